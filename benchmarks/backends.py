@@ -0,0 +1,49 @@
+"""
+    Compare files/sec of threads, processes and hybrid execution backends on a synthetic corpus
+
+    PYTHONPATH=src python benchmarks/backends.py --files 200 --cpu_workers 4
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+
+from corpus import CorpusSettings, generate_corpus
+from utils import EXECUTION_BACKENDS, ExecutionSettings, PhotoPixelSizeObject, PhotoRequirements, \
+    find_and_copy_photo
+
+
+def run(find_dir: pathlib.Path, execution: ExecutionSettings, verify_decode: bool) -> tuple:
+    photo_requirements = PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(width=640, height=480)])
+    start = time.perf_counter()
+    result = find_and_copy_photo(find_dir=find_dir, photo_requirements=photo_requirements,
+                                 verify_decode=verify_decode, execution=execution)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--width', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('--io_workers', type=int, default=None)
+    parser.add_argument('--cpu_workers', type=int, default=None)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        find_dir = pathlib.Path(tmp)
+        generate_corpus(find_dir, CorpusSettings(files=args.files, sizes=((args.width, args.height),),
+                                                 formats=('JPEG', 'PNG')))
+        for verify_decode in (False, True):
+            for backend in EXECUTION_BACKENDS:
+                execution = ExecutionSettings(backend=backend, io_workers=args.io_workers,
+                                              cpu_workers=args.cpu_workers, batch_size=args.batch_size)
+                seconds, result = run(find_dir, execution, verify_decode)
+                name = f'{backend}{" + verify_decode" if verify_decode else ""}'
+                print(f'{name:>27}: {args.files / seconds:10.1f} files/sec '
+                      f'(found={result.counts["found"]}, errors={result.counts["errors"]})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import pathlib
+import random
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+
+@dataclass
+class CorpusSettings:
+    files: int = field(default=100)
+    sizes: tuple = field(default=((4000, 3000), (3000, 4000), (1920, 1080), (640, 480)))
+    formats: tuple = field(default=('JPEG', 'PNG'))
+    modes: tuple = field(default=('RGB',))
+    seed: int = field(default=0)
+    # directory tree: every directory down to depth has fan_out inner directories, files are spread over all of them
+    depth: int = field(default=0)
+    fan_out: int = field(default=1)
+    # share of files which are truncated photos and share of files which are not images
+    corrupt_ratio: float = field(default=0.0)
+    non_image_ratio: float = field(default=0.0)
+
+
+@dataclass
+class Corpus:
+    photos: list = field(default_factory=list)
+    corrupt: list = field(default_factory=list)
+    non_images: list = field(default_factory=list)
+    directories: int = field(default=1)
+    bytes: int = field(default=0)
+
+    @property
+    def files(self) -> int:
+        return len(self.photos) + len(self.corrupt) + len(self.non_images)
+
+
+_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'BMP': 'bmp', 'WEBP': 'webp', 'TIFF': 'tif'}
+_NON_IMAGE_EXTENSIONS = ('txt', 'json', 'mp4', 'pdf')
+
+
+def _directories(root: pathlib.Path, depth: int, fan_out: int) -> list:
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [directory.joinpath(f'dir_{index:03d}') for directory in level for index in range(fan_out)]
+        directories.extend(level)
+    for directory in directories:
+        directory.mkdir(parents=True, exist_ok=True)
+    return directories
+
+
+def generate_tree(root: pathlib.Path, settings: CorpusSettings = None) -> Corpus:
+    """
+        Generate synthetic photos, truncated photos and other files in directory tree
+        :param root: pathlib.Path - directory to generate files in
+        :param settings: CorpusSettings - how many files, which tree and which sizes, formats and modes to generate
+        :return: Corpus - paths of generated files by kind and their total size
+    """
+    if settings is None:
+        settings = CorpusSettings()
+    rand = random.Random(settings.seed)
+    directories = _directories(root, settings.depth, max(1, settings.fan_out))
+    corpus = Corpus(directories=len(directories))
+    # noise does not compress well, so encoded files have realistic size for their resolution
+    for index in range(settings.files):
+        directory = directories[index % len(directories)]
+        # no extra random draw without corrupt and other files, so photos of the same seed stay the same
+        kind = rand.random() if settings.corrupt_ratio or settings.non_image_ratio else 1.0
+        if kind < settings.non_image_ratio:
+            path = directory.joinpath(f'file_{index:06d}.{rand.choice(_NON_IMAGE_EXTENSIONS)}')
+            path.write_bytes(rand.randbytes(rand.randint(100, 64 * 1024)))
+            corpus.non_images.append(path)
+        else:
+            width, height = rand.choice(settings.sizes)
+            photo_format = rand.choice(settings.formats)
+            mode = rand.choice(settings.modes)
+            if photo_format == 'JPEG' and mode not in ('RGB', 'L', 'CMYK'):
+                mode = 'RGB'
+            path = directory.joinpath(f'photo_{index:06d}.{_EXTENSIONS.get(photo_format, photo_format.lower())}')
+            with Image.effect_noise((width, height), 64).convert(mode) as img:
+                img.save(path, format=photo_format)
+            if kind < settings.non_image_ratio + settings.corrupt_ratio:
+                # header is kept, so file looks like image until its data is read
+                with open(path, 'r+b') as file:
+                    file.truncate(max(64, path.stat().st_size // 3))
+                corpus.corrupt.append(path)
+            else:
+                corpus.photos.append(path)
+        corpus.bytes += path.stat().st_size
+    return corpus
+
+
+def generate_corpus(root: pathlib.Path, settings: CorpusSettings = None) -> list:
+    """
+        Generate synthetic photos in root directory
+        :param root: pathlib.Path - directory to generate photos in
+        :param settings: CorpusSettings - how many photos and which sizes, formats and modes to generate
+        :return: list - paths of generated photos
+    """
+    return generate_tree(root, settings).photos
@@ -0,0 +1,41 @@
+"""
+    Compare files/sec of header-only matching and full decode (--verify_decode) on a synthetic corpus
+
+    PYTHONPATH=src python benchmarks/header_only.py --files 200
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+
+from corpus import CorpusSettings, generate_corpus
+from utils import PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo
+
+
+def run(find_dir: pathlib.Path, verify_decode: bool) -> tuple:
+    photo_requirements = PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(width=1080, height=1080)])
+    start = time.perf_counter()
+    result = find_and_copy_photo(find_dir=find_dir, photo_requirements=photo_requirements,
+                                 verify_decode=verify_decode)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        find_dir = pathlib.Path(tmp)
+        generate_corpus(find_dir, CorpusSettings(files=args.files, sizes=((args.width, args.height),),
+                                                 formats=('JPEG',)))
+        for name, verify_decode in (('header-only', False), ('verify-decode', True)):
+            seconds, result = run(find_dir, verify_decode)
+            print(f'{name:>14}: {args.files / seconds:10.1f} files/sec '
+                  f'(found={result.counts["found"]}, errors={result.counts["errors"]})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+    Run search and copy scenarios on a synthetic directory tree and report files/sec, bytes/sec, peak RSS,
+    time to first match and latency percentiles of check and copy stages. Every scenario runs in a new process,
+    so peak RSS of one scenario does not include others. JSON report can be compared with report of other commit
+
+    PYTHONPATH=src python benchmarks/suite.py --files 500 --depth 2 --fan_out 4 --json before.json
+    PYTHONPATH=src python benchmarks/suite.py --files 500 --depth 2 --fan_out 4 --compare before.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import pathlib
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+
+from corpus import CorpusSettings, generate_tree
+
+
+SCENARIOS = {
+    'search': {'copy': False, 'verify_decode': False},
+    'search_verify': {'copy': False, 'verify_decode': True},
+    'copy': {'copy': True, 'verify_decode': False},
+}
+STAGES = ('check', 'copy')
+PERCENTILES = (50, 95, 99)
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f'p{percent}': values[min(len(values) - 1, int(len(values) * percent / 100))] * 1000
+              for percent in PERCENTILES}
+    result['max'] = values[-1] * 1000
+    return result
+
+
+def _timed(function, latencies: list):
+    # list.append is atomic, so threads record latencies without lock
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, children are CPU processes of backend
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * scale / 1e6
+
+
+def _run_scenario(name: str, find_dir: str, options: dict, queue: multiprocessing.Queue) -> None:
+    from utils import CallbackResultSink, CopyEngine, ExecutionSettings, FindCopyPhotoResult, PhotoPixelSizeObject, \
+        PhotoRequirements, find_and_copy_photo
+    from utils import photo_finder
+
+    # errors of corrupt files are counted in result, they are not printed like in CLI
+    logging.getLogger().setLevel(logging.CRITICAL)
+    # stages are timed in this process, CPU processes of processes and hybrid backends are not timed
+    latencies = {stage: [] for stage in STAGES}
+    photo_finder.check_photo = _timed(photo_finder.check_photo, latencies['check'])
+    photo_finder.copy_photo = _timed(photo_finder.copy_photo, latencies['copy'])
+    first_match = []
+    result = FindCopyPhotoResult(keep_items=False)
+    result.sink = CallbackResultSink(lambda record: first_match.append(record.time)
+                                     if record.type == 'found' and not first_match else None)
+    photo_requirements = PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(width=640, height=480)])
+    execution = ExecutionSettings(backend=options['backend'], io_workers=options['io_workers'],
+                                  cpu_workers=options['cpu_workers'])
+    copy_engine = CopyEngine()
+    with tempfile.TemporaryDirectory() as copy_dir:
+        started = time.time()
+        start = time.perf_counter()
+        find_and_copy_photo(find_dir=pathlib.Path(find_dir), recursive=True,
+                            copy_dir=pathlib.Path(copy_dir) if SCENARIOS[name]['copy'] else None,
+                            photo_requirements=photo_requirements, result=result,
+                            verify_decode=SCENARIOS[name]['verify_decode'], execution=execution,
+                            copy_engine=copy_engine)
+        seconds = time.perf_counter() - start
+    queue.put({
+        'seconds': seconds,
+        'first_match_ms': (first_match[0] - started) * 1000 if first_match else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'copied_bytes': copy_engine.stats.bytes,
+        'counts': dict(result.counts),
+        'stages': {stage: _percentiles(values) for stage, values in latencies.items() if values},
+    })
+
+
+def run_scenario(name: str, find_dir: pathlib.Path, options: dict) -> dict:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_scenario, args=(name, str(find_dir), options, queue))
+    process.start()
+    report = queue.get()
+    process.join()
+    return report
+
+
+def _summary(name: str, runs: list, corpus) -> dict:
+    # median run by time, so one slow run does not move numbers
+    run = sorted(runs, key=lambda item: item['seconds'])[len(runs) // 2]
+    return {
+        'name': name,
+        'runs': len(runs),
+        'seconds': run['seconds'],
+        'files_per_second': corpus.files / run['seconds'],
+        'bytes_per_second': corpus.bytes / run['seconds'],
+        'copied_bytes_per_second': run['copied_bytes'] / run['seconds'] if run['copied_bytes'] else None,
+        'first_match_ms': run['first_match_ms'],
+        'peak_rss_mb': max(item['peak_rss_mb'] for item in runs),
+        'seconds_stdev': statistics.stdev(item['seconds'] for item in runs) if len(runs) > 1 else 0.0,
+        'counts': run['counts'],
+        'stages': run['stages'],
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=pathlib.Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print(scenario: dict, baseline: dict = None, threshold: float = 5.0) -> None:
+    def change(key: str, higher_is_better: bool = True) -> str:
+        # change worse than threshold is marked, it can be regression
+        if baseline is None or not baseline.get(key) or scenario.get(key) is None:
+            return ''
+        percent = (scenario[key] / baseline[key] - 1) * 100
+        is_worse = (percent < -threshold) if higher_is_better else (percent > threshold)
+        return f' ({percent:+.1f}%{" !" if is_worse else ""})'
+
+    first_match = f'{scenario["first_match_ms"]:.1f} ms' if scenario['first_match_ms'] is not None else '-'
+    print(f'{scenario["name"]:>14}: {scenario["files_per_second"]:10.1f} files/sec{change("files_per_second")}, '
+          f'{scenario["bytes_per_second"] / 1e6:8.1f} MB/s, first match {first_match}'
+          f'{change("first_match_ms", False)}, peak RSS {scenario["peak_rss_mb"]:.1f} MB{change("peak_rss_mb", False)}')
+    for stage, percentiles in scenario['stages'].items():
+        print(f'{"":>16}{stage:>6} ms: ' + ', '.join(f'{key}={value:.2f}' for key, value in percentiles.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fan_out', type=int, default=3)
+    parser.add_argument('--formats', default='JPEG,PNG,GIF,BMP,WEBP,TIFF')
+    parser.add_argument('--sizes', default='4000:3000,1920:1080,640:480,320:240')
+    parser.add_argument('--corrupt_ratio', type=float, default=0.05)
+    parser.add_argument('--non_image_ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--backend', default='threads')
+    parser.add_argument('--io_workers', type=int, default=None)
+    parser.add_argument('--cpu_workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', default=None, help='Write report to this file')
+    parser.add_argument('--compare', default=None, help='Show change against report of other run')
+    parser.add_argument('--threshold', type=float, default=5.0, help='Mark changes worse than this percent')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'Unknown scenarios {unknown}, supported ones are {tuple(SCENARIOS)}')
+    settings = CorpusSettings(files=args.files, depth=args.depth, fan_out=args.fan_out,
+                              formats=tuple(args.formats.split(',')),
+                              sizes=tuple(tuple(map(int, size.split(':'))) for size in args.sizes.split(',')),
+                              corrupt_ratio=args.corrupt_ratio, non_image_ratio=args.non_image_ratio, seed=args.seed)
+    options = {'backend': args.backend, 'io_workers': args.io_workers, 'cpu_workers': args.cpu_workers}
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline_report = json.load(file)
+        baseline = {scenario['name']: scenario for scenario in baseline_report['scenarios']}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        find_dir = pathlib.Path(tmp)
+        corpus = generate_tree(find_dir, settings)
+        print(f'Corpus: {corpus.files} files ({len(corpus.photos)} photos, {len(corpus.corrupt)} corrupt, '
+              f'{len(corpus.non_images)} other) in {corpus.directories} directories, {corpus.bytes / 1e6:.1f} MB')
+        report = {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus': {**asdict(settings), 'directories': corpus.directories, 'bytes': corpus.bytes},
+            'options': options,
+            'scenarios': [],
+        }
+        if args.compare:
+            for key in ('corpus', 'options'):
+                if json.loads(json.dumps(report[key])) != baseline_report.get(key):
+                    print(f'Warning: {key} differs from {args.compare}, numbers are not comparable')
+        for name in scenarios:
+            runs = [run_scenario(name, find_dir, options) for _ in range(max(1, args.repeat))]
+            scenario = _summary(name, runs, corpus)
+            report['scenarios'].append(scenario)
+            _print(scenario, baseline.get(name), args.threshold)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
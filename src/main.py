@@ -1,14 +1,20 @@
+import contextlib
 import pathlib
 import re
+import signal
 import click
 
-from utils import FindCopyPhotoResult, PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo, PHOTO_FORMATS, \
-    PHOTO_MODES
+# only choices and defaults of options are imported to define CLI, modules which implement commands are imported
+# by callbacks and commands which use them, so --help does not import them
+from utils import COPY_MODES, DEDUP_MODES, EXECUTION_BACKENDS, PERCEPTUAL_HASHES, RESULT_SINK_FORMATS, \
+    PHOTO_FORMATS, PHOTO_MODES, WATCH_BACKENDS, METRICS_FORMATS, PROFILERS, EXPORT_FORMATS, DEFAULT_BATCH_SIZE, \
+    DEFAULT_DECODE_MEMORY, DEFAULT_MAX_PIXELS, JOURNAL_FILE_NAME, MAX_PERCEPTUAL_DISTANCE, default_index_path
 import logging
 logger = logging.getLogger()
 
 
 def size_type(ctx, param, value):
+    from utils import PhotoPixelSizeObject
     if value is None or value == '':
         min_sizes = None
     else:
@@ -28,6 +34,7 @@ def size_type(ctx, param, value):
 
 
 def photo_mode(ctx, param, value):
+    from utils import PhotoRequirements
     if value is None or value == '':
         modes = PHOTO_MODES
     else:
@@ -40,6 +47,7 @@ def photo_mode(ctx, param, value):
 
 
 def photo_format(ctx, param, value):
+    from utils import PhotoRequirements
     if value is None or value == '':
         formats = PHOTO_FORMATS
     else:
@@ -51,9 +59,58 @@ def photo_format(ctx, param, value):
     return formats
 
 
+def where_type(ctx, param, value):
+    if value is None or value == '':
+        return None
+    from utils import FileFilter
+    try:
+        return FileFilter(value)
+    except Exception as e:
+        raise click.BadParameter(str(e))
+
+
+def export_size_type(ctx, param, value):
+    if value is None or value == '':
+        return None
+    if not re.match(r'^[0-9]{1,6}:[0-9]{1,6}$', value):
+        raise click.BadParameter('Incorrect size pattern. Set size of box in format width:height, '
+                                 '0 for side without limit')
+    width, height = value.split(':')
+    return int(width), int(height)
+
+
+def shard_type(ctx, param, value):
+    if value is None or value == '':
+        return None
+    from utils import Shard
+    try:
+        return Shard.parse(value)
+    except Exception as e:
+        raise click.BadParameter(str(e))
+
+
+def cameras_type(ctx, param, value):
+    if value is None or value == '':
+        return ()
+    return tuple(camera.strip() for camera in value.split(',') if camera.strip())
+
+
+def gps_bbox_type(ctx, param, value):
+    if value is None or value == '':
+        return None
+    from utils import ExifRequirements
+    try:
+        bbox = tuple(float(coordinate) for coordinate in value.split(','))
+        ExifRequirements(gps_bbox=bbox)
+    except Exception as e:
+        raise click.BadParameter(f'Set GPS box in format south,west,north,east in degrees, e.g. 45.8,5.9,47.8,10.5 '
+                                 f'({e})')
+    return bbox
+
+
 @click.group()
-@click.option('-d', '--find_dir', default=None, type=click.Path(dir_okay=True, file_okay=False, exists=True),
-              help='Directory where to search photos or current by default')
+@click.option('-d', '--find_dir', multiple=True, type=click.Path(dir_okay=True, file_okay=False, exists=True),
+              help='Directory where to search photos or current by default, repeat option for several directories')
 @click.option('-r', '--recursive', is_flag=True, help='Search in inner directories recursively')
 @click.option('-m', '--photo_modes', default=None, type=click.UNPROCESSED, callback=photo_mode,
               help=f'Search photo with selected mode or modes (default any of {PHOTO_MODES}) - '
@@ -65,20 +122,108 @@ def photo_format(ctx, param, value):
               show_default=True, help='Set size in format width:height for one size or width:height,width:height,... '
                                       'for several (maximum 10 sizes from 0:0 to 999999:999999)')
 @click.option('-a', '--add_reverse_sizes', is_flag=True, help='Add reverse min sizes')
+@click.option('-w', '--where', default=None, type=click.UNPROCESSED, callback=where_type,
+              help='Filter expression, e.g. "ext in (jpg, png) and size > 500KB and megapixels between 2 and 24". '
+                   'Path and stat conditions are checked before file is opened')
+@click.option('--taken_from', default=None, type=click.DateTime(), help='Search photo taken since date from EXIF')
+@click.option('--taken_to', default=None, type=click.DateTime(), help='Search photo taken until date from EXIF')
+@click.option('--cameras', default=None, type=click.UNPROCESSED, callback=cameras_type,
+              help='Search photo taken by camera, a part of EXIF make and model case insensitive - '
+                   'use CAMERA for one and CAMERA_1,CAMERA_2,... for several')
+@click.option('--gps_bbox', default=None, type=click.UNPROCESSED, callback=gps_bbox_type,
+              help='Search photo with EXIF GPS position in box south,west,north,east in degrees')
 @click.option('-e', '--extended_result', is_flag=True, help='Show extended result')
 @click.option('-l', '--with_logs', is_flag=True, help='Show info logs')
+@click.option('--verify_decode', is_flag=True, help='Decode every image fully to check its integrity '
+                                                     '(by default only image header is read)')
+@click.option('--max_pixels', default=DEFAULT_MAX_PIXELS, show_default=True, type=click.IntRange(min=1),
+              help='Images with more pixels are not decoded, only their header is checked')
+@click.option('--max_file_size', default=None, type=click.IntRange(min=1),
+              help='MB, larger images are not decoded, only their header is checked')
+@click.option('--decode_memory', default=DEFAULT_DECODE_MEMORY // (1024 * 1024), show_default=True,
+              type=click.IntRange(min=1), help='MB of pixels decoded at once by all threads and CPU processes, '
+                                               'larger images are not decoded')
+@click.option('--decode_timeout', default=None, type=click.FloatRange(min=0, min_open=True),
+              help='Seconds of decode of one image, decode which takes longer fails')
+@click.option('-i', '--use_index', is_flag=True, help='Answer files with unchanged stat from metadata index '
+                                                     'and update index for new and changed files')
+@click.option('--index_path', default=None, type=click.Path(dir_okay=False, file_okay=True),
+              help=f'Metadata index file ({default_index_path()} by default)')
+@click.option('--backend', default='threads', show_default=True, type=click.Choice(EXECUTION_BACKENDS),
+              help='Execution backend: threads check and copy files, processes check files in CPU processes, '
+                   'hybrid reads headers in I/O threads and decodes images in CPU processes')
+@click.option('--io_workers', default=None, type=click.IntRange(min=1), help='Number of I/O threads')
+@click.option('--cpu_workers', default=None, type=click.IntRange(min=1),
+              help='Number of CPU processes (number of CPUs by default)')
+@click.option('--batch_size', default=DEFAULT_BATCH_SIZE, show_default=True, type=click.IntRange(min=1),
+              help='Number of files sent to CPU process at once')
+@click.option('--shard', default=None, type=click.UNPROCESSED, callback=shard_type,
+              help='Check only shard INDEX of COUNT by hash of file path relative to find_dir, e.g. 0/4, so several '
+                   'workers scan disjoint parts of the same directories. Shard is added to names of output files')
+@click.option('-o', '--output', default=None, type=click.Path(dir_okay=False, file_okay=True, allow_dash=True),
+              help='Stream found, copied, not copied files, warnings and errors to file while scan is running '
+                   '(- for stdout), only counters are kept in memory')
+@click.option('--output_format', default=None, type=click.Choice(RESULT_SINK_FORMATS),
+              help='Output format (csv for .csv files and jsonl for others by default)')
+@click.option('--dedup', default=None, type=click.Choice(DEDUP_MODES),
+              help='Find photos with the same content: report shows duplicates, unique also copies only one photo '
+                   'of every group. Hashes are kept in metadata index with --use_index')
+@click.option('--stats', is_flag=True, help='Show time of every pipeline stage (walk, header read and parse, '
+                                             'decode, check, copy, hash) at the end')
+@click.option('--metrics', 'metrics_path', default=None, type=click.Path(dir_okay=False, file_okay=True),
+              help='Write stage latency histograms and counters to file at the end')
+@click.option('--metrics_format', default='json', show_default=True, type=click.Choice(METRICS_FORMATS),
+              help='Format of metrics file, prometheus is text exposition format')
+@click.option('--profile', 'profile_path', default=None, type=click.Path(dir_okay=False, file_okay=True),
+              help='Profile command and write profile to file')
+@click.option('--profiler', default='cprofile', show_default=True, type=click.Choice(PROFILERS),
+              help='cprofile writes pstats file, sampling writes collapsed stacks for flame graphs')
 @click.pass_context
-def photo_finder(context, find_dir, recursive, photo_modes, photo_formats, min_sizes, add_reverse_sizes, extended_result,
-                 with_logs):
+def photo_finder(context, find_dir, recursive, photo_modes, photo_formats, min_sizes, add_reverse_sizes, where,
+                 taken_from, taken_to, cameras, gps_bbox, extended_result, with_logs, verify_decode, max_pixels,
+                 max_file_size, decode_memory, decode_timeout, use_index, index_path, backend, io_workers, cpu_workers,
+                 batch_size, shard, output, output_format, dedup, stats, metrics_path, metrics_format, profile_path,
+                 profiler):
+    from utils import ExecutionSettings, ExifRequirements, FindCopyPhotoResult, PhotoPixelSizeObject, \
+        PhotoRequirements, ResourceLimits, governor, metrics, open_result_sink, profile
     if with_logs:
         logger.setLevel(logging.INFO)
     context.ensure_object(dict)
     result = FindCopyPhotoResult()
     context.obj['result'] = result
+    # with output to stdout other messages go to stderr, so stdout contains only records
+    context.obj['echo_err'] = output == '-'
+    context.obj['shard'] = shard
     try:
-        context.obj['find_dir'] = pathlib.Path(find_dir) if find_dir else pathlib.Path.cwd()
+        if shard is not None:
+            # every shard writes its own files, so workers can share output directory
+            output = str(shard.file_path(output)) if output and output != '-' else output
+            metrics_path = str(shard.file_path(metrics_path)) if metrics_path else None
+            profile_path = str(shard.file_path(profile_path)) if profile_path else None
+        if output:
+            result.sink = open_result_sink(output, output_format)
+            result.keep_items = False
+            context.call_on_close(result.sink.close)
+        if stats or metrics_path:
+            metrics.enable()
+            context.call_on_close(lambda: _report_metrics(stats, metrics_path, metrics_format,
+                                                          context.obj['echo_err']))
+        if profile_path:
+            # profile is written when command is finished, before metrics are reported
+            context.with_resource(profile(pathlib.Path(profile_path), profiler))
+        context.obj['find_dirs'] = [pathlib.Path(one_dir) for one_dir in find_dir] or [pathlib.Path.cwd()]
         context.obj['recursive'] = recursive
         context.obj['extended_result'] = extended_result
+        context.obj['verify_decode'] = verify_decode
+        context.obj['use_index'] = use_index
+        context.obj['index_path'] = pathlib.Path(index_path) if index_path else default_index_path()
+        context.obj['dedup'] = dedup
+        context.obj['execution'] = ExecutionSettings(backend=backend, io_workers=io_workers, cpu_workers=cpu_workers,
+                                                     batch_size=batch_size)
+        # limits are set before any process pool is started, CPU processes get them at start
+        governor.configure(ResourceLimits(max_pixels=max_pixels,
+                                          max_file_size=max_file_size * 1024 * 1024 if max_file_size else None,
+                                          decode_memory=decode_memory * 1024 * 1024, timeout=decode_timeout))
         min_photo_sizes = []
         if min_sizes:
             for size_item in min_sizes:
@@ -87,46 +232,317 @@ def photo_finder(context, find_dir, recursive, photo_modes, photo_formats, min_s
                     min_photo_sizes.append(PhotoPixelSizeObject(width=size_item.height, height=size_item.width))
 
         # set photo requirements
-        photo_requirements = PhotoRequirements(min_photo_sizes=min_photo_sizes)
+        exif_requirements = ExifRequirements(taken_from=taken_from.timestamp() if taken_from else None,
+                                             taken_to=taken_to.timestamp() if taken_to else None,
+                                             cameras=cameras, gps_bbox=gps_bbox)
+        photo_requirements = PhotoRequirements(min_photo_sizes=min_photo_sizes, where=where,
+                                               exif_requirements=exif_requirements)
         photo_requirements.set_photo_modes(photo_modes, False)
         photo_requirements.set_photo_formats(photo_formats, False)
         context.obj['photo_requirements'] = photo_requirements
 
     except Exception as e:
-        result.errors.append(f'Exception error: {repr(e)}')
+        result.add_error(f'Exception error: {repr(e)}')
+
+
+def _report_metrics(stats: bool, metrics_path: str, metrics_format: str, echo_err: bool) -> None:
+    from utils import metrics
+    metrics.disable()
+    if stats:
+        click.echo(f'{metrics.repr_summary()}\n', err=echo_err)
+    if metrics_path:
+        with open(metrics_path, 'w') as file:
+            metrics.write(file, metrics_format)
+
+
+@contextlib.contextmanager
+def _open_index(context):
+    if not context.obj['use_index']:
+        yield None
+        return
+    from utils import PhotoIndex
+    with PhotoIndex(context.obj['index_path']) as photo_index:
+        yield photo_index
+
+
+def _create_duplicate_finder(context, photo_index):
+    if context.obj['dedup'] is None:
+        return None
+    from utils import DuplicateFinder
+    return DuplicateFinder(mode=context.obj['dedup'], cache=photo_index, workers=context.obj['execution'].io_workers)
 
 
 @photo_finder.command()
 @click.pass_context
 def search(context):
-    click.echo('\nStart search')
+    from utils import find_and_copy_photo
+    click.echo('\nStart search', err=context.obj['echo_err'])
     result = context.obj['result']
-    if not result.errors:
+    if not result.has_errors:
         try:
-            res = find_and_copy_photo(find_dir=context.obj['find_dir'], recursive=context.obj['recursive'],
-                                      photo_requirements=context.obj['photo_requirements'])
-            result = context.obj['result'] + res
+            with _open_index(context) as photo_index:
+                find_and_copy_photo(find_dir=context.obj['find_dirs'], recursive=context.obj['recursive'],
+                                    photo_requirements=context.obj['photo_requirements'],
+                                    result=result, verify_decode=context.obj['verify_decode'],
+                                    photo_index=photo_index, execution=context.obj['execution'],
+                                    duplicate_finder=_create_duplicate_finder(context, photo_index),
+                                    shard=context.obj['shard'])
         except Exception as e:
-            result.errors.append(f'Exception error: {repr(e)}')
-    click.echo(f'End search\n{result.repr_detailed_search() if context.obj["extended_result"] else result.repr_short_search()}\n')
+            result.add_error(f'Exception error: {repr(e)}')
+    click.echo(f'End search\n{result.repr_detailed_search() if context.obj["extended_result"] else result.repr_short_search()}\n',
+               err=context.obj['echo_err'])
 
 
 @photo_finder.command()
 @click.argument('copy_dir', type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--copy_mode', default='copy', show_default=True, type=click.Choice(COPY_MODES),
+              help='copy uses the fastest supported method (reflink, copy_file_range, sendfile or buffer copy), '
+                   'hardlink and symlink link photos instead of copying')
+@click.option('--journal', default=None, type=click.Path(dir_okay=False, file_okay=True),
+              help='Checkpoint file of copy job with status of every checked file '
+                   f'(COPY_DIR/{JOURNAL_FILE_NAME} by default)')
+@click.option('--resume', is_flag=True, help='Skip files finished by interrupted run of the same job without '
+                                              'opening them')
+@click.option('--retry_failed', is_flag=True, help='Resume and check and copy again files which failed')
+@click.option('--export_format', default=None, type=click.Choice(EXPORT_FORMATS, case_sensitive=False),
+              help='Export photos resized and encoded to this format instead of copying them')
+@click.option('--export_quality', default=85, show_default=True, type=click.IntRange(min=1, max=100),
+              help='Encoder quality of JPEG and WEBP export')
+@click.option('--export_size', default=None, type=click.UNPROCESSED, callback=export_size_type,
+              help='Fit exported photo in box width:height, 0 for side without limit, photo is not enlarged')
+@click.option('--export_memory', default=512, show_default=True, type=click.IntRange(min=1),
+              help='MB of photos decoded by export at once')
 @click.pass_context
-def copy(context, copy_dir):
-    click.echo('\nStart copy')
+def copy(context, copy_dir, copy_mode, journal, resume, retry_failed, export_format, export_quality, export_size,
+         export_memory):
+    from utils import CopyEngine, CopyJournal, ExportEngine, ExportSettings, default_export_cache_path, \
+        default_journal_path, find_and_copy_photo
+    click.echo('\nStart copy', err=context.obj['echo_err'])
     result = context.obj['result']
-    if not result.errors:
+    if not result.has_errors:
         try:
             copy_dir = pathlib.Path(copy_dir)
-            find_and_copy_photo(find_dir=context.obj['find_dir'], copy_dir=copy_dir,
-                                recursive=context.obj['recursive'],
-                                photo_requirements=context.obj['photo_requirements'],
-                                result=result)
+            shard = context.obj['shard']
+            if export_format is None:
+                copy_engine = CopyEngine(mode=copy_mode)
+            elif copy_mode != 'copy':
+                raise Exception(f'Export can not be used with copy_mode={copy_mode}')
+            else:
+                export_settings = ExportSettings(format=export_format, quality=export_quality,
+                                                 max_width=export_size[0] if export_size else 0,
+                                                 max_height=export_size[1] if export_size else 0)
+                export_cache_path = default_export_cache_path(copy_dir)
+                copy_engine = ExportEngine(export_settings,
+                                           shard.file_path(export_cache_path) if shard else export_cache_path,
+                                           workers=context.obj['execution'].cpu_workers,
+                                           memory_limit=export_memory * 1024 * 1024)
+            journal_path = pathlib.Path(journal) if journal else default_journal_path(copy_dir)
+            # files which did not match or were not copied are skipped on resume, so job is resumed only
+            # with the same requirements and copy settings
+            photo_requirements = context.obj['photo_requirements']
+            job_options = {'requirements': photo_requirements.as_dict() if photo_requirements else None,
+                           'verify_decode': context.obj['verify_decode'], 'copy_mode': copy_mode,
+                           'export': export_settings.key if export_format is not None else None,
+                           'dedup': context.obj['dedup']}
+            copy_journal = CopyJournal(shard.file_path(journal_path) if shard else journal_path,
+                                       find_dir=context.obj['find_dirs'], copy_dir=copy_dir,
+                                       recursive=context.obj['recursive'], resume=resume, retry_failed=retry_failed,
+                                       shard=shard, options=job_options)
+            with copy_journal, _open_index(context) as photo_index, \
+                    copy_engine if export_format is not None else contextlib.nullcontext():
+                result.journal = copy_journal
+                find_and_copy_photo(find_dir=context.obj['find_dirs'], copy_dir=copy_dir,
+                                    recursive=context.obj['recursive'],
+                                    photo_requirements=context.obj['photo_requirements'],
+                                    result=result, verify_decode=context.obj['verify_decode'],
+                                    photo_index=photo_index, execution=context.obj['execution'],
+                                    copy_engine=copy_engine,
+                                    duplicate_finder=_create_duplicate_finder(context, photo_index), shard=shard)
+            if resume or retry_failed:
+                click.echo(f'Resumed: {copy_journal.resumed} finished files were skipped', err=context.obj['echo_err'])
+            click.echo(copy_engine.repr_stats(), err=context.obj['echo_err'])
+        except Exception as e:
+            result.add_error(f'Exception error: {repr(e)}')
+    click.echo(f'End copy\n{result.repr_detailed_copy() if context.obj["extended_result"] else result.repr_short_copy()}\n',
+               err=context.obj['echo_err'])
+
+
+@photo_finder.command()
+@click.option('--to', 'reference', default=None, type=click.Path(dir_okay=False, file_okay=True, exists=True),
+              help='Find photos similar to this photo, by default all photos are grouped by similarity')
+@click.option('--distance', default=10, show_default=True,
+              type=click.IntRange(min=0, max=MAX_PERCEPTUAL_DISTANCE),
+              help='Maximum Hamming distance between perceptual hashes of similar photos')
+@click.option('--hash', 'hash_kind', default='dhash', show_default=True, type=click.Choice(PERCEPTUAL_HASHES),
+              help='Perceptual hash: dhash (gradients, faster) or phash (DCT, more robust to edits)')
+@click.pass_context
+def similar(context, reference, distance, hash_kind):
+    """Find resized, recompressed and other near-duplicate photos"""
+    from utils import build_perceptual_index, perceptual_hash
+    click.echo('\nStart similar', err=context.obj['echo_err'])
+    result = context.obj['result']
+    messages = []
+    if not result.has_errors:
+        try:
+            if context.obj['shard'] is not None:
+                raise Exception('Similar photos are searched among all photos, it can not be used with shard')
+            with _open_index(context) as photo_index:
+                hash_index = build_perceptual_index(context.obj['find_dirs'], recursive=context.obj['recursive'],
+                                                    photo_requirements=context.obj['photo_requirements'],
+                                                    kind=hash_kind, photo_index=photo_index,
+                                                    workers=context.obj['execution'].io_workers,
+                                                    on_error=result.add_error, on_warning=result.add_warning)
+            if reference:
+                matches = hash_index.query(perceptual_hash(pathlib.Path(reference), hash_kind), distance)
+                messages.append(f'SIMILAR TO {reference}: {len(matches)}')
+                messages.extend(f'{path} (distance={match_distance})' for path, match_distance in matches)
+            else:
+                clusters = hash_index.clusters(distance)
+                messages.append(f'SIMILAR GROUPS: {len(clusters)}')
+                for number, paths in enumerate(clusters, start=1):
+                    messages.append(f'Group {number}:')
+                    messages.extend(f'  {path}' for path in paths)
+            messages.insert(0, f'Result: hashed={len(hash_index)}, warnings={result.counts["warnings"]}, '
+                               f'errors={result.counts["errors"]}')
         except Exception as e:
-            result.errors.append(f'Exception error: {repr(e)}')
-    click.echo(f'End copy\n{result.repr_detailed_copy() if context.obj["extended_result"] else result.repr_short_copy()}\n')
+            result.add_error(f'Exception error: {repr(e)}')
+    if not messages:
+        messages.append(result.repr_short_search())
+    elif result.counts['warnings'] or result.counts['errors']:
+        messages.insert(1, result.repr_warnings_and_errors(False))
+    click.echo('End similar\n' + '\n'.join(messages) + '\n', err=context.obj['echo_err'])
+
+
+@photo_finder.command()
+@click.argument('copy_dir', required=False, type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--copy_mode', default='copy', show_default=True, type=click.Choice(COPY_MODES),
+              help='copy uses the fastest supported method, hardlink and symlink link photos instead of copying')
+@click.option('--watch_backend', default='auto', show_default=True, type=click.Choice(WATCH_BACKENDS),
+              help='inotify sleeps until files change, polling walks find_dir every poll interval, '
+                   'auto uses inotify if it is available')
+@click.option('--settle', default=2.0, show_default=True, type=click.FloatRange(min=0),
+              help='Seconds without changes before new or changed file is checked, so partially written files '
+                   'are not copied')
+@click.option('--poll_interval', default=5.0, show_default=True, type=click.FloatRange(min=0.1),
+              help='Seconds between walks of polling backend')
+@click.option('--initial_scan', is_flag=True, help='Search and copy existing files before watching')
+@click.pass_context
+def watch(context, copy_dir, copy_mode, watch_backend, settle, poll_interval, initial_scan):
+    """Check and copy new and changed files of find_dir as they arrive until Ctrl+C"""
+    from utils import CopyEngine, PhotoWatcher, find_and_copy_photo
+    click.echo('\nStart watch', err=context.obj['echo_err'])
+    result = context.obj['result']
+    if not result.has_errors:
+        try:
+            if len(context.obj['find_dirs']) > 1 or context.obj['shard'] is not None:
+                raise Exception('Watch can be used only with one find_dir and without shard')
+            find_dir = context.obj['find_dirs'][0]
+            copy_dir = pathlib.Path(copy_dir) if copy_dir else None
+            copy_engine = CopyEngine(mode=copy_mode)
+            watcher = PhotoWatcher(find_dir, copy_dir=copy_dir, recursive=context.obj['recursive'],
+                                   photo_requirements=context.obj['photo_requirements'],
+                                   verify_decode=context.obj['verify_decode'], copy_engine=copy_engine,
+                                   backend=watch_backend, settle=settle, poll_interval=poll_interval,
+                                   workers=context.obj['execution'].io_workers, result=result)
+            signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+
+            def on_ready():
+                # watches are set before initial scan, so files written during scan are not missed
+                if initial_scan:
+                    find_and_copy_photo(find_dir=find_dir, copy_dir=copy_dir,
+                                        recursive=context.obj['recursive'],
+                                        photo_requirements=context.obj['photo_requirements'],
+                                        result=result, verify_decode=context.obj['verify_decode'],
+                                        execution=context.obj['execution'], copy_engine=copy_engine)
+                click.echo(f'Watching {watcher.find_dir} with {watcher.backend}, press Ctrl+C to stop',
+                           err=context.obj['echo_err'])
+
+            watcher.run(on_ready=on_ready)
+            click.echo(watcher.stats.repr_short(), err=context.obj['echo_err'])
+            if copy_dir is not None:
+                click.echo(copy_engine.repr_stats(), err=context.obj['echo_err'])
+        except Exception as e:
+            result.add_error(f'Exception error: {repr(e)}')
+    click.echo(f'End watch\n{result.repr_detailed_copy() if context.obj["extended_result"] else result.repr_short_copy()}\n',
+               err=context.obj['echo_err'])
+
+
+@photo_finder.command()
+@click.argument('result_files', nargs=-1, required=True,
+                type=click.Path(dir_okay=False, file_okay=True, exists=True))
+@click.option('--input_format', default=None, type=click.Choice(RESULT_SINK_FORMATS),
+              help='Format of result files (csv for .csv files and jsonl for others by default)')
+@click.pass_context
+def merge(context, result_files, input_format):
+    """Combine result files of shards written with --output into one report"""
+    from utils import merge_result_records
+    click.echo('\nStart merge', err=context.obj['echo_err'])
+    result = context.obj['result']
+    if not result.has_errors:
+        try:
+            # records of all files are streamed to report and to --output, they are not kept together in memory
+            for record in merge_result_records(result_files, input_format, on_warning=result.add_warning):
+                result.add_record(record)
+        except Exception as e:
+            result.add_error(f'Exception error: {repr(e)}')
+    # copy report is shown if shards copied photos, search report otherwise
+    if result.counts['copied'] or result.counts['not_copied']:
+        report = result.repr_detailed_copy() if context.obj['extended_result'] else result.repr_short_copy()
+    else:
+        report = result.repr_detailed_search() if context.obj['extended_result'] else result.repr_short_search()
+    click.echo(f'End merge\nMerged files: {len(result_files)}\n{report}\n', err=context.obj['echo_err'])
+
+
+@photo_finder.group()
+def index():
+    """Build, refresh and prune metadata index of find_dir"""
+
+
+def _run_index_command(context, name: str, **kwargs):
+    from utils import PhotoIndex
+    click.echo(f'\nStart index {name}')
+    result = context.obj['result']
+    if result.has_errors:
+        click.echo(f'End index {name}\n{result.repr_errors()}\n')
+        return
+    try:
+        messages = []
+        find_dirs = context.obj['find_dirs']
+        with PhotoIndex(context.obj['index_path']) as photo_index:
+            for find_dir in find_dirs:
+                if name == 'prune':
+                    index_result = photo_index.prune(find_dir=find_dir)
+                else:
+                    index_result = photo_index.refresh(find_dir=find_dir, recursive=context.obj['recursive'],
+                                                       verify_decode=context.obj['verify_decode'],
+                                                       shard=context.obj['shard'], **kwargs)
+                messages.append(index_result.repr_short() if len(find_dirs) == 1
+                                else f'{find_dir}:\n{index_result.repr_short()}')
+        message = '\n'.join(messages)
+    except Exception as e:
+        message = f'ERRORS:\nException error: {repr(e)}'
+    click.echo(f'End index {name}\n{message}\n')
+
+
+@index.command()
+@click.pass_context
+def build(context):
+    """Read headers of all files in find_dir again"""
+    _run_index_command(context, 'build', rebuild=True)
+
+
+@index.command()
+@click.pass_context
+def refresh(context):
+    """Read headers of new and changed files in find_dir only"""
+    _run_index_command(context, 'refresh')
+
+
+@index.command()
+@click.pass_context
+def prune(context):
+    """Remove files which do not exist anymore from index"""
+    _run_index_command(context, 'prune')
 
 
 def main():
@@ -1,2 +1,86 @@
-from .photo_finder import FindCopyPhotoResult, PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo, \
-    PHOTO_FORMATS, PHOTO_MODES
+import importlib
+from typing import TYPE_CHECKING
+
+# module => names it exports, a module is imported when one of its names is used for the first time,
+# so CLI which needs only a few names does not import every module of package
+_EXPORTS = {
+    'async_finder': ('PhotoMatch', 'afind_photos'),
+    'copy_engine': ('COPY_METHODS', 'CopyEngine', 'CopyStats'),
+    'copy_journal': ('CopyJournal', 'default_journal_path', 'JOURNAL_STATUSES'),
+    'dedup': ('DuplicateFinder',),
+    'defaults': ('COPY_MODES', 'DEDUP_MODES', 'DEFAULT_BATCH_SIZE', 'DEFAULT_DECODE_MEMORY', 'DEFAULT_MAX_PIXELS',
+                 'EXECUTION_BACKENDS', 'EXPORT_FORMATS', 'INDEX_FILE_NAME', 'JOURNAL_FILE_NAME',
+                 'MAX_PERCEPTUAL_DISTANCE', 'METRICS_FORMATS', 'PERCEPTUAL_HASHES', 'PHOTO_FORMATS', 'PHOTO_MODES',
+                 'PROFILERS', 'RESULT_SINK_FORMATS', 'WATCH_BACKENDS', 'default_index_path'),
+    'exif': ('ExifRequirements',),
+    'filters': ('FileFilter', 'WHERE_FIELDS'),
+    'governor': ('DeadlineReader', 'MemoryBudget', 'ResourceGovernor', 'ResourceLimits', 'estimate_decode_memory',
+                 'governor'),
+    'executors': ('ExecutionSettings',),
+    'exporter': ('ExportCache', 'ExportEngine', 'ExportSettings', 'default_export_cache_path',
+                 'estimate_export_memory', 'export_image', 'EXPORT_CACHE_FILE_NAME'),
+    'metrics': ('Histogram', 'Metrics', 'metrics', 'STAGES'),
+    'photo_finder': ('FindCopyPhotoResult', 'PhotoPixelSizeObject', 'PhotoRequirements', 'find_and_copy_photo',
+                     'read_photo_info'),
+    'photo_index': ('PhotoIndex', 'PhotoIndexResult'),
+    'photo_info': ('ExifInfo', 'PhotoInfo'),
+    'profiling': ('SamplingProfiler', 'profile'),
+    'result_sink': ('CallbackResultSink', 'CsvResultSink', 'JsonLinesResultSink', 'ResultRecord', 'ResultSink',
+                    'merge_result_records', 'open_result_sink', 'read_result_records', 'RECORD_TYPES'),
+    'sharding': ('Shard',),
+    'similarity': ('PerceptualHashIndex', 'build_perceptual_index', 'perceptual_hash'),
+    'sniffer': ('parse_exif', 'parse_header', 'sniff_image'),
+    'walker': ('DirectoryWalker', 'WalkBatch', 'WalkItem'),
+    'watcher': ('PhotoWatcher', 'WatchStats', 'is_partial_file', 'PARTIAL_SUFFIXES'),
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+__all__ = list(_MODULES)
+# these objects have names of their modules, the first import of module sets package attribute to module,
+# so they are imported at once and replace it
+from .governor import governor
+from .metrics import metrics
+
+
+def __getattr__(name: str):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    # the next use of name does not call __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
+
+
+if TYPE_CHECKING:
+    from .async_finder import PhotoMatch, afind_photos
+    from .copy_engine import COPY_METHODS, CopyEngine, CopyStats
+    from .copy_journal import CopyJournal, default_journal_path, JOURNAL_STATUSES
+    from .dedup import DuplicateFinder
+    from .defaults import COPY_MODES, DEDUP_MODES, DEFAULT_BATCH_SIZE, DEFAULT_DECODE_MEMORY, DEFAULT_MAX_PIXELS, \
+        EXECUTION_BACKENDS, EXPORT_FORMATS, INDEX_FILE_NAME, JOURNAL_FILE_NAME, MAX_PERCEPTUAL_DISTANCE, \
+        METRICS_FORMATS, PERCEPTUAL_HASHES, PHOTO_FORMATS, PHOTO_MODES, PROFILERS, RESULT_SINK_FORMATS, \
+        WATCH_BACKENDS, default_index_path
+    from .exif import ExifRequirements
+    from .filters import FileFilter, WHERE_FIELDS
+    from .governor import DeadlineReader, MemoryBudget, ResourceGovernor, ResourceLimits, estimate_decode_memory, \
+        governor
+    from .executors import ExecutionSettings
+    from .exporter import ExportCache, ExportEngine, ExportSettings, default_export_cache_path, \
+        estimate_export_memory, export_image, EXPORT_CACHE_FILE_NAME
+    from .metrics import Histogram, Metrics, metrics, STAGES
+    from .photo_finder import FindCopyPhotoResult, PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo, \
+        read_photo_info
+    from .photo_index import PhotoIndex, PhotoIndexResult
+    from .photo_info import ExifInfo, PhotoInfo
+    from .profiling import SamplingProfiler, profile
+    from .result_sink import CallbackResultSink, CsvResultSink, JsonLinesResultSink, ResultRecord, ResultSink, \
+        merge_result_records, open_result_sink, read_result_records, RECORD_TYPES
+    from .sharding import Shard
+    from .similarity import PerceptualHashIndex, build_perceptual_index, perceptual_hash
+    from .sniffer import parse_exif, parse_header, sniff_image
+    from .walker import DirectoryWalker, WalkBatch, WalkItem
+    from .watcher import PhotoWatcher, WatchStats, is_partial_file, PARTIAL_SUFFIXES
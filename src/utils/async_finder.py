@@ -0,0 +1,117 @@
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Union
+
+from .photo_finder import PhotoRequirements, read_photo_info
+from .photo_info import PhotoInfo
+from .walker import DirectoryWalker
+import logging
+logger = logging.getLogger()
+
+
+DEFAULT_MAX_OPEN_FILES = 16
+
+
+@dataclass(frozen=True)
+class PhotoMatch:
+    path: pathlib.Path
+    rel_dir: pathlib.PurePath
+    info: PhotoInfo
+
+
+def _check_file(path: pathlib.Path, rel_dir: pathlib.PurePath, photo_requirements: Union[PhotoRequirements, None],
+                verify_decode: bool) -> Union[PhotoMatch, str, None]:
+    try:
+        if photo_requirements and not photo_requirements.check_file(path):
+            return None
+        info = read_photo_info(path, verify_decode=verify_decode,
+                               read_exif=bool(photo_requirements and photo_requirements.needs_exif),
+                               photo_formats=photo_requirements.photo_formats if photo_requirements else None)
+    except Exception as e:
+        return f'Exception error on file "{str(path)}": {repr(e)}'
+    if info is None or (photo_requirements and not photo_requirements.check_image(info)):
+        return None
+    return PhotoMatch(path=path, rel_dir=rel_dir, info=info)
+
+
+async def afind_photos(find_dir: pathlib.Path, photo_requirements: PhotoRequirements = None, recursive: bool = False,
+                       verify_decode: bool = False, max_open_files: int = DEFAULT_MAX_OPEN_FILES,
+                       timeout: float = None, skip_dirs: list = None, on_error: Callable[[str], None] = None,
+                       on_warning: Callable[[str], None] = None) -> AsyncIterator[PhotoMatch]:
+    """
+        Find photos without blocking event loop, matches are yielded as soon as they are checked.
+        Walk and file reads run in threads, stopping iteration (break, aclose or task cancel) stops them
+        :param find_dir: pathlib.Path - directory to find photos
+        :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param recursive: bool - go to inner directories or not
+        :param verify_decode: bool - decode every image fully to check its integrity
+        :param max_open_files: int - maximum number of files opened at once
+        :param timeout: float - seconds for the whole search, asyncio.TimeoutError is raised after it
+        :param skip_dirs: list - directories to skip
+        :param on_error: Callable - called in event loop thread with error message
+        :param on_warning: Callable - called in event loop thread with warning message
+        :return: AsyncIterator[PhotoMatch] - found photos with their header data
+    """
+    if max_open_files < 1:
+        raise Exception('max_open_files can not be less than 1')
+    # asyncio is imported by the first call, so package and CLI do not pay for it
+    import asyncio
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    messages = []
+    walker = DirectoryWalker(find_dir, recursive=recursive, skip_dirs=skip_dirs,
+                             on_error=lambda message: messages.append((on_error, message)),
+                             on_warning=lambda message: messages.append((on_warning, message)))
+    batches = walker.iter_batches()
+    # generator must not run in two threads at once, so walk has its own single thread
+    walk_executor = ThreadPoolExecutor(max_workers=1)
+    open_executor = ThreadPoolExecutor(max_workers=max_open_files)
+    pending = set()
+    walk_future = None
+    walk_done = False
+    try:
+        while True:
+            if not walk_done and walk_future is None and len(pending) < 2 * max_open_files:
+                walk_future = loop.run_in_executor(walk_executor, next, batches, None)
+            waiting = pending | {walk_future} if walk_future is not None else pending
+            if not waiting:
+                return
+            remaining = deadline - loop.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait(waiting, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+
+            for future in done:
+                if future is walk_future:
+                    walk_future = None
+                    batch = future.result()
+                    while messages:
+                        callback, message = messages.pop(0)
+                        if callback is not None:
+                            callback(message)
+                    if batch is None:
+                        walk_done = True
+                        continue
+                    for item in batch.files:
+                        pending.add(loop.run_in_executor(open_executor, _check_file, item.path, item.rel_dir,
+                                                         photo_requirements, verify_decode))
+                    continue
+
+                pending.discard(future)
+                match = future.result()
+                if isinstance(match, str):
+                    logger.error(match)
+                    if on_error is not None:
+                        on_error(match)
+                elif match is not None:
+                    yield match
+    finally:
+        for future in pending:
+            future.cancel()
+        # closing generator stops walk threads, it runs after current next() in the same thread
+        walk_executor.submit(batches.close)
+        walk_executor.shutdown(wait=False)
+        open_executor.shutdown(wait=False, cancel_futures=True)
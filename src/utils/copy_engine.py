@@ -0,0 +1,259 @@
+import errno
+import os
+import pathlib
+import sys
+import time
+from threading import Lock
+
+from .dedup import PARTIAL_HASH_SIZE
+from .defaults import COPY_MODES
+from .metrics import metrics
+
+import logging
+logger = logging.getLogger()
+
+
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'buffer')
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+# temporary files of unfinished copies, they are left in copy_dir only if process is killed
+TMP_FILE_PREFIX = '.photo-finder-copy-'
+# ioctl FICLONE from linux/fs.h - share source extents with destination on CoW filesystems (btrfs, xfs)
+_FICLONE = 0x40049409
+# errors which mean that method is not supported for this pair of files, so next method is tried
+_UNSUPPORTED_ERRORS = frozenset(filter(None, (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY, errno.EBADF,
+                                              getattr(errno, 'EOPNOTSUPP', None), getattr(errno, 'ENOTSUP', None),
+                                              errno.EPERM)))
+
+
+def _same_head_and_tail(first: pathlib.Path, second: pathlib.Path, size: int) -> bool:
+    # the first and the last PARTIAL_HASH_SIZE bytes are compared, whole files if they are small
+    with open(first, 'rb') as first_file, open(second, 'rb') as second_file:
+        if first_file.read(PARTIAL_HASH_SIZE) != second_file.read(PARTIAL_HASH_SIZE):
+            return False
+        if size > 2 * PARTIAL_HASH_SIZE:
+            first_file.seek(size - PARTIAL_HASH_SIZE)
+            second_file.seek(size - PARTIAL_HASH_SIZE)
+        return first_file.read(PARTIAL_HASH_SIZE) == second_file.read(PARTIAL_HASH_SIZE)
+
+
+class CopyStats:
+    __slots__ = ['files', 'bytes', 'methods', '_started', '_finished']
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.methods = {}
+        self._started = None
+        self._finished = None
+
+    def add(self, size: int, method: str, started: float, finished: float) -> None:
+        self.files += 1
+        self.bytes += size
+        self.methods[method] = self.methods.get(method, 0) + 1
+        self._started = started if self._started is None else min(self._started, started)
+        self._finished = finished if self._finished is None else max(self._finished, finished)
+
+    @property
+    def seconds(self) -> float:
+        return self._finished - self._started if self._started is not None else 0.0
+
+    def repr_short(self, title: str = 'Copy') -> str:
+        seconds = self.seconds
+        mb_per_second = self.bytes / 1e6 / seconds if seconds else 0.0
+        files_per_second = self.files / seconds if seconds else 0.0
+        methods = ', '.join(f'{name}={count}' for name, count in self.methods.items())
+        # links do not move data, so only files per second are shown for them
+        throughput = f'{mb_per_second:.1f} MB/s, ' if self.bytes else ''
+        return (f'{title} throughput: {throughput}{files_per_second:.1f} files/sec '
+                f'({self.files} files, {self.bytes / 1e6:.1f} MB in {seconds:.2f} s{", " + methods if methods else ""})')
+
+
+class CopyEngine:
+    """
+        Copies files with the fastest method supported by source and destination filesystems:
+        reflink, copy_file_range, sendfile, then large buffer copy. A method which fails as unsupported is not tried
+        again for the same pair of devices. hardlink and symlink modes link files instead of copying.
+        Destination file is created exclusively, so existing file is never overwritten, and only when its data is
+        complete, so interrupted copy leaves no partial file
+    """
+    __slots__ = ['_mode', '_buffer_size', '_preserve_metadata', '_created_dirs', '_unsupported', '_lock', 'stats']
+
+    def __init__(self, mode: str = 'copy', buffer_size: int = DEFAULT_BUFFER_SIZE, preserve_metadata: bool = True):
+        """
+            :param mode: str - copy, hardlink or symlink
+            :param buffer_size: int - buffer size for buffer copy and chunk size for sendfile and copy_file_range
+            :param preserve_metadata: bool - copy mtime and permissions as shutil.copy2 does
+        """
+        if mode not in COPY_MODES:
+            raise Exception(f'Copy mode={mode} is unknown. Supported ones are {COPY_MODES}')
+        self._mode = mode
+        self._buffer_size = buffer_size
+        self._preserve_metadata = preserve_metadata
+        self._created_dirs = set()
+        self._unsupported = {}
+        self._lock = Lock()
+        self.stats = CopyStats()
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    def ensure_dir(self, directory: pathlib.Path) -> None:
+        """
+            Create directory with parents, every directory is created once per engine
+            :param directory: pathlib.Path - directory to create
+        """
+        if directory in self._created_dirs:
+            return
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._created_dirs.add(directory)
+
+    def target_name(self, path: pathlib.Path, number: int = 0) -> str:
+        """
+            :param path: pathlib.Path - file to copy
+            :param number: int - number of name, names with lower numbers are taken by other files
+            :return: str - name of destination file, name_N.ext for number N
+        """
+        return path.name if not number else f'{path.stem}_{number}{path.suffix}'
+
+    def copy(self, src: pathlib.Path, dst: pathlib.Path) -> str:
+        """
+            :param src: pathlib.Path - file to copy
+            :param dst: pathlib.Path - destination file, FileExistsError is raised if it exists
+            :return: str - used method
+        """
+        started = time.perf_counter()
+        if self._mode == 'hardlink':
+            os.link(src, dst)
+            method, size = 'hardlink', 0
+        elif self._mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            method, size = 'symlink', 0
+        else:
+            method, size = self._copy_data(src, dst)
+        finished = time.perf_counter()
+        with self._lock:
+            self.stats.add(size, method, started, finished)
+        metrics.observe('copy', finished - started)
+        return method
+
+    def is_copy_of(self, src: pathlib.Path, dst: pathlib.Path) -> bool:
+        """
+            :param src: pathlib.Path - copied file
+            :param dst: pathlib.Path - existing destination file
+            :return: bool - dst was made from src by this mode: the same link or copy with the same size, mtime and
+                the first and the last bytes, so other photo of the same size is not taken for its copy
+        """
+        try:
+            if self._mode == 'symlink':
+                return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+            if self._mode == 'hardlink':
+                return os.path.samefile(src, dst)
+            src_stat, dst_stat = os.stat(src), os.stat(dst, follow_symlinks=False)
+            if src_stat.st_size != dst_stat.st_size or \
+                    (self._preserve_metadata and src_stat.st_mtime_ns != dst_stat.st_mtime_ns):
+                return False
+            return _same_head_and_tail(src, dst, src_stat.st_size)
+        except OSError:
+            return False
+
+    def _copy_data(self, src: pathlib.Path, dst: pathlib.Path) -> tuple:
+        # data and metadata are written to temporary file in the same directory which gets name of dst only
+        # when it is complete, so interrupted copy never leaves partial file with name of photo
+        tmp = dst.with_name(f'{TMP_FILE_PREFIX}{os.urandom(8).hex()}.tmp')
+        with open(src, 'rb') as src_file:
+            src_stat = os.fstat(src_file.fileno())
+            tmp_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, src_stat.st_mode & 0o777)
+            try:
+                method = self._copy_fd(src_file.fileno(), tmp_fd, src_stat, os.fstat(tmp_fd).st_dev)
+            except BaseException:
+                os.close(tmp_fd)
+                os.unlink(tmp)
+                raise
+            os.close(tmp_fd)
+        try:
+            if self._preserve_metadata:
+                # shutil imports compression modules, so it is imported only by copy
+                import shutil
+                shutil.copystat(src, tmp)
+            self._publish(tmp, dst)
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        return method, src_stat.st_size
+
+    def _copy_fd(self, src_fd: int, dst_fd: int, src_stat: os.stat_result, dst_dev: int) -> str:
+        devices = (src_stat.st_dev, dst_dev)
+        unsupported = self._unsupported.get(devices, ())
+        for method in COPY_METHODS:
+            if method in unsupported:
+                continue
+            try:
+                getattr(self, f'_copy_{method}')(src_fd, dst_fd, src_stat.st_size)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRORS or method == 'buffer' or os.lseek(dst_fd, 0, 1):
+                    raise
+                with self._lock:
+                    self._unsupported[devices] = (*self._unsupported.get(devices, ()), method)
+                logger.info(f'Copy method {method} is not supported for devices {devices}: {repr(e)}')
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                continue
+            return method
+        raise OSError(errno.ENOTSUP, 'No copy method is supported')
+
+    @staticmethod
+    def _publish(tmp: pathlib.Path, dst: pathlib.Path) -> None:
+        # link fails if dst exists, so complete file gets its name exclusively, FileExistsError is raised as it is
+        try:
+            os.link(tmp, dst)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRORS:
+                raise
+            # filesystem without hard links: name is reserved exclusively and replaced by complete file
+            os.close(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            os.replace(tmp, dst)
+
+    @staticmethod
+    def _copy_reflink(src_fd: int, dst_fd: int, size: int) -> None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOTSUP, 'reflink is supported only on Linux')
+        import fcntl
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        os.lseek(dst_fd, size, os.SEEK_SET)
+
+    def _copy_copy_file_range(self, src_fd: int, dst_fd: int, size: int) -> None:
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+        copied = 0
+        while copied < size:
+            sent = os.copy_file_range(src_fd, dst_fd, min(self._buffer_size, size - copied))
+            if not sent:
+                break
+            copied += sent
+
+    def _copy_sendfile(self, src_fd: int, dst_fd: int, size: int) -> None:
+        if not hasattr(os, 'sendfile'):
+            raise OSError(errno.ENOSYS, 'sendfile is not available')
+        copied = 0
+        while copied < size:
+            sent = os.sendfile(dst_fd, src_fd, copied, min(self._buffer_size, size - copied))
+            if not sent:
+                break
+            copied += sent
+
+    def _copy_buffer(self, src_fd: int, dst_fd: int, size: int) -> None:
+        buffer = bytearray(min(self._buffer_size, max(size, 1)))
+        view = memoryview(buffer)
+        while True:
+            read = os.readv(src_fd, [buffer])
+            if not read:
+                break
+            written = 0
+            while written < read:
+                written += os.write(dst_fd, view[written:read])
+
+    def repr_stats(self) -> str:
+        return self.stats.repr_short()
@@ -0,0 +1,144 @@
+import json
+import os
+import pathlib
+import time
+from threading import Lock
+from typing import Union
+
+from .defaults import JOURNAL_FILE_NAME
+from .sharding import Shard
+import logging
+logger = logging.getLogger()
+
+
+JOURNAL_STATUSES = ('copied', 'not_copied', 'not_matched', 'failed')
+# records are flushed in groups, a lost tail after crash only makes these files to be checked again
+_FLUSH_EVERY = 256
+
+
+def default_journal_path(copy_dir: pathlib.Path) -> pathlib.Path:
+    """
+        :param copy_dir: pathlib.Path - directory to copy photos
+        :return: pathlib.Path - journal file in copy_dir, copy_dir is never walked, so journal is not found as photo
+    """
+    return pathlib.Path(copy_dir).joinpath(JOURNAL_FILE_NAME)
+
+
+class CopyJournal:
+    """
+        Append-only checkpoint of copy job. Every checked file gets a record with its final status,
+        so resumed job skips finished files without opening them. The last record of a file wins
+    """
+    __slots__ = ['_path', '_job', '_retry_failed', '_statuses', '_file', '_lock', '_unflushed', 'resumed']
+
+    def __init__(self, path: pathlib.Path, find_dir: Union[pathlib.Path, list], copy_dir: pathlib.Path,
+                 recursive: bool = False, resume: bool = False, retry_failed: bool = False, shard: Shard = None,
+                 options: dict = None):
+        """
+            :param path: pathlib.Path - journal file, every shard of job needs its own one
+            :param find_dir: pathlib.Path or list - directory or directories to find photos
+            :param copy_dir: pathlib.Path - directory to copy photos
+            :param recursive: bool - go to inner directories or not
+            :param resume: bool - skip files finished by previous run of the same job, new journal is started otherwise
+            :param retry_failed: bool - resume, but check and copy failed files again
+            :param shard: Shard - shard of job, journal can be resumed only by the same shard
+            :param options: dict - JSON compatible options which decide what files match and how they are copied,
+                e.g. photo requirements and export settings, journal can be resumed only with the same options
+        """
+        self._path = pathlib.Path(path)
+        find_dirs = [os.path.abspath(one_dir) for one_dir in (find_dir if isinstance(find_dir, (list, tuple))
+                                                               else [find_dir])]
+        # one directory is kept as string, so journals of single directory jobs stay resumable
+        self._job = {'status': 'job', 'find_dir': find_dirs[0] if len(find_dirs) == 1 else find_dirs,
+                     'copy_dir': os.path.abspath(copy_dir), 'recursive': recursive,
+                     'shard': str(shard) if shard is not None else None, 'options': options}
+        # job is compared with the first line of journal, so it is taken in the same form as it is read back
+        self._job = json.loads(json.dumps(self._job, ensure_ascii=False))
+        self._retry_failed = retry_failed
+        self._statuses = {}
+        self._lock = Lock()
+        self._unflushed = 0
+        self.resumed = 0
+        resume = resume or retry_failed
+        if resume and self._path.exists():
+            self._load()
+            self._file = open(self._path, 'a', encoding='utf-8')
+        else:
+            self._file = open(self._path, 'w', encoding='utf-8')
+            self._write_line(self._job)
+            self._file.flush()
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for status in self._statuses.values() if status == 'failed')
+
+    def _load(self) -> None:
+        with open(self._path, 'r', encoding='utf-8') as file:
+            for line_number, line in enumerate(file):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be torn by interruption
+                    logger.warning(f'Journal {self._path} line {line_number + 1} is broken and skipped')
+                    continue
+                if line_number == 0:
+                    job = {name: record.get(name) for name in self._job}
+                    if job != self._job:
+                        differences = ', '.join(name for name in self._job if job[name] != self._job[name])
+                        raise Exception(f'Journal {self._path} was written for another job with different '
+                                        f'{differences}: {job}, it can not be resumed for {self._job}')
+                    continue
+                if record.get('status') in JOURNAL_STATUSES and record.get('path'):
+                    self._statuses[record['path']] = record['status']
+
+    def is_finished(self, path: Union[pathlib.Path, str]) -> bool:
+        """
+            :param path: pathlib.Path - file to check
+            :return: bool - file was finished by previous run and must be skipped
+        """
+        status = self._statuses.get(os.path.abspath(path))
+        if status is None or (status == 'failed' and self._retry_failed):
+            return False
+        self.resumed += 1
+        return True
+
+    def record(self, status: str, path: Union[pathlib.Path, str], target: Union[pathlib.Path, str] = None,
+               message: str = None) -> None:
+        """
+            :param status: str - copied, not_copied, not_matched or failed
+            :param path: pathlib.Path - checked file
+            :param target: pathlib.Path - copied file
+            :param message: str - reason of not_copied or failed status
+        """
+        line = {'status': status, 'path': os.path.abspath(path), 'time': time.time()}
+        if target is not None:
+            line['target'] = str(target)
+        if message is not None:
+            line['message'] = message
+        with self._lock:
+            self._write_line(line)
+            self._unflushed += 1
+            if self._unflushed >= _FLUSH_EVERY:
+                self._file.flush()
+                self._unflushed = 0
+
+    def _write_line(self, line: dict) -> None:
+        self._file.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
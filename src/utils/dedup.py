@@ -0,0 +1,186 @@
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Union
+
+from .defaults import DEDUP_MODES
+from .metrics import metrics
+
+import logging
+logger = logging.getLogger()
+
+if TYPE_CHECKING:
+    from .photo_index import PhotoIndex
+
+
+PARTIAL_HASH_SIZE = 64 * 1024
+HASH_BUFFER_SIZE = 1024 * 1024
+_DIGEST_SIZE = 16
+
+
+def _new_hash():
+    # blake2b is the fastest cryptographic hash of hashlib and releases GIL for large updates,
+    # hashlib loads OpenSSL, so it is imported only when files are hashed
+    import hashlib
+    return hashlib.blake2b(digest_size=_DIGEST_SIZE)
+
+
+def partial_hash(path: pathlib.Path, size: int) -> bytes:
+    """
+        :param path: pathlib.Path - file to hash
+        :param size: int - file size
+        :return: bytes - hash of the first and the last PARTIAL_HASH_SIZE bytes, of whole file if it is small
+    """
+    file_hash = _new_hash()
+    with metrics.stage('hash_partial'), open(path, 'rb') as file:
+        file_hash.update(file.read(PARTIAL_HASH_SIZE))
+        if size > 2 * PARTIAL_HASH_SIZE:
+            file.seek(size - PARTIAL_HASH_SIZE)
+        file_hash.update(file.read(PARTIAL_HASH_SIZE))
+    return file_hash.digest()
+
+
+def full_hash(path: pathlib.Path) -> bytes:
+    """
+        :param path: pathlib.Path - file to hash
+        :return: bytes - hash of whole file, read in HASH_BUFFER_SIZE chunks to one reused buffer
+    """
+    file_hash = _new_hash()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with metrics.stage('hash_full'), open(path, 'rb', buffering=0) as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            file_hash.update(view[:read])
+    return file_hash.digest()
+
+
+class DuplicateFinder:
+    """
+        Collects found photos and groups identical ones: by size first, then by partial hash of head and tail,
+        then by full hash. Only files which share size (and partial hash) are read. Hashes are cached in PhotoIndex
+        by (device, inode, size, mtime), so unchanged files are not read again by later runs
+    """
+    __slots__ = ['_mode', '_cache', '_workers', '_candidates', '_lock', '_duplicate_of']
+
+    def __init__(self, mode: str = 'report', cache: 'PhotoIndex' = None, workers: int = None):
+        """
+            :param mode: str - report duplicate groups or copy only one photo of every group (unique)
+            :param cache: PhotoIndex - index to keep hashes between runs
+            :param workers: int - number of threads to read files for hashes
+        """
+        if mode not in DEDUP_MODES:
+            raise Exception(f'Dedup mode={mode} is unknown. Supported ones are {DEDUP_MODES}')
+        self._mode = mode
+        self._cache = cache
+        self._workers = workers
+        self._candidates = []
+        self._lock = Lock()
+        self._duplicate_of = {}
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    def add(self, path: pathlib.Path, copy_dir: Union[pathlib.Path, None] = None) -> None:
+        """
+            :param path: pathlib.Path - found photo
+            :param copy_dir: pathlib.Path - directory to copy photo after deduplication
+        """
+        with self._lock:
+            self._candidates.append((path, copy_dir))
+
+    @property
+    def candidates(self) -> list:
+        return self._candidates
+
+    def duplicate_of(self, path: pathlib.Path) -> Union[pathlib.Path, None]:
+        """
+            :param path: pathlib.Path - found photo
+            :return: pathlib.Path - kept photo with the same content or None if path is kept
+        """
+        return self._duplicate_of.get(path)
+
+    def find_duplicates(self, on_error: Callable[[str, pathlib.Path], None] = None) -> list:
+        """
+            Group collected photos by content, the first path of every group is kept
+            :param on_error: Callable - called with error message and path of file which can not be read
+            :return: list - groups of at least two paths with the same content
+        """
+        by_size = {}
+        for path, _ in self._candidates:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                if on_error is not None:
+                    on_error(f'Exception error on file "{str(path)}": {repr(e)}', path)
+                continue
+            # inode is unique only on its device, so files of several filesystems do not share cached hashes
+            by_size.setdefault(stat.st_size, []).append(
+                (path, (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)))
+        same_size = [group for group in by_size.values() if len(group) > 1]
+        if not same_size:
+            return []
+
+        files = [item for group in same_size for item in group]
+        cached = self._cache.get_hashes([key for _, key in files]) if self._cache is not None else {}
+        new_hashes = {}
+
+        def hashes_of(items: list, kind: int, compute: Callable) -> list:
+            # kind is 0 for partial and 1 for full hash in cache rows
+            hashed = []
+            to_compute = []
+            for path, key in items:
+                known = new_hashes.get(key, cached.get(key, (None, None)))[kind]
+                if known is not None:
+                    hashed.append((path, key, known))
+                else:
+                    to_compute.append((path, key))
+            for (path, key), value in zip(to_compute, executor.map(lambda item: self._hash(compute, item),
+                                                                   to_compute)):
+                if isinstance(value, Exception):
+                    if on_error is not None:
+                        on_error(f'Exception error on file "{str(path)}": {repr(value)}', path)
+                    continue
+                known = list(new_hashes.get(key, cached.get(key, (None, None))))
+                known[kind] = value
+                new_hashes[key] = tuple(known)
+                hashed.append((path, key, value))
+            return hashed
+
+        def regroup(groups: list, kind: int, compute: Callable) -> list:
+            items = [item for group in groups for item in group]
+            by_hash = {}
+            for path, key, value in hashes_of(items, kind, compute):
+                by_hash.setdefault((key[2], value), []).append((path, key))
+            return [group for group in by_hash.values() if len(group) > 1]
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            same_partial = regroup(same_size, 0, lambda path, size: partial_hash(path, size))
+            # files not bigger than partial hash window are hashed whole already
+            small = [group for group in same_partial if group[0][1][2] <= 2 * PARTIAL_HASH_SIZE]
+            big = [group for group in same_partial if group[0][1][2] > 2 * PARTIAL_HASH_SIZE]
+            same_full = small + regroup(big, 1, lambda path, size: full_hash(path))
+
+        if self._cache is not None and new_hashes:
+            self._cache.put_hashes([(*key, *values) for key, values in new_hashes.items()])
+
+        duplicates = []
+        for group in same_full:
+            paths = sorted((path for path, _ in group), key=str)
+            for path in paths[1:]:
+                self._duplicate_of[path] = paths[0]
+            duplicates.append(paths)
+        duplicates.sort(key=lambda paths: str(paths[0]))
+        return duplicates
+
+    @staticmethod
+    def _hash(compute: Callable, item: tuple) -> Union[bytes, Exception]:
+        path, key = item
+        try:
+            return compute(path, key[2])
+        except Exception as e:
+            return e
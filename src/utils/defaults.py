@@ -0,0 +1,36 @@
+import os
+import pathlib
+
+
+# choices and defaults of CLI options, they are here without imports of modules which use them,
+# so CLI options are defined and --help is shown without importing these modules
+
+PHOTO_FORMATS = ('BMP', 'DDS', 'DIB', 'EPS', 'GIF', 'ICNS', 'ICO', 'IM', 'JPEG', 'MSP', 'PCX', 'PNG', 'PPM', 'SGI',
+                 'SPIDER', 'TGA', 'TIFF', 'WEBP', 'XBM')
+# the same as PIL.Image.MODES, it is not taken from Pillow, so Pillow is not imported to parse CLI options
+PHOTO_MODES = ('1', 'CMYK', 'F', 'HSV', 'I', 'L', 'LAB', 'P', 'RGB', 'RGBA', 'RGBX', 'YCbCr')
+# the same as PIL.Image.MAX_IMAGE_PIXELS, Pillow warns about decompression bomb above it
+DEFAULT_MAX_PIXELS = 89478485
+DEFAULT_DECODE_MEMORY = 1024 * 1024 * 1024
+EXECUTION_BACKENDS = ('threads', 'processes', 'hybrid')
+DEFAULT_BATCH_SIZE = 64
+COPY_MODES = ('copy', 'hardlink', 'symlink')
+JOURNAL_FILE_NAME = '.photo-finder-journal.jsonl'
+DEDUP_MODES = ('report', 'unique')
+EXPORT_FORMATS = ('JPEG', 'WEBP', 'PNG')
+RESULT_SINK_FORMATS = ('jsonl', 'csv')
+METRICS_FORMATS = ('json', 'prometheus')
+PROFILERS = ('cprofile', 'sampling')
+PERCEPTUAL_HASHES = ('dhash', 'phash')
+# photos with more different bits of 64-bit perceptual hash are not similar, and search of pairs slows down with it
+MAX_PERCEPTUAL_DISTANCE = 16
+WATCH_BACKENDS = ('auto', 'inotify', 'polling')
+INDEX_FILE_NAME = 'index.sqlite'
+
+
+def default_index_path() -> pathlib.Path:
+    """
+        :return: pathlib.Path - index file in user cache directory ($XDG_CACHE_HOME or ~/.cache)
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home().joinpath('.cache')
+    return pathlib.Path(cache_dir).joinpath('photo-finder', INDEX_FILE_NAME)
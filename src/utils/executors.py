@@ -0,0 +1,90 @@
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Union
+
+from .defaults import DEFAULT_BATCH_SIZE, EXECUTION_BACKENDS
+from .governor import governor
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+@dataclass(frozen=True)
+class ExecutionSettings:
+    """
+        threads - every file is checked and copied in I/O threads (fast for header-only checks)
+        processes - files are checked in batches in CPU processes and copied in I/O threads
+        hybrid - I/O threads read headers and pass only images to decode in batches to CPU processes
+    """
+    backend: str = field(default='threads')
+    io_workers: Union[int, None] = field(default=None)
+    cpu_workers: Union[int, None] = field(default=None)
+    batch_size: int = field(default=DEFAULT_BATCH_SIZE)
+
+    def __post_init__(self):
+        if self.backend not in EXECUTION_BACKENDS:
+            raise Exception(f'Execution backend={self.backend} is unknown. Supported ones are {EXECUTION_BACKENDS}')
+        for name in ('io_workers', 'cpu_workers', 'batch_size'):
+            value = getattr(self, name)
+            if value is not None and value < 1:
+                raise Exception(f'{name} can not be less than 1')
+
+    @property
+    def uses_processes(self) -> bool:
+        return self.backend != 'threads'
+
+    @property
+    def max_cpu_workers(self) -> int:
+        return self.cpu_workers or os.cpu_count() or 1
+
+
+def create_cpu_executor(settings: ExecutionSettings) -> Union['ProcessPoolExecutor', nullcontext]:
+    """
+        :param settings: ExecutionSettings - execution backend and worker counts
+        :return: ProcessPoolExecutor - started process pool or nullcontext(None) for threads backend
+    """
+    if not settings.uses_processes:
+        return nullcontext(None)
+    # multiprocessing is imported only by processes and hybrid backends
+    from concurrent.futures import ProcessPoolExecutor
+    # CPU processes get decode limits and decode in the same memory budget as threads of main process
+    initializer, initargs = governor.share()
+    executor = ProcessPoolExecutor(max_workers=settings.max_cpu_workers, initializer=initializer, initargs=initargs)
+    # with fork start method all processes are started by first submit, do it before any walk or I/O thread starts
+    executor.submit(int).result()
+    return executor
+
+
+def iter_batches(items, batch_size: int):
+    """
+        :param items: Iterable - items to split
+        :param batch_size: int - maximum items in one batch
+        :return: Iterator[list] - lists of at most batch_size items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def max_pending_batches(settings: ExecutionSettings, max_pending: int) -> int:
+    """
+        :param settings: ExecutionSettings - execution backend and worker counts
+        :param max_pending: int - maximum number of files waiting for check
+        :return: int - maximum number of batches waiting for check, enough to keep every CPU worker busy
+    """
+    return max(2 * settings.max_cpu_workers, max_pending // settings.batch_size)
+
+
+def max_cpu_batches(settings: ExecutionSettings) -> int:
+    """
+        :param settings: ExecutionSettings - execution backend and worker counts
+        :return: int - maximum number of batches submitted to CPU processes at once, one running and one waiting
+            for every CPU worker
+    """
+    return 2 * settings.max_cpu_workers
@@ -0,0 +1,188 @@
+import datetime
+import struct
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Union
+
+from .photo_info import ExifInfo
+
+if TYPE_CHECKING:
+    from .sniffer import _HeaderReader
+
+
+_MAKE, _MODEL, _DATE_TIME, _EXIF_IFD, _GPS_IFD = 0x010F, 0x0110, 0x0132, 0x8769, 0x8825
+_DATE_TIME_ORIGINAL = 0x9003
+_GPS_LATITUDE_REF, _GPS_LATITUDE, _GPS_LONGITUDE_REF, _GPS_LONGITUDE = 1, 2, 3, 4
+# TIFF value type => struct format and size, only types of needed tags
+_EXIF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 7: ('s', 1)}
+# IFD with hundreds of entries is broken, it is not read
+_MAX_ENTRIES = 1024
+# make, model and dates are short strings, coordinates are 3 rationals, longer value is broken and it is not read
+_MAX_VALUE_SIZE = 256
+
+
+def _read_ifd(reader: '_HeaderReader', base: int, offset: int, order: str, tags: frozenset) -> dict:
+    # only entries of requested tags are decoded, values beyond the entry are read by offset,
+    # reader bounds them by file size and count of value is not trusted above _MAX_VALUE_SIZE
+    count_data = reader.read(base + offset, 2)
+    if len(count_data) < 2:
+        return {}
+    count = struct.unpack(f'{order}H', count_data)[0]
+    if count > _MAX_ENTRIES:
+        return {}
+    entries = reader.read(base + offset + 2, count * 12)
+    values = {}
+    for index in range(len(entries) // 12):
+        tag, value_type, value_count = struct.unpack(f'{order}HHI', entries[index * 12:index * 12 + 8])
+        if tag not in tags or value_type not in _EXIF_TYPES:
+            continue
+        value_format, value_size = _EXIF_TYPES[value_type]
+        size = value_size * value_count
+        if size > _MAX_VALUE_SIZE:
+            continue
+        value_data = entries[index * 12 + 8:index * 12 + 12]
+        if size > 4:
+            value_data = reader.read(base + struct.unpack(f'{order}I', value_data)[0], size)
+        if len(value_data) < size:
+            continue
+        if value_format == 's':
+            values[tag] = value_data[:size].split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+        else:
+            values[tag] = struct.unpack(f'{order}{value_format * value_count}', value_data[:size])
+    return values
+
+
+def _parse_date_time(value: Union[str, None]) -> Union[float, None]:
+    # EXIF time has no time zone, it is taken as local time like mtime
+    try:
+        return datetime.datetime.strptime(value, '%Y:%m:%d %H:%M:%S').timestamp() if value else None
+    except ValueError:
+        return None
+
+
+def _parse_coordinate(value: Union[tuple, None], reference: Union[str, None]) -> Union[float, None]:
+    if not value or len(value) < 6 or not all(value[1::2]):
+        return None
+    degrees, minutes, seconds = (value[index] / value[index + 1] for index in range(0, 6, 2))
+    coordinate = degrees + minutes / 60 + seconds / 3600
+    return -coordinate if reference in ('S', 'W') else coordinate
+
+
+def _parse_tiff_exif(reader: '_HeaderReader', base: int) -> Union[ExifInfo, None]:
+    byte_order = reader.read(base, 8)
+    if len(byte_order) < 8 or byte_order[:2] not in (b'II', b'MM'):
+        return None
+    order = '<' if byte_order[:2] == b'II' else '>'
+    ifd0 = _read_ifd(reader, base, struct.unpack(f'{order}I', byte_order[4:8])[0], order,
+                     frozenset((_MAKE, _MODEL, _DATE_TIME, _EXIF_IFD, _GPS_IFD)))
+    taken = None
+    if _EXIF_IFD in ifd0:
+        taken = _read_ifd(reader, base, ifd0[_EXIF_IFD][0], order,
+                          frozenset((_DATE_TIME_ORIGINAL,))).get(_DATE_TIME_ORIGINAL)
+    latitude = longitude = None
+    if _GPS_IFD in ifd0:
+        gps = _read_ifd(reader, base, ifd0[_GPS_IFD][0], order, frozenset(
+            (_GPS_LATITUDE_REF, _GPS_LATITUDE, _GPS_LONGITUDE_REF, _GPS_LONGITUDE)))
+        latitude = _parse_coordinate(gps.get(_GPS_LATITUDE), gps.get(_GPS_LATITUDE_REF))
+        longitude = _parse_coordinate(gps.get(_GPS_LONGITUDE), gps.get(_GPS_LONGITUDE_REF))
+    return ExifInfo(taken=_parse_date_time(taken or ifd0.get(_DATE_TIME)), make=ifd0.get(_MAKE) or None,
+                    model=ifd0.get(_MODEL) or None, latitude=latitude, longitude=longitude)
+
+
+def _find_jpeg_exif(reader: '_HeaderReader') -> Union[int, None]:
+    offset = 2
+    while True:
+        marker = reader.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] in (0xD9, 0xDA):
+            return None
+        length = struct.unpack('>H', marker[2:4])[0]
+        if marker[1] == 0xE1 and reader.read(offset + 4, 6) == b'Exif\x00\x00':
+            return offset + 10
+        offset += 2 + length
+
+
+def _find_png_exif(reader: '_HeaderReader') -> Union[int, None]:
+    offset = 8
+    while True:
+        chunk = reader.read(offset, 8)
+        if len(chunk) < 8 or chunk[4:8] in (b'IDAT', b'IEND'):
+            return None
+        if chunk[4:8] == b'eXIf':
+            return offset + 8
+        offset += 12 + struct.unpack('>I', chunk[:4])[0]
+
+
+def read_exif_fields(reader: '_HeaderReader') -> Union[ExifInfo, None]:
+    """
+        Read date taken, camera make and model and GPS position from EXIF of JPEG, TIFF and PNG.
+        Only entries of these tags are decoded, image data is not read
+        :param reader: _HeaderReader - header buffer and opened file to read data beyond header if needed
+        :return: ExifInfo - EXIF fields or None if there is no EXIF
+    """
+    header = reader.header
+    try:
+        if header[:3] == b'\xff\xd8\xff':
+            base = _find_jpeg_exif(reader)
+        elif header[:8] == b'\x89PNG\r\n\x1a\n':
+            base = _find_png_exif(reader)
+        elif header[:4] in (b'II*\x00', b'MM\x00*'):
+            base = 0
+        else:
+            base = None
+        return _parse_tiff_exif(reader, base) if base is not None else None
+    except struct.error:
+        return None
+
+
+@dataclass(frozen=True)
+class ExifRequirements:
+    """
+        Photo matches if every set requirement matches, photo without needed EXIF field does not match
+    """
+    taken_from: Union[float, None] = field(default=None)
+    taken_to: Union[float, None] = field(default=None)
+    cameras: tuple = field(default=())
+    gps_bbox: Union[tuple, None] = field(default=None)
+
+    def __post_init__(self):
+        if self.gps_bbox is not None:
+            if len(self.gps_bbox) != 4:
+                raise Exception('gps_bbox should be (south, west, north, east)')
+            south, west, north, east = self.gps_bbox
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+                raise Exception(f'gps_bbox {self.gps_bbox} is incorrect: latitude should be from -90 to 90 '
+                                f'with south <= north, longitude from -180 to 180')
+        # cameras are compared in lower case
+        object.__setattr__(self, 'cameras', tuple(camera.lower() for camera in self.cameras))
+
+    def __bool__(self) -> bool:
+        return (self.taken_from is not None or self.taken_to is not None or bool(self.cameras)
+                or self.gps_bbox is not None)
+
+    def check(self, exif: Union[ExifInfo, None]) -> bool:
+        """
+            :param exif: ExifInfo - EXIF fields of photo
+            :return: bool - photo matches
+        """
+        if exif is None:
+            return False
+        if self.taken_from is not None or self.taken_to is not None:
+            if exif.taken is None or (self.taken_from is not None and exif.taken < self.taken_from) or \
+                    (self.taken_to is not None and exif.taken > self.taken_to):
+                return False
+        if self.cameras:
+            # camera is found in make and model, e.g. "iphone 12" matches make Apple and model iPhone 12 Pro
+            camera = f'{exif.make or ""} {exif.model or ""}'.lower()
+            if not any(required in camera for required in self.cameras):
+                return False
+        if self.gps_bbox is not None:
+            if exif.latitude is None or exif.longitude is None:
+                return False
+            south, west, north, east = self.gps_bbox
+            if not south <= exif.latitude <= north:
+                return False
+            # box crossing 180th meridian has west > east
+            if west <= east and not west <= exif.longitude <= east:
+                return False
+            if west > east and not (exif.longitude >= west or exif.longitude <= east):
+                return False
+        return True
@@ -0,0 +1,321 @@
+import errno
+import json
+import math
+import os
+import pathlib
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Union
+
+from .copy_engine import TMP_FILE_PREFIX, CopyEngine
+from .defaults import EXPORT_FORMATS
+from .executors import ExecutionSettings, create_cpu_executor
+from .governor import MODE_BYTES, DeadlineReader, MemoryBudget, governor
+from .metrics import metrics
+from .photo_info import PhotoInfo
+from .sniffer import sniff_image
+import logging
+logger = logging.getLogger()
+
+
+EXPORT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+EXPORT_CACHE_FILE_NAME = '.photo-finder-exports.jsonl'
+DEFAULT_QUALITY = 85
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+# image is reduced by integer factor (JPEG by DCT scaling on load) while it stays this times larger than target,
+# then it is resampled, so quality is the same as resampling of full size image
+REDUCING_GAP = 2.0
+# EXIF orientation => Image.Transpose value, the same as PIL.ImageOps.exif_transpose
+_ORIENTATION_TRANSPOSE = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+_JPEG_DRAFT_SCALES = (2, 4, 8)
+
+
+def default_export_cache_path(copy_dir: pathlib.Path) -> pathlib.Path:
+    """
+        :param copy_dir: pathlib.Path - directory to export photos
+        :return: pathlib.Path - export cache file in copy_dir
+    """
+    return pathlib.Path(copy_dir).joinpath(EXPORT_CACHE_FILE_NAME)
+
+
+@dataclass(frozen=True)
+class ExportSettings:
+    """
+        Target of export: format, encoder quality and box the photo is fitted in, 0 means no limit of the side.
+        Photo is never enlarged
+    """
+    format: str = field(default='JPEG')
+    quality: int = field(default=DEFAULT_QUALITY)
+    max_width: int = field(default=0)
+    max_height: int = field(default=0)
+
+    def __post_init__(self):
+        photo_format = self.format.upper()
+        if photo_format not in EXPORT_FORMATS:
+            raise Exception(f'Export format={self.format} is unknown. Supported ones are {EXPORT_FORMATS}')
+        object.__setattr__(self, 'format', photo_format)
+        if not 1 <= self.quality <= 100:
+            raise Exception('Export quality must be from 1 to 100')
+        if self.max_width < 0 or self.max_height < 0:
+            raise Exception('Export size can not be negative')
+
+    @property
+    def extension(self) -> str:
+        return EXPORT_EXTENSIONS[self.format]
+
+    @property
+    def key(self) -> str:
+        return f'{self.format}:{self.quality}:{self.max_width}x{self.max_height}'
+
+    def target_size(self, width: int, height: int) -> tuple:
+        """
+            :param width: int - photo width
+            :param height: int - photo height
+            :return: tuple - (width, height) of photo fitted in box with the same aspect ratio
+        """
+        scale = min(self.max_width / width if self.max_width else 1.0,
+                    self.max_height / height if self.max_height else 1.0, 1.0)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_export_memory(info: PhotoInfo, settings: ExportSettings) -> int:
+    """
+        Memory of decoded and resized photo estimated from header, JPEG is decoded at reduced scale
+        :param info: PhotoInfo - image header data
+        :param settings: ExportSettings - export target
+        :return: int - bytes
+    """
+    target_width, target_height = settings.target_size(info.width, info.height)
+    width, height = info.width, info.height
+    if info.format == 'JPEG':
+        for scale in _JPEG_DRAFT_SCALES:
+            if (info.width / scale < target_width * REDUCING_GAP
+                    or info.height / scale < target_height * REDUCING_GAP):
+                break
+            width, height = math.ceil(info.width / scale), math.ceil(info.height / scale)
+    return width * height * MODE_BYTES.get(info.mode, 4) + target_width * target_height * 4
+
+
+def export_image(src: pathlib.Path, dst: pathlib.Path, settings: ExportSettings) -> int:
+    """
+        Decode photo at reduced scale, fit it in box of settings and encode it, runs in CPU process.
+        JPEG is decoded with DCT scaling, so full size pixels are never made, other formats are reduced by integer
+        factor before resampling. EXIF orientation is applied, ICC profile is kept.
+        Image over limits of governor is not exported, decode which takes longer than its timeout fails
+        :param src: pathlib.Path - photo to export
+        :param dst: pathlib.Path - exported file, FileExistsError is raised if it exists. It gets its name only
+            when it is complete, so interrupted export never leaves partial or empty file with name of photo
+        :param settings: ExportSettings - export target
+        :return: int - size of exported file
+    """
+    from PIL import Image
+    with open(src, 'rb') as file:
+        source = DeadlineReader(file)
+        with Image.open(source) as img:
+            info = PhotoInfo(format=img.format, mode=img.mode, width=img.width, height=img.height)
+            reason = governor.refuse_reason(info, os.fstat(file.fileno()).st_size,
+                                            estimate_export_memory(info, settings))
+            if reason is not None:
+                raise Exception(f'File is not exported because {reason}')
+            # decoders read file by chunks, so reader stops decode after timeout, getexif of PNG decodes it too
+            source.start(governor.limits.timeout)
+            orientation = img.getexif().get(0x0112, 1)
+            transpose = _ORIENTATION_TRANSPOSE.get(orientation)
+            # box is given for photo as it is shown, stored photo is rotated by 90 degrees for orientations 5-8
+            box_settings = settings if orientation < 5 else ExportSettings(
+                format=settings.format, quality=settings.quality, max_width=settings.max_height,
+                max_height=settings.max_width)
+            size = box_settings.target_size(img.width, img.height)
+            icc_profile = img.info.get('icc_profile')
+            img.draft(None, (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+            image = img.resize(size, Image.LANCZOS, reducing_gap=REDUCING_GAP) if img.size != size else img.copy()
+    if transpose is not None:
+        image = image.transpose(transpose)
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if settings.format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        if has_alpha:
+            # JPEG has no alpha, transparent pixels become white
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, 'white')
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            image = image.convert('RGB')
+    elif settings.format == 'PNG' and image.mode in ('CMYK', 'YCbCr', 'LAB', 'HSV', 'F'):
+        image = image.convert('RGB')
+    options = {'quality': settings.quality} if settings.format != 'PNG' else {}
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    tmp = dst.with_name(f'{TMP_FILE_PREFIX}{os.urandom(8).hex()}.tmp')
+    try:
+        image.save(tmp, format=settings.format, **options)
+        CopyEngine._publish(tmp, dst)
+    finally:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+    return os.stat(dst).st_size
+
+
+class ExportCache:
+    """
+        Append-only record of exported files keyed on source identity (device, inode, size and mtime) and
+        export settings, so rerun finds finished exports without decoding photos again. The last record of key wins
+    """
+    __slots__ = ['_path', '_entries', '_file', '_lock']
+
+    def __init__(self, path: pathlib.Path):
+        """
+            :param path: pathlib.Path - cache file, it is created if it does not exist
+        """
+        self._path = pathlib.Path(path)
+        self._entries = {}
+        self._lock = Lock()
+        if self._path.exists():
+            self._load()
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def _load(self) -> None:
+        with open(self._path, 'r', encoding='utf-8') as file:
+            for line_number, line in enumerate(file):
+                try:
+                    record = json.loads(line)
+                    self._entries[record['key']] = (record['target'], record['size'])
+                except (ValueError, KeyError, TypeError):
+                    # the last line may be torn by interruption
+                    logger.warning(f'Export cache {self._path} line {line_number + 1} is broken and skipped')
+
+    @staticmethod
+    def key(path: pathlib.Path, settings: ExportSettings) -> str:
+        """
+            :param path: pathlib.Path - photo to export
+            :param settings: ExportSettings - export target
+            :return: str - source identity and export settings
+        """
+        stat = os.stat(path)
+        return f'{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}:{settings.key}'
+
+    def is_exported(self, key: str, target: pathlib.Path) -> bool:
+        """
+            :param key: str - key of photo and settings
+            :param target: pathlib.Path - existing file
+            :return: bool - target was exported for this key and was not changed after
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != os.path.abspath(target):
+            return False
+        try:
+            return os.stat(target).st_size == entry[1]
+        except OSError:
+            return False
+
+    def record(self, key: str, target: pathlib.Path, size: int) -> None:
+        """
+            Record is flushed at once: exported file without record would be exported again with other name
+            :param key: str - key of photo and settings
+            :param target: pathlib.Path - exported file
+            :param size: int - size of exported file
+        """
+        line = {'key': key, 'target': os.path.abspath(target), 'size': size, 'time': time.time()}
+        with self._lock:
+            self._entries[key] = (line['target'], size)
+            self._file.write(json.dumps(line, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class ExportEngine(CopyEngine):
+    """
+        Exports found photos instead of copying them: photo is resized and encoded to target format in CPU processes.
+        I/O thread waits for its photo, so number of I/O threads and memory budget limit photos decoded at once.
+        Exported file gets its name exclusively like copy when it is complete, exported files are recorded in cache,
+        so rerun skips them
+    """
+    __slots__ = ['_settings', '_workers', '_memory', '_cache', '_executor']
+
+    def __init__(self, settings: ExportSettings, cache_path: pathlib.Path, workers: int = None,
+                 memory_limit: int = DEFAULT_MEMORY_LIMIT):
+        """
+            :param settings: ExportSettings - export target
+            :param cache_path: pathlib.Path - export cache file, default_export_cache_path(copy_dir) usually
+            :param workers: int - number of CPU processes, number of CPUs by default
+            :param memory_limit: int - bytes of decoded photos in all CPU processes at once
+        """
+        super().__init__(mode='copy', preserve_metadata=False)
+        self._settings = settings
+        self._workers = workers
+        self._memory = MemoryBudget(memory_limit)
+        self._cache = ExportCache(cache_path)
+        self._executor = None
+
+    @property
+    def settings(self) -> ExportSettings:
+        return self._settings
+
+    def __enter__(self):
+        # processes are started before walk and I/O threads, see create_cpu_executor
+        self._executor = create_cpu_executor(ExecutionSettings(backend='processes', cpu_workers=self._workers))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._cache.close()
+
+    def target_name(self, path: pathlib.Path, number: int = 0) -> str:
+        return f'{path.stem}{f"_{number}" if number else ""}{self._settings.extension}'
+
+    def copy(self, src: pathlib.Path, dst: pathlib.Path) -> str:
+        """
+            :param src: pathlib.Path - photo to export
+            :param dst: pathlib.Path - exported file, FileExistsError is raised if it exists
+            :return: str - export
+        """
+        if self._executor is None:
+            raise Exception('ExportEngine must be entered with "with" statement before export')
+        started = time.perf_counter()
+        key = self._cache.key(src, self._settings)
+        # taken name is found before decode, export_image takes the name exclusively when file is complete
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, 'File exists', str(dst))
+        info = sniff_image(src)
+        if info is None:
+            raise Exception('File is not image')
+        reserved = estimate_export_memory(info, self._settings)
+        # export needs pixels, so image over decode limits is not exported
+        reason = governor.refuse_reason(info, os.stat(src).st_size, reserved)
+        if reason is not None:
+            raise Exception(f'File is not exported because {reason}')
+        self._memory.acquire(reserved)
+        try:
+            size = self._executor.submit(export_image, src, dst, self._settings).result()
+        finally:
+            self._memory.release(reserved)
+        self._cache.record(key, dst, size)
+        finished = time.perf_counter()
+        with self._lock:
+            self.stats.add(size, 'export', started, finished)
+        metrics.observe('export', finished - started)
+        return 'export'
+
+    def is_copy_of(self, src: pathlib.Path, dst: pathlib.Path) -> bool:
+        try:
+            return self._cache.is_exported(self._cache.key(src, self._settings), dst)
+        except OSError:
+            return False
+
+    def repr_stats(self) -> str:
+        return self.stats.repr_short('Export')
@@ -0,0 +1,301 @@
+import datetime
+import fnmatch
+import operator
+import os
+import pathlib
+import re
+from typing import Callable, Union
+
+from .photo_info import PhotoInfo
+
+
+# stages in order of cost: path is known from walk, stat needs stat call, header needs file read
+PATH_STAGE, STAT_STAGE, HEADER_STAGE = 0, 1, 2
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3,
+               'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3}
+_COMPARISONS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne,
+                '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+_TOKEN = re.compile(r'\s*(?:(?P<string>"[^"]*"|\'[^\']*\')|(?P<symbol>[(),]|<=|>=|==|!=|=|<|>)'
+                    r'|(?P<word>[^\s(),<>=!"\']+))')
+
+
+def _parse_number(value: str) -> float:
+    return float(value)
+
+
+def _parse_int(value: str) -> int:
+    return int(value)
+
+
+def _parse_size(value: str) -> int:
+    match = re.fullmatch(r'([0-9]+(?:\.[0-9]+)?)\s*([A-Za-z]*)', value)
+    if not match or match.group(2).upper() not in _SIZE_UNITS:
+        raise ValueError(f'size "{value}" should be number with optional unit {tuple(_SIZE_UNITS)[2:]}')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def _parse_time(value: str) -> float:
+    # local time, date or date with time in ISO format
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _parse_aspect(value: str) -> float:
+    if ':' in value:
+        width, height = value.split(':', 1)
+        return float(width) / float(height)
+    return float(value)
+
+
+class _Field:
+    __slots__ = ['stage', 'getter', 'parser', 'is_text']
+
+    def __init__(self, stage: int, getter: Callable, parser: Callable = str, is_text: bool = False):
+        self.stage = stage
+        self.getter = getter
+        self.parser = parser
+        self.is_text = is_text
+
+
+# getters take (path, stat, info)
+WHERE_FIELDS = {
+    'name': _Field(PATH_STAGE, lambda path, stat, info: path.name, is_text=True),
+    'path': _Field(PATH_STAGE, lambda path, stat, info: str(path), is_text=True),
+    'ext': _Field(PATH_STAGE, lambda path, stat, info: path.suffix[1:].lower(), lambda value: value.lower(), True),
+    'size': _Field(STAT_STAGE, lambda path, stat, info: stat.st_size, _parse_size),
+    'mtime': _Field(STAT_STAGE, lambda path, stat, info: stat.st_mtime, _parse_time),
+    'width': _Field(HEADER_STAGE, lambda path, stat, info: info.width, _parse_int),
+    'height': _Field(HEADER_STAGE, lambda path, stat, info: info.height, _parse_int),
+    'megapixels': _Field(HEADER_STAGE, lambda path, stat, info: info.width * info.height / 1e6, _parse_number),
+    'aspect': _Field(HEADER_STAGE, lambda path, stat, info: info.width / info.height if info.height else 0.0,
+                     _parse_aspect),
+    'format': _Field(HEADER_STAGE, lambda path, stat, info: (info.format or '').upper(), lambda value: value.upper(),
+                     True),
+    'mode': _Field(HEADER_STAGE, lambda path, stat, info: info.mode, is_text=True),
+}
+
+
+class _Parser:
+    """
+        expression := or_group
+        or_group := and_group ("or" and_group)*
+        and_group := not_group ("and" not_group)*
+        not_group := "not" not_group | "(" expression ")" | condition
+        condition := FIELD OPERATOR VALUE | FIELD "in" "(" VALUE ("," VALUE)* ")" | FIELD "between" VALUE "and" VALUE
+                     | FIELD "glob" VALUE | FIELD "regex" VALUE
+        Node is (stage, fields stages, predicate)
+    """
+    def __init__(self, text: str):
+        self._text = text
+        self._tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if not match or match.end() == position:
+                raise Exception(f'Incorrect where expression: unexpected symbol at position {position}: '
+                                f'"{text[position:]}"')
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'string':
+                value = value[1:-1]
+            self._tokens.append((kind, value, match.start(kind)))
+            position = match.end()
+        self._index = 0
+
+    def _peek(self) -> Union[tuple, None]:
+        return self._tokens[self._index] if self._index < len(self._tokens) else None
+
+    def _next(self, expected: str = None) -> tuple:
+        token = self._peek()
+        if token is None:
+            raise Exception(f'Incorrect where expression: unexpected end of "{self._text}"')
+        if expected is not None and (token[0] == 'string' or token[1].lower() != expected):
+            raise Exception(f'Incorrect where expression: "{expected}" is expected at position {token[2]}, '
+                            f'got "{token[1]}"')
+        self._index += 1
+        return token
+
+    def _is_keyword(self, keyword: str) -> bool:
+        token = self._peek()
+        return token is not None and token[0] == 'word' and token[1].lower() == keyword
+
+    def parse(self) -> tuple:
+        node = self._or_group()
+        token = self._peek()
+        if token is not None:
+            raise Exception(f'Incorrect where expression: unexpected "{token[1]}" at position {token[2]}')
+        return node
+
+    def _or_group(self) -> tuple:
+        nodes = [self._and_group()]
+        while self._is_keyword('or'):
+            self._next()
+            nodes.append(self._and_group())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def _and_group(self) -> tuple:
+        nodes = [self._not_group()]
+        while self._is_keyword('and'):
+            self._next()
+            nodes.append(self._not_group())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def _not_group(self) -> tuple:
+        if self._is_keyword('not'):
+            self._next()
+            return 'not', self._not_group()
+        token = self._peek()
+        if token is not None and token[1] == '(' and token[0] == 'symbol':
+            self._next()
+            node = self._or_group()
+            self._next(')')
+            return node
+        return self._condition()
+
+    def _value(self, field: _Field, name: str) -> Union[str, int, float]:
+        kind, value, position = self._next()
+        if kind == 'symbol':
+            raise Exception(f'Incorrect where expression: value of {name} is expected at position {position}')
+        try:
+            return field.parser(value)
+        except ValueError as e:
+            raise Exception(f'Incorrect where expression: wrong value of {name} at position {position}: {e}')
+
+    def _condition(self) -> tuple:
+        kind, name, position = self._next()
+        field = WHERE_FIELDS.get(name.lower()) if kind == 'word' else None
+        if field is None:
+            raise Exception(f'Incorrect where expression: field is expected at position {position}, got "{name}". '
+                            f'Supported fields are {tuple(WHERE_FIELDS)}')
+        name = name.lower()
+        getter = field.getter
+        kind, operation, position = self._next()
+        operation = operation.lower()
+        if kind == 'symbol' and operation in _COMPARISONS:
+            if field.is_text and operation not in ('=', '==', '!='):
+                raise Exception(f'Incorrect where expression: {name} can be compared only with =, != at {position}')
+            compare, value = _COMPARISONS[operation], self._value(field, name)
+            predicate = lambda path, stat, info: compare(getter(path, stat, info), value)
+        elif operation == 'in':
+            self._next('(')
+            values = [self._value(field, name)]
+            while self._peek() is not None and self._peek()[1] == ',':
+                self._next()
+                values.append(self._value(field, name))
+            self._next(')')
+            values = frozenset(values)
+            predicate = lambda path, stat, info: getter(path, stat, info) in values
+        elif operation == 'between' and not field.is_text:
+            low = self._value(field, name)
+            self._next('and')
+            high = self._value(field, name)
+            predicate = lambda path, stat, info: low <= getter(path, stat, info) <= high
+        elif operation in ('glob', 'regex') and field.is_text:
+            kind, pattern, position = self._next()
+            try:
+                compiled = re.compile(fnmatch.translate(pattern) if operation == 'glob' else pattern)
+            except re.error as e:
+                raise Exception(f'Incorrect where expression: wrong pattern at position {position}: {e}')
+            match = compiled.match if operation == 'glob' else compiled.search
+            predicate = lambda path, stat, info: match(getter(path, stat, info)) is not None
+        else:
+            raise Exception(f'Incorrect where expression: operator "{operation}" at position {position} '
+                            f'can not be used with {name}')
+        return 'condition', field.stage, predicate
+
+
+def _stages(node: tuple) -> set:
+    if node[0] == 'condition':
+        return {node[1]}
+    if node[0] == 'not':
+        return _stages(node[1])
+    return set().union(*map(_stages, node[1]))
+
+
+def _compile(node: tuple) -> Callable:
+    if node[0] == 'condition':
+        return node[2]
+    if node[0] == 'not':
+        predicate = _compile(node[1])
+        return lambda path, stat, info: not predicate(path, stat, info)
+    predicates = tuple(map(_compile, node[1]))
+    if node[0] == 'and':
+        return lambda path, stat, info: all(predicate(path, stat, info) for predicate in predicates)
+    return lambda path, stat, info: any(predicate(path, stat, info) for predicate in predicates)
+
+
+class FileFilter:
+    """
+        Where expression compiled once into predicates of three stages: path, stat and header.
+        Top level "and" conditions are split by stage, so path and stat conditions reject files before any open
+        and header conditions are checked only for images
+    """
+    __slots__ = ['_text', '_path_predicates', '_stat_predicates', '_header_predicates']
+
+    def __init__(self, text: str):
+        """
+            :param text: str - where expression, e.g. 'ext in (jpg, png) and size > 1MB and megapixels >= 2'
+        """
+        self._text = text
+        root = _Parser(text).parse()
+        stages = ([], [], [])
+        for node in (root[1] if root[0] == 'and' else [root]):
+            node_stages = _stages(node)
+            stage = max(node_stages)
+            if stage == HEADER_STAGE and len(node_stages) > 1:
+                raise Exception(f'Incorrect where expression: header fields (width, height, megapixels, aspect, '
+                                f'format, mode) can be combined with path and stat fields only by top level "and"')
+            stages[stage].append(_compile(node))
+        self._path_predicates, self._stat_predicates, self._header_predicates = map(tuple, stages)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def needs_stat(self) -> bool:
+        return bool(self._stat_predicates)
+
+    @property
+    def has_header_predicates(self) -> bool:
+        return bool(self._header_predicates)
+
+    def check_file(self, path: pathlib.Path, stat: os.stat_result = None) -> bool:
+        """
+            Path and stat stages, file is not opened
+            :param path: pathlib.Path - file to check
+            :param stat: os.stat_result - stat of file, it is taken only if stat conditions exist and stat is None
+            :return: bool - file can match
+        """
+        for predicate in self._path_predicates:
+            if not predicate(path, None, None):
+                return False
+        if self._stat_predicates:
+            if stat is None:
+                stat = os.stat(path)
+            for predicate in self._stat_predicates:
+                if not predicate(path, stat, None):
+                    return False
+        return True
+
+    def check_info(self, info: PhotoInfo) -> bool:
+        """
+            Header stage
+            :param info: PhotoInfo or Image - image header data
+            :return: bool - image matches
+        """
+        for predicate in self._header_predicates:
+            if not predicate(None, None, info):
+                return False
+        return True
+
+    def __getstate__(self):
+        # compiled predicates are closures, processes get the text and compile it again
+        return self._text
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self) -> str:
+        return f'FileFilter({self._text!r})'
@@ -0,0 +1,205 @@
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Condition
+from typing import BinaryIO, Union
+
+from .defaults import DEFAULT_DECODE_MEMORY, DEFAULT_MAX_PIXELS
+from .photo_info import PhotoInfo
+
+
+# bytes per pixel of decoded image, 4 for other modes
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3}
+
+
+def estimate_decode_memory(info: PhotoInfo) -> int:
+    """
+        :param info: PhotoInfo - image header data
+        :return: int - bytes of decoded pixels of full size image
+    """
+    return info.width * info.height * MODE_BYTES.get(info.mode, 4)
+
+
+class _LocalValue:
+    __slots__ = ['value']
+
+    def __init__(self, value: int = 0):
+        self.value = value
+
+
+class MemoryBudget:
+    """
+        Bytes of images decoded at once, image which does not fit waits until others are finished.
+        Image larger than whole budget is decoded alone. Shared budget is kept in shared memory,
+        so threads and CPU processes started after it wait for each other
+    """
+    __slots__ = ['_limit', '_used', '_condition', '_shared']
+
+    def __init__(self, limit: int, shared: bool = False):
+        """
+            :param limit: int - bytes
+            :param shared: bool - budget is shared with CPU processes, it must be passed to them at their start
+        """
+        self._limit = limit
+        self._shared = shared
+        if shared:
+            # multiprocessing is imported only by processes and hybrid backends
+            import multiprocessing
+            self._used = multiprocessing.RawValue('q', 0)
+            self._condition = multiprocessing.Condition()
+        else:
+            self._used = _LocalValue()
+            self._condition = Condition()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def shared(self) -> bool:
+        return self._shared
+
+    @property
+    def used(self) -> int:
+        return self._used.value
+
+    def acquire(self, size: int) -> None:
+        with self._condition:
+            while self._used.value and self._used.value + size > self._limit:
+                self._condition.wait()
+            self._used.value += size
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self._used.value -= size
+            self._condition.notify_all()
+
+
+class DeadlineReader:
+    """
+        Opened file which raises TimeoutError on read after deadline. Pillow decoders read file by chunks,
+        so decode of pathological file stops at the next chunk instead of holding worker
+    """
+    __slots__ = ['_file', '_deadline', '_timeout']
+
+    def __init__(self, file: BinaryIO):
+        """
+            :param file: BinaryIO - opened file, it is read without deadline until start
+        """
+        self._file = file
+        self._timeout = None
+        self._deadline = None
+
+    def start(self, timeout: Union[float, None]) -> None:
+        """
+            :param timeout: float - seconds from now, None for no deadline
+        """
+        self._timeout = timeout
+        self._deadline = time.monotonic() + timeout if timeout is not None else None
+
+    def read(self, size: int = -1) -> bytes:
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError(f'Decode took longer than {self._timeout} s')
+        return self._file.read(size)
+
+    def __getattr__(self, name: str):
+        return getattr(self._file, name)
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """
+        Limits of image decode, None means no limit. Image over a limit is checked by its header only
+    """
+    max_pixels: Union[int, None] = field(default=DEFAULT_MAX_PIXELS)
+    max_file_size: Union[int, None] = field(default=None)
+    decode_memory: int = field(default=DEFAULT_DECODE_MEMORY)
+    timeout: Union[float, None] = field(default=None)
+
+    def __post_init__(self):
+        for name in ('max_pixels', 'max_file_size', 'decode_memory', 'timeout'):
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise Exception(f'{name} must be greater than 0')
+
+
+def _install_governor(limits: ResourceLimits, budget: MemoryBudget) -> None:
+    # initializer of CPU process, its decodes are counted in budget of main process
+    governor.configure(limits, budget)
+
+
+class ResourceGovernor:
+    """
+        Decides which images may be decoded and bounds bytes of pixels decoded at once by all threads and
+        CPU processes, so several huge images or decompression bombs can not exhaust memory together.
+        Decision is made from header dimensions and mode before any pixel is decoded
+    """
+    __slots__ = ['_limits', '_budget']
+
+    def __init__(self, limits: ResourceLimits = None):
+        """
+            :param limits: ResourceLimits - default limits by default
+        """
+        self._limits = limits if limits is not None else ResourceLimits()
+        self._budget = MemoryBudget(self._limits.decode_memory)
+
+    @property
+    def limits(self) -> ResourceLimits:
+        return self._limits
+
+    @property
+    def budget(self) -> MemoryBudget:
+        return self._budget
+
+    def configure(self, limits: ResourceLimits, budget: MemoryBudget = None) -> None:
+        """
+            Set limits before decodes are started
+            :param limits: ResourceLimits - new limits
+            :param budget: MemoryBudget - budget to use, new one for limits.decode_memory by default
+        """
+        self._limits = limits
+        self._budget = budget if budget is not None else MemoryBudget(limits.decode_memory)
+
+    def share(self) -> tuple:
+        """
+            Move budget to shared memory, so CPU processes decode in the same budget as threads of main process
+            :return: tuple - initializer and its arguments for process pool
+        """
+        if not self._budget.shared:
+            self._budget = MemoryBudget(self._limits.decode_memory, shared=True)
+        return _install_governor, (self._limits, self._budget)
+
+    def refuse_reason(self, info: PhotoInfo, file_size: int = None, memory: int = None) -> Union[str, None]:
+        """
+            :param info: PhotoInfo - image header data
+            :param file_size: int - bytes of file
+            :param memory: int - bytes of decoded pixels, estimate_decode_memory by default
+            :return: str - why image must not be decoded or None if it may be decoded
+        """
+        limits = self._limits
+        pixels = info.width * info.height
+        if limits.max_pixels is not None and pixels > limits.max_pixels:
+            return f'{info.width}x{info.height} has more than {limits.max_pixels} pixels'
+        if limits.max_file_size is not None and file_size is not None and file_size > limits.max_file_size:
+            return f'file size {file_size} is more than {limits.max_file_size} bytes'
+        if memory is None:
+            memory = estimate_decode_memory(info)
+        if memory > limits.decode_memory:
+            return f'decoded {info.mode} image needs {memory} bytes, more than {limits.decode_memory} bytes'
+        return None
+
+    @contextmanager
+    def reserve(self, memory: int):
+        """
+            Wait until memory of decoded image fits in budget, it is released at the end of with block
+            :param memory: int - bytes, estimate_decode_memory for full decode
+        """
+        self._budget.acquire(memory)
+        try:
+            yield
+        finally:
+            self._budget.release(memory)
+
+
+# one governor per process, CPU processes get limits and shared budget of main process at their start
+governor = ResourceGovernor()
@@ -0,0 +1,206 @@
+import bisect
+import json
+import time
+from contextlib import nullcontext
+from threading import Lock
+from typing import TextIO
+
+from .defaults import METRICS_FORMATS
+
+
+# stages in order of pipeline, their names are used by summary and dumps
+STAGES = ('walk', 'read_header', 'parse_header', 'pil_open', 'decode', 'exif', 'check', 'index_query', 'copy',
+          'export', 'hash_partial', 'hash_full', 'perceptual_hash')
+# upper bounds of histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+_NULL_TIMER = nullcontext()
+
+
+class Histogram:
+    """
+        Latency histogram with fixed buckets, so adding a value is one bisect and memory does not grow with count
+    """
+    __slots__ = ['counts', 'count', 'sum', 'max']
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, state: dict) -> None:
+        for index, count in enumerate(state['counts']):
+            self.counts[index] += count
+        self.count += state['count']
+        self.sum += state['sum']
+        self.max = max(self.max, state['max'])
+
+    def percentile(self, percent: float) -> float:
+        """
+            :param percent: float - from 0 to 100
+            :return: float - upper bound of bucket with the percentile, max for the last bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'max': self.max}
+
+
+class _StageTimer:
+    __slots__ = ['_metrics', '_stage', '_start']
+
+    def __init__(self, metrics: 'Metrics', stage: str):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.observe(self._stage, time.perf_counter() - self._start)
+
+
+class Metrics:
+    """
+        Per-stage latency histograms and counters of one run. Disabled metrics cost one attribute check per call,
+        so instrumentation stays in hot paths
+    """
+    __slots__ = ['enabled', '_histograms', '_counters', '_lock', '_started']
+
+    def __init__(self):
+        self.enabled = False
+        self._histograms = {}
+        self._counters = {}
+        self._lock = Lock()
+        self._started = None
+
+    def enable(self) -> None:
+        self.reset()
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self._started = time.perf_counter()
+
+    def stage(self, name: str):
+        """
+            :param name: str - stage name, one of STAGES
+            :return: context manager which adds its duration to stage histogram
+        """
+        return _StageTimer(self, name) if self.enabled else _NULL_TIMER
+
+    def observe(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        """
+            :return: dict - picklable state, CPU processes send it with their results to be merged
+        """
+        with self._lock:
+            return {'histograms': {name: histogram.as_dict() for name, histogram in self._histograms.items()},
+                    'counters': dict(self._counters)}
+
+    def merge(self, snapshot: dict) -> None:
+        with self._lock:
+            for name, state in snapshot['histograms'].items():
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = Histogram()
+                histogram.merge(state)
+            for name, value in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def _ordered_stages(self) -> list:
+        return sorted(self._histograms, key=lambda name: (STAGES.index(name) if name in STAGES else len(STAGES), name))
+
+    def repr_summary(self) -> str:
+        with self._lock:
+            elapsed = time.perf_counter() - self._started if self._started is not None else 0.0
+            lines = [f'Stats: {elapsed:.2f} s wall time, stage time is summed over all threads and processes',
+                     f'{"stage":<16}{"count":>10}{"total s":>10}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}'
+                     f'{"p99 ms":>10}{"max ms":>10}']
+            for name in self._ordered_stages():
+                histogram = self._histograms[name]
+                lines.append(f'{name:<16}{histogram.count:>10}{histogram.sum:>10.2f}'
+                             f'{histogram.sum / histogram.count * 1000:>10.3f}'
+                             + ''.join(f'{histogram.percentile(percent) * 1000:>10.3f}' for percent in (50, 95, 99))
+                             + f'{histogram.max * 1000:>10.3f}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'{name}: {value}')
+        return '\n'.join(lines)
+
+    def to_json(self) -> dict:
+        snapshot = self.snapshot()
+        for name, state in snapshot['histograms'].items():
+            histogram = self._histograms[name]
+            state['buckets'] = list(BUCKETS)
+            state.update({f'p{percent}': histogram.percentile(percent) for percent in (50, 95, 99)})
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines = ['# HELP photo_finder_stage_seconds Duration of pipeline stage per file or directory',
+                 '# TYPE photo_finder_stage_seconds histogram']
+        with self._lock:
+            for name in self._ordered_stages():
+                histogram = self._histograms[name]
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, '+Inf'), histogram.counts):
+                    cumulative += count
+                    lines.append(f'photo_finder_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'photo_finder_stage_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'photo_finder_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'# TYPE photo_finder_{name}_total counter')
+                lines.append(f'photo_finder_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file: TextIO, metrics_format: str = 'json') -> None:
+        """
+            :param file: TextIO - opened text file
+            :param metrics_format: str - json or prometheus text exposition format
+        """
+        if metrics_format not in METRICS_FORMATS:
+            raise Exception(f'Metrics format={metrics_format} is unknown. Supported ones are {METRICS_FORMATS}')
+        if metrics_format == 'json':
+            json.dump(self.to_json(), file, indent=2)
+            file.write('\n')
+        else:
+            file.write(self.to_prometheus())
+
+
+# one registry per process, CPU processes merge their snapshots into the registry of main process
+metrics = Metrics()
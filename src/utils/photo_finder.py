@@ -1,45 +1,141 @@
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from typing import Type, Union
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import TYPE_CHECKING, Callable, Type, Union
 
-from PIL import Image
-from PIL.Image import MODES
+import itertools
+import os
 import pathlib
-import filetype
-import shutil
 from dataclasses import dataclass, field
+from .copy_engine import CopyEngine
+from .copy_journal import CopyJournal
+from .dedup import DuplicateFinder
+from .defaults import PHOTO_FORMATS, PHOTO_MODES
+from .exif import ExifRequirements
+from .filters import FileFilter
+from .executors import ExecutionSettings, create_cpu_executor, iter_batches, max_cpu_batches, max_pending_batches
+from .metrics import metrics
+from .photo_info import PhotoInfo
+from .result_sink import ResultRecord, ResultSink
+from .sharding import Shard
+from .sniffer import sniff_image
+from .walker import DirectoryWalker
 import logging
 logger = logging.getLogger()
 
+if TYPE_CHECKING:
+    # process pool and Pillow are imported only when they are used, so CLI starts without them
+    from concurrent.futures import ProcessPoolExecutor
+    from PIL import Image
+    from .photo_index import PhotoIndex
 
-PHOTO_FORMATS = ('BMP', 'DDS', 'DIB', 'EPS', 'GIF', 'ICNS', 'ICO', 'IM', 'JPEG', 'MSP', 'PCX', 'PNG', 'PPM', 'SGI',
-                 'SPIDER', 'TGA', 'TIFF', 'WEBP', 'XBM')
-PHOTO_MODES = tuple(MODES)
+
+DEFAULT_MAX_PENDING = 1024
+
+
+RESULT_FIELDS = ('found', 'copied', 'not_copied', 'duplicates', 'warnings', 'errors')
+# record type => result field
+_RECORD_FIELDS = {'found': 'found', 'copied': 'copied', 'not_copied': 'not_copied', 'duplicate': 'duplicates',
+                  'warning': 'warnings', 'error': 'errors'}
 
 
 @dataclass
 class FindCopyPhotoResult:
+    """
+        Result of search or copy. Every item is counted and written to sink right away, items are kept in lists only
+        if keep_items is True, so with sink and keep_items=False memory does not grow with number of files.
+        With journal every checked file of copy job is also recorded with its final status
+    """
     found: list = field(default_factory=list)
     copied: list = field(default_factory=list)
     not_copied: list = field(default_factory=list)
+    duplicates: list = field(default_factory=list)
     errors: list = field(default_factory=list)
     warnings: list = field(default_factory=list)
+    sink: Union[ResultSink, None] = field(default=None, repr=False, compare=False)
+    keep_items: bool = field(default=True, repr=False, compare=False)
+    journal: Union[CopyJournal, None] = field(default=None, repr=False, compare=False)
+    counts: dict = field(default=None, compare=False)
+
+    def __post_init__(self):
+        if self.counts is None:
+            self.counts = {name: len(getattr(self, name)) for name in RESULT_FIELDS}
+
+    def _add(self, name: str, item, record: ResultRecord) -> None:
+        self.counts[name] += 1
+        if self.keep_items:
+            getattr(self, name).append(item)
+        if self.sink is not None:
+            self.sink.write(record)
+
+    def add_found(self, path: pathlib.Path) -> None:
+        self._add('found', path, ResultRecord(type='found', path=str(path)))
+
+    def add_copied(self, path: pathlib.Path, target: pathlib.Path = None) -> None:
+        self._add('copied', path, ResultRecord(type='copied', path=str(path),
+                                               target=str(target) if target is not None else None))
+        if self.journal is not None:
+            self.journal.record('copied', path, target=target)
+
+    def add_not_copied(self, path: pathlib.Path, message: str = None) -> None:
+        self._add('not_copied', path, ResultRecord(type='not_copied', path=str(path), message=message))
+        if self.journal is not None:
+            self.journal.record('not_copied', path, message=message)
+
+    def add_duplicate(self, path: pathlib.Path, original: pathlib.Path) -> None:
+        self._add('duplicates', f'{path} is duplicate of {original}',
+                  ResultRecord(type='duplicate', path=str(path), target=str(original)))
+
+    def add_not_matched(self, path: pathlib.Path) -> None:
+        # only journal needs files which are checked and not matched, they are not counted
+        if self.journal is not None:
+            self.journal.record('not_matched', path)
+
+    def add_error(self, message: str, path: pathlib.Path = None) -> None:
+        self._add('errors', message, ResultRecord(type='error', path=str(path) if path is not None else None,
+                                                  message=message))
+        if self.journal is not None and path is not None:
+            self.journal.record('failed', path, message=message)
+
+    def add_warning(self, message: str, path: pathlib.Path = None) -> None:
+        self._add('warnings', message, ResultRecord(type='warning', path=str(path) if path is not None else None,
+                                                    message=message))
+
+    def add_record(self, record: ResultRecord) -> None:
+        """
+            Add record read from output of other run, e.g. of other shard. Record is written to sink as it is
+            :param record: ResultRecord - record of any type from RECORD_TYPES
+        """
+        name = _RECORD_FIELDS.get(record.type)
+        if name is None:
+            raise Exception(f'Record type={record.type} is unknown. Supported ones are {tuple(_RECORD_FIELDS)}')
+        if name in ('found', 'copied', 'not_copied'):
+            item = pathlib.Path(record.path)
+        elif name == 'duplicates':
+            item = f'{record.path} is duplicate of {record.target}'
+        else:
+            item = record.message
+        self._add(name, item, record)
+
+    @property
+    def has_errors(self) -> bool:
+        return self.counts['errors'] > 0
 
     def __add__(self, new_result):
         if isinstance(new_result, FindCopyPhotoResult):
-            errors = [*self.errors]
-            errors.extend(new_result.errors)
-            warnings = [*self.warnings]
-            warnings.extend(new_result.warnings)
             return FindCopyPhotoResult(
                 found=self.found + new_result.found,
                 copied=self.copied + new_result.copied,
                 not_copied=self.not_copied + new_result.not_copied,
-                errors=errors,
-                warnings=warnings
+                duplicates=self.duplicates + new_result.duplicates,
+                errors=self.errors + new_result.errors,
+                warnings=self.warnings + new_result.warnings,
+                sink=self.sink if self.sink is not None else new_result.sink,
+                journal=self.journal if self.journal is not None else new_result.journal,
+                keep_items=self.keep_items and new_result.keep_items,
+                counts={name: self.counts[name] + new_result.counts[name] for name in RESULT_FIELDS}
             )
         else:
-            raise 'Can be add only the same class object'
+            raise Exception('Can be add only the same class object')
 
     def __radd__(self, new_result):
         return self.__add__(new_result)
@@ -49,12 +145,9 @@ class FindCopyPhotoResult:
         message = f'NO {name_upper}' if show_if_no else ''
         value = getattr(self, name)
         if value:
-            message = f'{name_upper}:'
-            if isinstance(value, list):
-                for item in value:
-                    message += f'\n{item}'
-            else:
-                message += f' {value}'
+            message = '\n'.join((f'{name_upper}:', *map(str, value)))
+        elif self.counts.get(name):
+            message = f'{name_upper}: {self.counts[name]} (written to output)'
 
         return message
 
@@ -82,41 +175,48 @@ class FindCopyPhotoResult:
     def repr_not_copied(self, show_if_no: bool = True) -> str:
         return self.__repr_value('not_copied', show_if_no)
 
+    def repr_duplicates(self, show_if_no: bool = True) -> str:
+        return self.__repr_value('duplicates', show_if_no)
+
+    def _repr_duplicates_count(self) -> str:
+        # duplicates are shown only if deduplication found them
+        return f'duplicates={self.counts["duplicates"]}, ' if self.counts['duplicates'] else ''
+
     def repr_short_search(self) -> str:
-        main_message = (f'Result: found={len(self.found)}, warnings={len(self.warnings)}, '
-                       f'errors={len(self.errors)}')
-        if self.warnings or self.errors:
+        main_message = (f'Result: found={self.counts["found"]}, {self._repr_duplicates_count()}'
+                        f'warnings={self.counts["warnings"]}, errors={self.counts["errors"]}')
+        if self.counts['warnings'] or self.counts['errors']:
             main_message += f'\n{self.repr_warnings_and_errors(False)}'
 
         return main_message
 
 
     def repr_short_copy(self) -> str:
-        main_message = (f'Result: found={len(self.found)}, copied={len(self.copied)}, '
-                        f'not_copied={len(self.not_copied)}, warnings={len(self.warnings)}, errors={len(self.errors)}')
-        if self.warnings or self.errors:
+        main_message = (f'Result: found={self.counts["found"]}, copied={self.counts["copied"]}, '
+                        f'not_copied={self.counts["not_copied"]}, {self._repr_duplicates_count()}'
+                        f'warnings={self.counts["warnings"]}, errors={self.counts["errors"]}')
+        if self.counts['warnings'] or self.counts['errors']:
             main_message += f'\n{self.repr_warnings_and_errors(False)}'
 
         return main_message
 
     def repr_detailed_search(self) -> str:
-        message = self.repr_short_search()
-        if self.found:
-            message += f'\n{self.repr_found()}'
+        messages = [self.repr_short_search()]
+        if self.counts['found']:
+            messages.append(self.repr_found())
+        if self.counts['duplicates']:
+            messages.append(self.repr_duplicates())
 
-        return message
+        return '\n'.join(messages)
 
 
     def repr_detailed_copy(self) -> str:
-        message = self.repr_short_copy()
-        if self.found:
-            message += f'\n{self.repr_found()}'
-        if self.copied:
-            message += f'\n{self.repr_copied()}'
-        if self.not_copied:
-            message += f'\n{self.repr_not_copied()}'
+        messages = [self.repr_short_copy()]
+        for name in ('found', 'copied', 'not_copied', 'duplicates'):
+            if self.counts[name]:
+                messages.append(self.__repr_value(name))
 
-        return message
+        return '\n'.join(messages)
 
 
 @dataclass(frozen=True)
@@ -135,9 +235,10 @@ class PhotoPixelSizeObject(PhotoPixelSize):
 
 
 class PhotoRequirements:
-    __slots__ = ['_min_photo_sizes', '_photo_modes', '_photo_formats']
+    __slots__ = ['_min_photo_sizes', '_photo_modes', '_photo_formats', '_where', '_exif_requirements', '_checks']
     def __init__(self, min_photo_sizes: list = None, photo_modes: Union[list[str], set[str]] = None,
-                 photo_formats: Union[list[str], set[str]] = None):
+                 photo_formats: Union[list[str], set[str]] = None, where: Union[str, FileFilter] = None,
+                 exif_requirements: ExifRequirements = None):
         self._min_photo_sizes = []
         if min_photo_sizes:
             for size in min_photo_sizes:
@@ -147,6 +248,22 @@ class PhotoRequirements:
                     raise Exception(f'Elements of min_photo_sizes should be instance of PhotoPixelSizeObject class')
         self._photo_modes = self.check_photo_modes(photo_modes) if photo_modes is not None else PHOTO_MODES
         self._photo_formats = self.check_photo_formats(photo_formats) if photo_formats is not None else PHOTO_FORMATS
+        self._where = FileFilter(where) if isinstance(where, str) else where
+        self._exif_requirements = exif_requirements if exif_requirements else None
+        self._checks = None
+
+    def __getstate__(self):
+        # compiled checks are closures, they are compiled again in process
+        return self._min_photo_sizes, self._photo_modes, self._photo_formats, self._where, self._exif_requirements
+
+    def __setstate__(self, state):
+        (self._min_photo_sizes, self._photo_modes, self._photo_formats, self._where,
+         self._exif_requirements) = state
+        self._checks = None
+
+    @property
+    def min_photo_sizes(self) -> list:
+        return self._min_photo_sizes
 
     @property
     def photo_modes(self) -> Union[set, None]:
@@ -154,12 +271,14 @@ class PhotoRequirements:
 
     @photo_modes.setter
     def photo_modes(self, modes: Union[list[str], set[str], None]) -> None:
+        self._checks = None
         if modes is None:
             self._photo_modes = PHOTO_MODES
         else:
             self._photo_modes = self.check_photo_modes(modes)
 
     def set_photo_modes(self, modes: Union[list[str], set[str], None], check: bool = True) -> None:
+        self._checks = None
         if modes is None:
             self._photo_modes = PHOTO_MODES
         else:
@@ -171,17 +290,41 @@ class PhotoRequirements:
 
     @photo_formats.setter
     def photo_formats(self, formats: Union[list[str], set[str], None]) -> None:
+        self._checks = None
         if formats is None:
             self._photo_formats = PHOTO_FORMATS
         else:
             self._photo_formats = self.check_photo_formats(formats)
 
     def set_photo_formats(self, formats: Union[list[str], set[str], None], check: bool = True) -> None:
+        self._checks = None
         if formats is None:
             self._photo_formats = PHOTO_FORMATS
         else:
             self._photo_formats = self.check_photo_formats(formats) if check else formats
 
+    @property
+    def where(self) -> Union[FileFilter, None]:
+        return self._where
+
+    @property
+    def needs_stat(self) -> bool:
+        """
+            Whether check_file needs stat of file (size or mtime conditions), walk can take it with directory entry
+        """
+        return self._where is not None and self._where.needs_stat
+
+    @property
+    def exif_requirements(self) -> Union[ExifRequirements, None]:
+        return self._exif_requirements
+
+    @property
+    def needs_exif(self) -> bool:
+        """
+            Whether check_image needs EXIF fields, they are read only for date, camera and GPS requirements
+        """
+        return self._exif_requirements is not None
+
     @staticmethod
     def _check_requirements_data(data: Union[list[str], set[str]],
                                   possible_data: Union[list[str], set[str], tuple[str,...]], name: str) -> Union[tuple, None]:
@@ -208,160 +351,553 @@ class PhotoRequirements:
     def check_photo_formats(cls, photo_formats: Union[list[str], set[str]]) -> Union[tuple, None]:
         return cls._check_requirements_data(data=photo_formats, possible_data=PHOTO_FORMATS, name="Photo format")
 
+    def as_dict(self) -> dict:
+        """
+            :return: dict - every requirement in JSON compatible form, equal requirements give equal dicts
+        """
+        exif = self._exif_requirements
+        return {'min_photo_sizes': sorted([size.width, size.height] for size in self._min_photo_sizes),
+                'photo_modes': sorted(self._photo_modes), 'photo_formats': sorted(self._photo_formats),
+                'where': self._where.text if self._where is not None else None,
+                'exif': {'taken_from': exif.taken_from, 'taken_to': exif.taken_to, 'cameras': sorted(exif.cameras),
+                         'gps_bbox': list(exif.gps_bbox) if exif.gps_bbox is not None else None}
+                if exif is not None else None}
+
+    def _compile_checks(self) -> tuple:
+        # cheap set lookups first, then sizes, then where expression, then EXIF
+        checks = []
+        if self._photo_modes:
+            modes = frozenset(self._photo_modes)
+            checks.append(lambda image: image.mode in modes)
+        if self._photo_formats:
+            formats = frozenset(self._photo_formats)
+            checks.append(lambda image: image.format in formats)
+        if self._min_photo_sizes:
+            sizes = tuple((size.width, size.height) for size in self._min_photo_sizes)
+            checks.append(lambda image: any(image.width >= width and image.height >= height for width, height in sizes))
+        if self._where is not None and self._where.has_header_predicates:
+            checks.append(self._where.check_info)
+        if self._exif_requirements is not None:
+            exif_check = self._exif_requirements.check
+            checks.append(lambda image: exif_check(getattr(image, 'exif', None)))
+        return tuple(checks)
+
+    def check_file(self, path: pathlib.Path, stat: os.stat_result = None) -> bool:
+        """
+            Check path and stat conditions of where expression before file is opened
+            :param path: pathlib.Path - file to check
+            :param stat: os.stat_result - stat of file if it is known already
+            :return: bool - file can match requirements
+        """
+        return self._where is None or self._where.check_file(path, stat)
+
+    def check_image(self, image: Union['Image.Image', PhotoInfo]) -> bool:
+        checks = self._checks
+        if checks is None:
+            checks = self._checks = self._compile_checks()
+        for check in checks:
+            if not check(image):
+                return False
+        return True
+
+
+def read_photo_info(path: pathlib.Path, verify_decode: bool = False, read_exif: bool = False,
+                    photo_formats: Union[set, tuple, None] = None,
+                    on_warning: Callable[[str], None] = None) -> Union[PhotoInfo, None]:
+    """
+        Read format, mode and size from image header, file is opened and read once
+        :param path: pathlib.Path - file to read
+        :param verify_decode: bool - decode image fully to check its integrity
+        :param read_exif: bool - read date taken, camera and GPS position from EXIF too
+        :param photo_formats: set - formats to look for, Pillow loads only their plugins. Any format by default
+        :param on_warning: Callable - called with warning message if image is over decode limits and only its header
+            is checked
+        :return: PhotoInfo - image header data or None if file is not image of photo_formats
+    """
+    return sniff_image(path, verify_decode=verify_decode, read_exif=read_exif, photo_formats=photo_formats,
+                       on_warning=on_warning)
 
-    def check_image(self, image: Image.Image) -> bool:
-        result = True
-        if self._photo_modes and image.mode not in self._photo_modes:
-            result = False
-        if result and self._photo_formats and image.format not in self._photo_formats:
-            result = False
-        if result and self._min_photo_sizes:
-            according_to_one_of_size = False
-            for size in self._min_photo_sizes:
-                if image.width >= size.width and image.height >= size.height:
-                    according_to_one_of_size = True
-                    break
-            if not according_to_one_of_size:
-                result = False
-
-        return result
 
+def copy_photo(path: pathlib.Path, copy_dir: pathlib.Path, executor_lock: Lock, result: FindCopyPhotoResult,
+               copy_engine: CopyEngine = None):
+    """
+        Copy found photo to copy_dir, if other file with the same name exists photo is copied as name_N.ext
+        :param path: pathlib.Path - photo to copy
+        :param copy_dir: pathlib.Path - directory to copy photo, will be created if it does not exist
+        :param executor_lock: Lock - executor_lock for executor to append results
+        :param result: FindCopyPhotoResult - result for all
+        :param copy_engine: CopyEngine - copy method and created directories cache, plain copy by default
+    """
+    if copy_engine is None:
+        copy_engine = CopyEngine()
+    try:
+        copy_engine.ensure_dir(copy_dir)
+    except Exception as e:
+        error_message = (f'Directory {copy_dir.absolute()} was not created, error={repr(e)}. '
+                         f'File {path.absolute()} will not be copied')
+        with executor_lock:
+            result.add_not_copied(path, error_message)
+            result.add_error(error_message, path)
+        logger.error(error_message)
+        return
 
-def check_image_file_and_copy(path: pathlib.Path, executor_lock: Lock, result: FindCopyPhotoResult,
-                                    photo_requirements: PhotoRequirements, copy_dir: pathlib.Path = None):
     try:
-        logger.info(f'Start check file {path.absolute()}')
-        with Image.open(path) as img:
-            img.load()
-            if not photo_requirements or photo_requirements.check_image(img):
-                with executor_lock:
-                    result.found.append(path)
-                    logger.info(f'File {path.absolute()} matches requirements')
-                if copy_dir is not None:
-                    if not pathlib.Path.exists(copy_dir):
-                        try:
-                            copy_dir.mkdir(parents=True, exist_ok=True)
-                        except Exception as e:
-                            error_message = (f'Directory {copy_dir.absolute()} was not created, error={repr(e)}. '
-                                             f'File {path.absolute()} will not be copied')
-                            with executor_lock:
-                                result.not_copied.append(path)
-                                result.errors.append(error_message)
-                            logger.error(error_message)
-                            copy_dir_exists = False
-                        else:
-                            copy_dir_exists = True
-                    else:
-                        copy_dir_exists = True
-                    if copy_dir_exists:
-                        save_file_path = pathlib.Path(copy_dir)
-                        save_file_path = save_file_path.joinpath(path.name)
-                        if not pathlib.Path.exists(save_file_path):
-                            try:
-                                shutil.copy2(src=path, dst=save_file_path)
-                            except Exception as e:
-                                error_message = f'File {path.absolute()} will not be copied because of error={repr(e)}'
-                                with executor_lock:
-                                    result.not_copied.append(path)
-                                    result.errors.append(error_message)
-                                logger.error(error_message)
-                            else:
-                                with executor_lock:
-                                    result.copied.append(path)
-                                logger.info(f'File {path.absolute()} was copied in {save_file_path.absolute()}')
-                        else:
-                            warning_message = (f'File {path.absolute()} will not be copied because file with name '
-                                               f'exists in copy_dir {copy_dir.absolute()}')
-                            with executor_lock:
-                                result.not_copied.append(path)
-                                result.warnings.append(warning_message)
-                            logger.warning(warning_message)
+        # destination is created exclusively, so existing file is not overwritten even by concurrent copy.
+        # Existing file with the same name is checked to be a copy of this photo, other photo gets numbered name
+        for number in itertools.count():
+            save_file_path = copy_dir.joinpath(copy_engine.target_name(path, number))
+            try:
+                method = copy_engine.copy(path, save_file_path)
+            except FileExistsError:
+                if copy_engine.is_copy_of(path, save_file_path):
+                    method = None
+                    break
             else:
-                logger.info(f'File {path.absolute()} does not match requirements')
+                break
     except Exception as e:
-        error_message = f'Exception error on file "{str(path)}": {repr(e)}'
+        error_message = f'File {path.absolute()} will not be copied because of error={repr(e)}'
         with executor_lock:
-            result.errors.append(error_message)
+            result.add_not_copied(path, error_message)
+            result.add_error(error_message, path)
         logger.error(error_message)
+    else:
+        if method is None:
+            warning_message = (f'File {path.absolute()} will not be copied because it was already copied in '
+                               f'{save_file_path.absolute()}')
+            with executor_lock:
+                result.add_not_copied(path, warning_message)
+                result.add_warning(warning_message, path)
+            logger.warning(warning_message)
+            return
+        with executor_lock:
+            result.add_copied(path, save_file_path)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('File %s was copied in %s with %s', path.absolute(), save_file_path.absolute(), method)
 
 
-def _find_and_copy_photo_recursive(executor: ThreadPoolExecutor, executor_lock: Lock, tasks: list, result: FindCopyPhotoResult,
-                                   find_dir: pathlib.Path, copy_dir: pathlib.Path = None, recursive: bool = False,
-                                   photo_requirements: PhotoRequirements = None) -> None:
+def check_photo(path: pathlib.Path, photo_requirements: PhotoRequirements = None,
+                verify_decode: bool = False, on_warning: Callable[[str], None] = None) -> bool:
+    """
+        :param path: pathlib.Path - file to check
+        :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param verify_decode: bool - decode image fully to check its integrity
+        :param on_warning: Callable - called with warning message if image is not decoded because of limits
+        :return: bool - file is image and matches requirements
     """
+    # every requirement is checked by header data, pixels are decoded just for integrity check
+    info = read_photo_info(path, verify_decode=verify_decode,
+                           read_exif=bool(photo_requirements and photo_requirements.needs_exif),
+                           photo_formats=photo_requirements.photo_formats if photo_requirements else None,
+                           on_warning=on_warning)
+    if info is None:
+        return False
+    metrics.count('images')
+    with metrics.stage('check'):
+        matches = not photo_requirements or photo_requirements.check_image(info)
+    # path is made absolute only if info logs are shown
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('File %s %s requirements', path.absolute(), 'matches' if matches else 'does not match')
+    return matches
+
+
+def check_photo_batch(paths: list, photo_requirements: PhotoRequirements = None,
+                      verify_decode: bool = False, with_metrics: bool = False) -> Union[list, tuple]:
+    """
+        Check files in worker process, only results are sent back
+        :param paths: list - files to check
+        :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param verify_decode: bool - decode images fully to check their integrity
+        :param with_metrics: bool - measure stages in worker process and send metrics of this batch too
+        :return: list - (path, matches, error message or None, warning message or None) for every file,
+            tuple (list of outcomes, metrics snapshot) if with_metrics is set
+    """
+    if with_metrics:
+        # worker process is reused, metrics are reset, so every snapshot has only its batch
+        metrics.enable()
+    outcomes = []
+    for path in paths:
+        warnings = []
+        try:
+            matches = check_photo(path, photo_requirements, verify_decode, on_warning=warnings.append)
+            outcomes.append((path, matches, None, warnings[0] if warnings else None))
+        except Exception as e:
+            outcomes.append((path, False, f'Exception error on file "{str(path)}": {repr(e)}', None))
+    return (outcomes, metrics.snapshot()) if with_metrics else outcomes
+
+
+def _record_found(path: pathlib.Path, executor_lock: Lock, result: FindCopyPhotoResult,
+                  copy_dir: pathlib.Path = None, executor: ThreadPoolExecutor = None,
+                  copy_engine: CopyEngine = None, duplicate_finder: DuplicateFinder = None) -> None:
+    with executor_lock:
+        result.add_found(path)
+    if duplicate_finder is not None:
+        # copy waits for deduplication of all found photos
+        duplicate_finder.add(path, copy_dir)
+    elif copy_dir is not None:
+        if executor is None:
+            copy_photo(path=path, copy_dir=copy_dir, executor_lock=executor_lock, result=result,
+                       copy_engine=copy_engine)
+        else:
+            executor.submit(copy_photo, path=path, copy_dir=copy_dir, executor_lock=executor_lock, result=result,
+                            copy_engine=copy_engine)
+
+
+def _record_not_matched(path: pathlib.Path, executor_lock: Lock, result: FindCopyPhotoResult) -> None:
+    if result.journal is not None:
+        with executor_lock:
+            result.add_not_matched(path)
+
+
+def _record_error(error_message: str, executor_lock: Lock, result: FindCopyPhotoResult,
+                  path: pathlib.Path = None) -> None:
+    with executor_lock:
+        result.add_error(error_message, path)
+    logger.error(error_message)
+
+
+def _record_warning(warning_message: str, executor_lock: Lock, result: FindCopyPhotoResult,
+                    path: pathlib.Path = None) -> None:
+    # message is logged where it is made, it can be made in CPU process
+    with executor_lock:
+        result.add_warning(warning_message, path)
+
+
+def check_image_file_and_copy(path: pathlib.Path, executor_lock: Lock, result: FindCopyPhotoResult,
+                                    photo_requirements: PhotoRequirements, copy_dir: pathlib.Path = None,
+                                    verify_decode: bool = False, copy_engine: CopyEngine = None,
+                                    duplicate_finder: DuplicateFinder = None):
+    try:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Start check file %s', path.absolute())
+        if check_photo(path, photo_requirements, verify_decode,
+                       on_warning=lambda message: _record_warning(message, executor_lock, result, path)):
+            _record_found(path=path, executor_lock=executor_lock, result=result, copy_dir=copy_dir,
+                          copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+        else:
+            _record_not_matched(path, executor_lock, result)
+    except Exception as e:
+        _record_error(f'Exception error on file "{str(path)}": {repr(e)}', executor_lock, result, path)
+
+
+def _record_batch(future: Future, copy_dirs: dict, executor_lock: Lock, result: FindCopyPhotoResult,
+                  executor: ThreadPoolExecutor, copy_engine: CopyEngine = None,
+                  duplicate_finder: DuplicateFinder = None) -> None:
+    # runs in process pool management thread, so copies are passed to I/O threads
+    try:
+        outcomes = future.result()
+    except Exception as e:
+        _record_error(f'Exception error on files batch {list(copy_dirs)}: {repr(e)}', executor_lock, result)
+        return
+    if isinstance(outcomes, tuple):
+        outcomes, snapshot = outcomes
+        metrics.merge(snapshot)
+    for path, matches, error_message, warning_message in outcomes:
+        if warning_message is not None:
+            _record_warning(warning_message, executor_lock, result, path)
+        if error_message is not None:
+            _record_error(error_message, executor_lock, result, path)
+        elif matches:
+            _record_found(path=path, executor_lock=executor_lock, result=result, copy_dir=copy_dirs[path],
+                          executor=executor, copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+        else:
+            _record_not_matched(path, executor_lock, result)
+
+
+def _check_header_batch(batch: list, executor_lock: Lock, result: FindCopyPhotoResult,
+                        photo_requirements: PhotoRequirements, verify_decode: bool, copy_executor: ThreadPoolExecutor,
+                        cpu_executor: 'ProcessPoolExecutor', cpu_semaphore: BoundedSemaphore,
+                        copy_engine: CopyEngine = None, duplicate_finder: DuplicateFinder = None) -> None:
+    """
+        Hybrid backend I/O stage: read headers in thread, pass only images which need decode to CPU processes.
+        Thread waits for free slot of cpu_semaphore, so batches do not pile up in process pool queue
+    """
+    to_decode = {}
+    for path, copy_dir in batch:
+        try:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('Start check file %s', path.absolute())
+            if verify_decode:
+                if read_photo_info(path, photo_formats=photo_requirements.photo_formats
+                                   if photo_requirements else None) is not None:
+                    to_decode[path] = copy_dir
+                else:
+                    _record_not_matched(path, executor_lock, result)
+            elif check_photo(path, photo_requirements):
+                _record_found(path=path, executor_lock=executor_lock, result=result, copy_dir=copy_dir,
+                              copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+            else:
+                _record_not_matched(path, executor_lock, result)
+        except Exception as e:
+            _record_error(f'Exception error on file "{str(path)}": {repr(e)}', executor_lock, result, path)
+    if to_decode:
+        _submit_bounded(cpu_executor, cpu_semaphore, check_photo_batch, list(to_decode), photo_requirements, True,
+                        metrics.enabled, callback=lambda done: _record_batch(done, to_decode, executor_lock, result,
+                                                                            copy_executor, copy_engine,
+                                                                            duplicate_finder))
+
+
+def _submit_bounded(executor: Executor, semaphore: BoundedSemaphore, fn, *args, callback=None, **kwargs) -> None:
+    # wait for free slot, so walk does not run ahead of workers and pending tasks do not pile up in memory
+    semaphore.acquire()
+    try:
+        future = executor.submit(fn, *args, **kwargs)
+    except BaseException:
+        semaphore.release()
+        raise
+
+    def done(finished: Future):
+        try:
+            if callback is not None:
+                callback(finished)
+        finally:
+            semaphore.release()
+
+    future.add_done_callback(done)
+
+
+def _find_and_copy_photo_walk(executor: ThreadPoolExecutor, executor_lock: Lock, result: FindCopyPhotoResult,
+                              find_dirs: list, copy_dir: pathlib.Path = None, recursive: bool = False,
+                              photo_requirements: PhotoRequirements = None, verify_decode: bool = False,
+                              max_pending: int = DEFAULT_MAX_PENDING, execution: ExecutionSettings = None,
+                              cpu_executor: 'ProcessPoolExecutor' = None, copy_engine: CopyEngine = None,
+                              duplicate_finder: DuplicateFinder = None, shard: Shard = None) -> None:
+    """
+        Stream files from DirectoryWalker to executor, at most max_pending files are waiting for check at once.
+        Directories are walked one after another into the same executors, so workers are not idle between them
         :param executor: ThreadPoolExecutor - executor for checking and copy files
         :param executor_lock: Lock - executor_lock for executor to append results
-        :param tasks: list - tasks for checking and copy files
         :param result: FindCopyPhotoResult - result for all
+        :param find_dirs: list - directories to find photos
+        :param copy_dir: pathlib.Path - directory to copy photos, inner directories are copied to its inner directories
+        :param recursive: bool - go to inner directories or not
+        :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param verify_decode: bool - decode every image fully to check its integrity
+        :param max_pending: int - maximum number of submitted and not finished files
+        :param execution: ExecutionSettings - execution backend, files are checked in batches for processes and hybrid
+        :param cpu_executor: ProcessPoolExecutor - executor for checking files for processes and hybrid backends
+        :param copy_engine: CopyEngine - copy method and created directories cache
+        :param duplicate_finder: DuplicateFinder - collects found photos to copy them after deduplication
+        :param shard: Shard - check only files of this shard
+    """
+    def add_message(add: Callable[[str], None], message: str):
+        with executor_lock:
+            add(message)
+
+    walkers = (DirectoryWalker(find_dir, recursive=recursive, skip_dirs=[copy_dir],
+                               with_stat=bool(photo_requirements and photo_requirements.needs_stat), shard=shard,
+                               on_error=lambda message: add_message(result.add_error, message),
+                               on_warning=lambda message: add_message(result.add_warning, message))
+               for find_dir in find_dirs)
+    # files finished by resumed copy job and files rejected by path and stat conditions are skipped before open
+    journal = result.journal
+    items = ((item.path, copy_dir.joinpath(item.rel_dir) if copy_dir is not None else None)
+             for item in itertools.chain.from_iterable(walkers)
+             if (journal is None or not journal.is_finished(item.path))
+             and (not photo_requirements or photo_requirements.check_file(item.path, item.stat)))
+    if cpu_executor is None:
+        semaphore = BoundedSemaphore(max_pending)
+        for path, item_copy_dir in items:
+            _submit_bounded(executor, semaphore, check_image_file_and_copy, path=path, result=result,
+                            executor_lock=executor_lock, copy_dir=item_copy_dir,
+                            photo_requirements=photo_requirements, verify_decode=verify_decode,
+                            copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+        return
+
+    slots = max_pending_batches(execution, max_pending)
+    semaphore = BoundedSemaphore(slots)
+    # hybrid I/O stage is bounded by semaphore, its submissions to CPU processes are bounded by cpu_semaphore
+    cpu_slots = max_cpu_batches(execution)
+    cpu_semaphore = BoundedSemaphore(cpu_slots)
+    for batch in iter_batches(items, execution.batch_size):
+        if execution.backend == 'processes':
+            copy_dirs = dict(batch)
+            _submit_bounded(cpu_executor, semaphore, check_photo_batch, list(copy_dirs), photo_requirements,
+                            verify_decode, metrics.enabled, callback=lambda done, copy_dirs=copy_dirs: _record_batch(
+                                done, copy_dirs, executor_lock, result, executor, copy_engine, duplicate_finder))
+        else:
+            _submit_bounded(executor, semaphore, _check_header_batch, batch=batch, executor_lock=executor_lock,
+                            result=result, photo_requirements=photo_requirements, verify_decode=verify_decode,
+                            copy_executor=executor, cpu_executor=cpu_executor, cpu_semaphore=cpu_semaphore,
+                            copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+    # wait for every batch, hybrid I/O stage submits to cpu_executor, so it can not be shut down before
+    for _ in range(slots):
+        semaphore.acquire()
+    for _ in range(cpu_slots):
+        cpu_semaphore.acquire()
+
+
+def _find_and_copy_photo_indexed(executor: ThreadPoolExecutor, executor_lock: Lock, result: FindCopyPhotoResult,
+                                 photo_index: 'PhotoIndex', find_dir: pathlib.Path, copy_dir: pathlib.Path = None,
+                                 recursive: bool = False, photo_requirements: PhotoRequirements = None,
+                                 verify_decode: bool = False, copy_engine: CopyEngine = None,
+                                 duplicate_finder: DuplicateFinder = None, shard: Shard = None) -> None:
+    """
+        Refresh index for find_dir (only new and changed files are opened) and find photos with index query
+        :param executor: ThreadPoolExecutor - executor for copy files
+        :param executor_lock: Lock - executor_lock for executor to append results
+        :param result: FindCopyPhotoResult - result for all
+        :param photo_index: PhotoIndex - index of photo metadata
         :param find_dir: pathlib.Path - directory to find photos
         :param copy_dir: pathlib.Path - directory to copy photos
         :param recursive: bool - go to inner directories or not
         :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param verify_decode: bool - decode new and changed images fully to check their integrity
+        :param copy_engine: CopyEngine - copy method and created directories cache
+        :param duplicate_finder: DuplicateFinder - collects found photos to copy them after deduplication
+        :param shard: Shard - refresh index and find photos only for files of this shard
     """
-
-    logger.info(f'In directory {find_dir.resolve().absolute()}')
     if find_dir == copy_dir:
         warning_message = f'find_dir "{find_dir}" and copy_dir "{copy_dir}" are the same, find_dir will be skipped'
         with executor_lock:
-            result.warnings.append(warning_message)
+            result.add_warning(warning_message)
         logger.warning(warning_message)
         return
 
-    for item in find_dir.iterdir():
-        if item.is_dir() and recursive:
-            if item != copy_dir:
-                new_copy_dir = pathlib.Path(copy_dir).joinpath(item.name)
-                _find_and_copy_photo_recursive(executor=executor, executor_lock=executor_lock, tasks=tasks, result=result,
-                                               find_dir=item, copy_dir=new_copy_dir, recursive=recursive,
-                                               photo_requirements=photo_requirements)
-            else:
-                warning_message = (f'"Directory {item}" and copy_dir "{copy_dir}" are the same, '
-                                   f'this directory will be skipped')
+    index_result = photo_index.refresh(find_dir=find_dir, recursive=recursive, skip_dir=copy_dir,
+                                       verify_decode=verify_decode, shard=shard)
+    with executor_lock:
+        for error_message in index_result.errors:
+            result.add_error(error_message)
+        for warning_message in index_result.warnings:
+            result.add_warning(warning_message)
+
+    find_dir = find_dir.absolute()
+    for path in photo_index.query(find_dir=find_dir, recursive=recursive, photo_requirements=photo_requirements,
+                                  skip_dir=copy_dir, shard=shard):
+        if result.journal is not None and result.journal.is_finished(path):
+            continue
+        logger.info('File %s matches requirements', path)
+        _record_found(path=path, executor_lock=executor_lock, result=result,
+                      copy_dir=copy_dir.joinpath(path.parent.relative_to(find_dir)) if copy_dir is not None else None,
+                      executor=executor, copy_engine=copy_engine, duplicate_finder=duplicate_finder)
+
+
+def _deduplicate_and_copy(duplicate_finder: DuplicateFinder, executor_lock: Lock, result: FindCopyPhotoResult,
+                          execution: ExecutionSettings, copy_engine: CopyEngine) -> None:
+    """
+        Report found photos with the same content and copy collected photos, duplicates are not copied in unique mode
+        :param duplicate_finder: DuplicateFinder - found photos with their copy directories
+        :param executor_lock: Lock - executor_lock for executor to append results
+        :param result: FindCopyPhotoResult - result for all
+        :param execution: ExecutionSettings - number of I/O threads for hashing and copy
+        :param copy_engine: CopyEngine - copy method and created directories cache
+    """
+    for group in duplicate_finder.find_duplicates(
+            on_error=lambda message, path: _record_error(message, executor_lock, result, path)):
+        for path in group[1:]:
+            with executor_lock:
+                result.add_duplicate(path, group[0])
+            logger.info('File %s is duplicate of %s', path, group[0])
+
+    with ThreadPoolExecutor(max_workers=execution.io_workers) as executor:
+        for path, copy_dir in duplicate_finder.candidates:
+            if copy_dir is None:
+                continue
+            original = duplicate_finder.duplicate_of(path)
+            if original is not None and duplicate_finder.mode == 'unique':
                 with executor_lock:
-                    result.warnings.append(warning_message)
-                logger.warning(warning_message)
-        elif item.is_file() and filetype.is_image(item):
-            tasks.append(executor.submit(check_image_file_and_copy, path=item, result=result,
-                                   executor_lock=executor_lock, copy_dir=copy_dir, photo_requirements=photo_requirements))
+                    result.add_not_copied(path, f'File {path.absolute()} will not be copied because it is '
+                                                f'duplicate of {original.absolute()}')
+                continue
+            executor.submit(copy_photo, path=path, copy_dir=copy_dir, executor_lock=executor_lock, result=result,
+                            copy_engine=copy_engine)
 
 
+def _unique_find_dirs(find_dirs: list, recursive: bool, result: FindCopyPhotoResult) -> list:
+    """
+        :param find_dirs: list - directories to find photos
+        :param recursive: bool - go to inner directories or not
+        :param result: FindCopyPhotoResult - result for warnings about skipped directories
+        :return: list - directories without repeated ones and, for recursive search, without ones inside others
+    """
+    absolute_dirs = [os.path.abspath(find_dir) for find_dir in find_dirs]
+    unique_dirs = []
+    for find_dir, absolute_dir in zip(find_dirs, absolute_dirs):
+        outer_dir = next((other for other in absolute_dirs if other != absolute_dir and recursive
+                          and absolute_dir.startswith(os.path.join(other, ''))), None)
+        if outer_dir is not None:
+            warning_message = f'find_dir "{find_dir}" is inside find_dir "{outer_dir}", it will be skipped'
+        elif absolute_dir in (os.path.abspath(unique_dir) for unique_dir in unique_dirs):
+            warning_message = f'find_dir "{find_dir}" is set several times, it will be searched once'
+        else:
+            unique_dirs.append(find_dir)
+            continue
+        result.add_warning(warning_message)
+        logger.warning(warning_message)
+    return unique_dirs
 
 
-# find photo and copy it with recursive call
-def find_and_copy_photo(find_dir: pathlib.Path, copy_dir: pathlib.Path = None, recursive: bool = False,
+# find photo and copy it with streaming directory walk
+def find_and_copy_photo(find_dir: Union[pathlib.Path, list], copy_dir: pathlib.Path = None, recursive: bool = False,
                         photo_requirements: PhotoRequirements = None,
-                        result: FindCopyPhotoResult = None) -> FindCopyPhotoResult:
+                        result: FindCopyPhotoResult = None, verify_decode: bool = False,
+                        photo_index: 'PhotoIndex' = None, execution: ExecutionSettings = None,
+                        copy_engine: CopyEngine = None, duplicate_finder: DuplicateFinder = None,
+                        shard: Shard = None) -> FindCopyPhotoResult:
     """
-        :param find_dir: pathlib.Path - directory to find photos
+        :param find_dir: pathlib.Path or list - directory or directories to find photos, files of all of them are
+            copied to the same copy_dir with their relative directories
         :param copy_dir: pathlib.Path - directory to copy photos
         :param recursive: bool - go to inner directories or not
         :param photo_requirements: PhotoRequirements - requirement to photo to find
         :param result: FindCopyPhotoResult - to get result even if will be some exception
+        :param verify_decode: bool - decode every image fully to check its integrity, by default only header is read
+        :param photo_index: PhotoIndex - index of photo metadata, files with unchanged stat are not opened
+        :param execution: ExecutionSettings - threads, processes or hybrid backend and worker counts
+        :param copy_engine: CopyEngine - copy, hardlink or symlink mode, its stats has copy throughput
+        :param duplicate_finder: DuplicateFinder - report photos with the same content or copy only one of them
+        :param shard: Shard - check only files of this shard by path relative to find_dir, so several workers
+            with the same find_dir scan disjoint parts of it
         :return: FindCopyPhotoResult - dataclass with found, copied, errors and warnings fields - result of function
     """
     if result is None:
         result = FindCopyPhotoResult()
 
-    if not pathlib.Path.exists(find_dir):
-        result.errors.append(f'find_dir "{find_dir}" does not exist')
-    elif not find_dir.is_dir():
-        result.errors.append(f'find_dir "{find_dir}" is not directory')
+    find_dirs = list(find_dir) if isinstance(find_dir, (list, tuple)) else [find_dir]
+    if not find_dirs:
+        result.add_error('find_dir is not set')
+    for find_dir in find_dirs:
+        if not pathlib.Path.exists(find_dir):
+            result.add_error(f'find_dir "{find_dir}" does not exist')
+        elif not find_dir.is_dir():
+            result.add_error(f'find_dir "{find_dir}" is not directory')
 
     if copy_dir is not None:
         if not pathlib.Path.exists(copy_dir):
-            result.errors.append(f'copy_dir "{copy_dir}" does not exist')
+            result.add_error(f'copy_dir "{copy_dir}" does not exist')
         elif not copy_dir.is_dir():
-            result.errors.append(f'copy_dir "{copy_dir}" is not directory')
+            result.add_error(f'copy_dir "{copy_dir}" is not directory')
 
-    if result.errors:
+    if result.has_errors:
         return result
 
-    executor_lock = Lock()
-    tasks = []
-    with ThreadPoolExecutor() as executor:
-        _find_and_copy_photo_recursive(tasks=tasks, executor=executor, executor_lock=executor_lock, result=result,
-                                       find_dir=find_dir, copy_dir=copy_dir,
-                                       recursive=recursive, photo_requirements=photo_requirements)
+    find_dirs = _unique_find_dirs(find_dirs, recursive, result)
+    if execution is None:
+        execution = ExecutionSettings()
+    if copy_engine is None:
+        copy_engine = CopyEngine()
 
+    executor_lock = Lock()
+    # exit order matters: CPU processes finish first, their callbacks still pass copies to I/O threads
+    with ThreadPoolExecutor(max_workers=execution.io_workers) as executor, \
+            create_cpu_executor(execution if photo_index is None else ExecutionSettings()) as cpu_executor:
+        if photo_index is not None:
+            for find_dir in find_dirs:
+                _find_and_copy_photo_indexed(executor=executor, executor_lock=executor_lock, result=result,
+                                             photo_index=photo_index, find_dir=find_dir, copy_dir=copy_dir,
+                                             recursive=recursive, photo_requirements=photo_requirements,
+                                             verify_decode=verify_decode, copy_engine=copy_engine,
+                                             duplicate_finder=duplicate_finder, shard=shard)
+        else:
+            _find_and_copy_photo_walk(executor=executor, executor_lock=executor_lock, result=result,
+                                      find_dirs=find_dirs, copy_dir=copy_dir,
+                                      recursive=recursive, photo_requirements=photo_requirements,
+                                      verify_decode=verify_decode, execution=execution, cpu_executor=cpu_executor,
+                                      copy_engine=copy_engine, duplicate_finder=duplicate_finder, shard=shard)
+
+    if duplicate_finder is not None:
+        # every check is finished after executors shutdown, so all found photos are collected
+        _deduplicate_and_copy(duplicate_finder=duplicate_finder, executor_lock=executor_lock, result=result,
+                              execution=execution, copy_engine=copy_engine)
 
     return result
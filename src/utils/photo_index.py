@@ -0,0 +1,408 @@
+import os
+import pathlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Union
+
+from .defaults import INDEX_FILE_NAME, default_index_path
+from .metrics import metrics
+from .photo_finder import PhotoInfo, PhotoRequirements, read_photo_info
+from .photo_info import ExifInfo
+from .sharding import Shard
+from .walker import DirectoryWalker
+import logging
+logger = logging.getLogger()
+
+
+_IndexedStat = namedtuple('_IndexedStat', ['st_size', 'st_mtime'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    is_image INTEGER NOT NULL,
+    format TEXT,
+    mode TEXT,
+    width INTEGER,
+    height INTEGER,
+    taken REAL,
+    make TEXT,
+    model TEXT,
+    latitude REAL,
+    longitude REAL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_photo ON files (is_image, format, mode, width, height);
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    partial_hash BLOB,
+    full_hash BLOB,
+    PRIMARY KEY (device, inode, size, mtime_ns)
+);
+CREATE TABLE IF NOT EXISTS perceptual_hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime_ns, kind)
+);
+'''
+# tables of hashes keyed without device in the first index versions
+_HASH_TABLES = ('hashes', 'perceptual_hashes')
+# columns added after the first index version, rows of old index are read again to fill them
+_EXIF_COLUMNS = (('taken', 'REAL'), ('make', 'TEXT'), ('model', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL'))
+
+
+@dataclass
+class PhotoIndexResult:
+    added: int = field(default=0)
+    updated: int = field(default=0)
+    unchanged: int = field(default=0)
+    removed: int = field(default=0)
+    errors: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+
+    def repr_short(self) -> str:
+        main_message = (f'Result: added={self.added}, updated={self.updated}, unchanged={self.unchanged}, '
+                        f'removed={self.removed}, warnings={len(self.warnings)}, errors={len(self.errors)}')
+        for name in ('warnings', 'errors'):
+            value = getattr(self, name)
+            if value:
+                main_message += f'\n{name.upper()}:\n' + '\n'.join(value)
+        return main_message
+
+
+class PhotoIndex:
+    """
+        On-disk SQLite index of file stat and image header data.
+        Files with unchanged size, mtime and inode are answered from the index without opening them
+    """
+    __slots__ = ['_path', '_connection', '_lock']
+
+    def __init__(self, path: pathlib.Path = None):
+        """
+            :param path: pathlib.Path - index file, default_index_path() by default
+        """
+        self._path = pathlib.Path(path) if path is not None else default_index_path()
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        import sqlite3
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = Lock()
+
+    def _migrate(self) -> None:
+        for table in _HASH_TABLES:
+            if 'device' not in {row[1] for row in self._connection.execute(f'PRAGMA table_info({table})')}:
+                # inode of old key may be of any device, so cached hashes are dropped and files are hashed again
+                with self._connection:
+                    self._connection.execute(f'DROP TABLE {table}')
+                self._connection.executescript(_SCHEMA)
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(files)')}
+        missing = [(name, column_type) for name, column_type in _EXIF_COLUMNS if name not in columns]
+        if not missing:
+            return
+        with self._connection:
+            for name, column_type in missing:
+                self._connection.execute(f'ALTER TABLE files ADD COLUMN {name} {column_type}')
+            # stat which never matches makes the next refresh read EXIF of every indexed file
+            self._connection.execute('UPDATE files SET mtime_ns = -1')
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def _key(path: Union[pathlib.Path, str]) -> str:
+        return os.path.abspath(path)
+
+    @staticmethod
+    def _subtree_range(find_dir: pathlib.Path) -> tuple:
+        prefix = os.path.join(os.path.abspath(find_dir), '')
+        return prefix, prefix + '\U0010ffff'
+
+    def refresh(self, find_dir: pathlib.Path, recursive: bool = False, skip_dir: pathlib.Path = None,
+                rebuild: bool = False, verify_decode: bool = False, shard: Shard = None) -> PhotoIndexResult:
+        """
+            Walk find_dir and read headers with EXIF fields only of new and changed files,
+            rows of deleted files and, for recursive refresh, of deleted directories are removed
+            :param find_dir: pathlib.Path - directory to index
+            :param recursive: bool - go to inner directories or not
+            :param skip_dir: pathlib.Path - directory to skip, e.g. copy_dir
+            :param rebuild: bool - read all files again even if their stat is unchanged
+            :param verify_decode: bool - decode new and changed images fully to check their integrity
+            :param shard: Shard - refresh only files of this shard, rows of other shards are kept
+            :return: PhotoIndexResult - counters, errors and warnings
+        """
+        index_result = PhotoIndexResult()
+        root = os.path.abspath(find_dir)
+        walker = DirectoryWalker(find_dir, recursive=recursive, skip_dirs=[skip_dir], with_stat=True, shard=shard,
+                                 on_error=index_result.errors.append, on_warning=index_result.warnings.append)
+        # rows of directories being walked now, rows left after the last batch of directory are deleted files
+        known_by_dir = {}
+        walked_dirs = set()
+        with ThreadPoolExecutor() as executor:
+            for batch in walker.iter_batches():
+                dir_key = str(batch.dir_path)
+                walked_dirs.add(dir_key)
+                known = known_by_dir.get(dir_key)
+                if known is None:
+                    with self._lock:
+                        known = {row[0]: tuple(row[1:]) for row in self._connection.execute(
+                            'SELECT path, size, mtime_ns, inode FROM files WHERE dir = ?', (dir_key,))}
+                    known_by_dir[dir_key] = known
+                changed = []
+                for item in batch.files:
+                    stat_key = (item.stat.st_size, item.stat.st_mtime_ns, item.stat.st_ino)
+                    known_stat = known.pop(str(item.path), None)
+                    if known_stat == stat_key and not rebuild:
+                        index_result.unchanged += 1
+                    else:
+                        changed.append((item.path, stat_key, known_stat is None))
+
+                rows = []
+                for (path, stat_key, is_new), info in zip(changed, executor.map(
+                        lambda change: self._read_info(change[0], verify_decode, index_result.warnings.append),
+                        changed)):
+                    if isinstance(info, Exception):
+                        index_result.errors.append(f'Exception error on file "{path}": {repr(info)}')
+                        continue
+                    exif = info.exif if info is not None and info.exif is not None else ExifInfo()
+                    rows.append((str(path), dir_key, *stat_key, info is not None,
+                                 *((info.format, info.mode, info.width, info.height) if info else (None,) * 4),
+                                 exif.taken, exif.make, exif.model, exif.latitude, exif.longitude))
+                    if is_new:
+                        index_result.added += 1
+                    else:
+                        index_result.updated += 1
+
+                with self._lock, self._connection:
+                    self._connection.executemany('INSERT OR REPLACE INTO files (path, dir, size, mtime_ns, inode, is_image, format, mode, width, '
+                                                 'height, taken, make, model, latitude, longitude) '
+                                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                                 rows)
+                    if batch.is_last:
+                        del known_by_dir[dir_key]
+                        if shard is not None:
+                            # files of other shards are not walked, their rows are not deleted files
+                            known = [key for key in known
+                                     if shard.contains(pathlib.PurePath(os.path.relpath(key, root)))]
+                        if known:
+                            self._connection.executemany('DELETE FROM files WHERE path = ?',
+                                                         [(key,) for key in known])
+                            index_result.removed += len(known)
+        if recursive:
+            index_result.removed += self._remove_deleted_dirs(find_dir, walked_dirs)
+        return index_result
+
+    def _remove_deleted_dirs(self, find_dir: pathlib.Path, walked_dirs: set) -> int:
+        """
+            Deleted directory is not walked, so rows of its files are not left after its last batch
+            :param find_dir: pathlib.Path - directory walked recursively
+            :param walked_dirs: set - str of walked directories
+            :return: int - number of removed rows
+        """
+        with self._lock:
+            dirs = [row[0] for row in self._connection.execute(
+                'SELECT DISTINCT dir FROM files WHERE dir > ? AND dir < ?', self._subtree_range(find_dir))]
+        # directory which exists but was not walked, e.g. because of permission error, keeps its rows
+        deleted = [(dir_key,) for dir_key in dirs if dir_key not in walked_dirs and not os.path.isdir(dir_key)]
+        if not deleted:
+            return 0
+        with self._lock, self._connection:
+            return self._connection.executemany('DELETE FROM files WHERE dir = ?', deleted).rowcount
+
+    @staticmethod
+    def _read_info(path: pathlib.Path, verify_decode: bool,
+                   on_warning: Callable[[str], None]) -> Union[PhotoInfo, Exception, None]:
+        try:
+            return read_photo_info(path, verify_decode=verify_decode, read_exif=True, on_warning=on_warning)
+        except Exception as e:
+            return e
+
+    def prune(self, find_dir: pathlib.Path = None) -> PhotoIndexResult:
+        """
+            Remove rows of files which do not exist anymore
+            :param find_dir: pathlib.Path - prune only files inside find_dir, whole index by default
+            :return: PhotoIndexResult - removed counter
+        """
+        index_result = PhotoIndexResult()
+        with self._lock:
+            if find_dir is None:
+                paths = [row[0] for row in self._connection.execute('SELECT path FROM files')]
+            else:
+                paths = [row[0] for row in self._connection.execute(
+                    'SELECT path FROM files WHERE path > ? AND path < ?', self._subtree_range(find_dir))]
+        removed = [(path,) for path in paths if not os.path.isfile(path)]
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM files WHERE path = ?', removed)
+        index_result.removed = len(removed)
+        index_result.unchanged = len(paths) - len(removed)
+        return index_result
+
+    def get_hashes(self, keys: list) -> dict:
+        """
+            :param keys: list - (device, inode, size, mtime_ns) of files
+            :return: dict - (device, inode, size, mtime_ns) => (partial hash, full hash) for files with known hashes
+        """
+        hashes = {}
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute('SELECT partial_hash, full_hash FROM hashes '
+                                               'WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                                               key).fetchone()
+                if row is not None:
+                    hashes[key] = tuple(row)
+        return hashes
+
+    def put_hashes(self, rows: list) -> None:
+        """
+            :param rows: list - (device, inode, size, mtime_ns, partial hash, full hash), unknown hash is None
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?) '
+                                         'ON CONFLICT (device, inode, size, mtime_ns) DO UPDATE SET '
+                                         'partial_hash = coalesce(excluded.partial_hash, partial_hash), '
+                                         'full_hash = coalesce(excluded.full_hash, full_hash)', rows)
+
+    def get_perceptual_hashes(self, keys: list, kind: str) -> dict:
+        """
+            :param keys: list - (device, inode, size, mtime_ns) of files, None keys are skipped
+            :param kind: str - dhash or phash
+            :return: dict - (device, inode, size, mtime_ns) => 64-bit hash for files with known hashes
+        """
+        hashes = {}
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                row = self._connection.execute('SELECT hash FROM perceptual_hashes WHERE device = ? AND inode = ? '
+                                               'AND size = ? AND mtime_ns = ? AND kind = ?',
+                                               (*key, kind)).fetchone()
+                if row is not None:
+                    # SQLite integers are signed
+                    hashes[key] = row[0] & 0xFFFFFFFFFFFFFFFF
+        return hashes
+
+    def put_perceptual_hashes(self, rows: list, kind: str) -> None:
+        """
+            :param rows: list - (device, inode, size, mtime_ns, 64-bit hash)
+            :param kind: str - dhash or phash
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO perceptual_hashes VALUES (?, ?, ?, ?, ?, ?)',
+                [(device, inode, size, mtime_ns, kind, value - (1 << 64) if value >= 1 << 63 else value)
+                 for device, inode, size, mtime_ns, value in rows])
+
+    def get(self, path: pathlib.Path) -> Union[PhotoInfo, None]:
+        """
+            :param path: pathlib.Path - file to look up
+            :return: PhotoInfo - indexed image header data or None if file is not indexed, changed or is not image
+        """
+        key = self._key(path)
+        stat = os.stat(key)
+        with self._lock:
+            row = self._connection.execute('SELECT size, mtime_ns, inode, is_image, format, mode, width, height, '
+                                           'taken, make, model, latitude, longitude '
+                                           'FROM files WHERE path = ?', (key,)).fetchone()
+        if row is None or tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ino) or not row[3]:
+            return None
+        return PhotoInfo(format=row[4], mode=row[5], width=row[6], height=row[7], exif=self._exif(row[8:]))
+
+    @staticmethod
+    def _exif(row: tuple) -> Union[ExifInfo, None]:
+        return ExifInfo(*row) if any(value is not None for value in row) else None
+
+    def query(self, find_dir: pathlib.Path, recursive: bool = False, photo_requirements: PhotoRequirements = None,
+              skip_dir: pathlib.Path = None, shard: Shard = None) -> list:
+        """
+            Find indexed photos matching requirements with one SQL query
+            :param find_dir: pathlib.Path - directory to find photos
+            :param recursive: bool - go to inner directories or not
+            :param photo_requirements: PhotoRequirements - requirement to photo to find
+            :param skip_dir: pathlib.Path - directory to exclude, e.g. copy_dir
+            :param shard: Shard - find only photos of this shard
+            :return: list - pathlib.Path of matching photos
+        """
+        with metrics.stage('index_query'):
+            paths = self._query(find_dir, recursive, photo_requirements, skip_dir)
+        if shard is None:
+            return paths
+        root = self._key(find_dir)
+        return [path for path in paths if shard.contains(pathlib.PurePath(os.path.relpath(path, root)))]
+
+    def _query(self, find_dir: pathlib.Path, recursive: bool, photo_requirements: Union[PhotoRequirements, None],
+               skip_dir: Union[pathlib.Path, None]) -> list:
+        where = ['is_image = 1']
+        params = []
+        if recursive:
+            where.append('(dir = ? OR (dir > ? AND dir < ?))')
+            params.extend((self._key(find_dir), *self._subtree_range(find_dir)))
+        else:
+            where.append('dir = ?')
+            params.append(self._key(find_dir))
+        if skip_dir is not None:
+            where.append('NOT (dir = ? OR (dir > ? AND dir < ?))')
+            params.extend((self._key(skip_dir), *self._subtree_range(skip_dir)))
+        if photo_requirements:
+            for column, values in (('mode', photo_requirements.photo_modes),
+                                   ('format', photo_requirements.photo_formats)):
+                if values:
+                    where.append(f'{column} IN ({", ".join("?" * len(values))})')
+                    params.extend(values)
+            if photo_requirements.min_photo_sizes:
+                where.append('(' + ' OR '.join('(width >= ? AND height >= ?)'
+                                               for _ in photo_requirements.min_photo_sizes) + ')')
+                for size in photo_requirements.min_photo_sizes:
+                    params.extend((size.width, size.height))
+        file_filter = photo_requirements.where if photo_requirements else None
+        exif_requirements = photo_requirements.exif_requirements if photo_requirements else None
+        if exif_requirements is not None:
+            # date and latitude ranges narrow rows in SQL, every EXIF requirement is checked after
+            for column, operation, value in (('taken', '>=', exif_requirements.taken_from),
+                                             ('taken', '<=', exif_requirements.taken_to)):
+                if value is not None:
+                    where.append(f'{column} {operation} ?')
+                    params.append(value)
+            if exif_requirements.gps_bbox is not None:
+                where.append('latitude BETWEEN ? AND ?')
+                params.extend((exif_requirements.gps_bbox[0], exif_requirements.gps_bbox[2]))
+        with self._lock:
+            rows = self._connection.execute(f'SELECT path, size, mtime_ns, format, mode, width, height, '
+                                            f'taken, make, model, latitude, longitude FROM files '
+                                            f'WHERE {" AND ".join(where)} ORDER BY path', params).fetchall()
+        if file_filter is None and exif_requirements is None:
+            return [pathlib.Path(row[0]) for row in rows]
+        # where expression and EXIF are checked with indexed data, so files are not touched
+        paths = []
+        for path, size, mtime_ns, photo_format, mode, width, height, *exif in rows:
+            path = pathlib.Path(path)
+            if file_filter is not None and not (
+                    file_filter.check_file(path, _IndexedStat(st_size=size, st_mtime=mtime_ns / 1e9)) and
+                    file_filter.check_info(PhotoInfo(format=photo_format, mode=mode, width=width, height=height))):
+                continue
+            if exif_requirements is not None and not exif_requirements.check(self._exif(exif)):
+                continue
+            paths.append(path)
+        return paths
@@ -0,0 +1,20 @@
+from dataclasses import dataclass, field
+from typing import Union
+
+
+@dataclass(frozen=True)
+class ExifInfo:
+    taken: Union[float, None] = field(default=None)
+    make: Union[str, None] = field(default=None)
+    model: Union[str, None] = field(default=None)
+    latitude: Union[float, None] = field(default=None)
+    longitude: Union[float, None] = field(default=None)
+
+
+@dataclass(frozen=True)
+class PhotoInfo:
+    format: Union[str, None] = field(default=None)
+    mode: Union[str, None] = field(default=None)
+    width: int = field(default=0)
+    height: int = field(default=0)
+    exif: Union[ExifInfo, None] = field(default=None)
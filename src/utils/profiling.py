@@ -0,0 +1,109 @@
+import pathlib
+import sys
+import threading
+from contextlib import contextmanager
+
+from .defaults import PROFILERS
+
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    """
+        Takes stacks of all threads every interval and counts them. Overhead does not depend on number of calls,
+        so hot paths are measured without cProfile slowdown. Output is collapsed stacks for flamegraph tools
+    """
+    __slots__ = ['interval', 'samples', '_stop', '_thread']
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        """
+            :param interval: float - seconds between samples
+        """
+        self.interval = interval
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({pathlib.Path(code.co_filename).name}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def write(self, path: pathlib.Path) -> None:
+        with open(path, 'w') as file:
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                file.write(f'{stack} {count}\n')
+
+
+@contextmanager
+def profile(path: pathlib.Path, profiler: str = 'cprofile', interval: float = DEFAULT_SAMPLE_INTERVAL):
+    """
+        Profile code of with block, cprofile writes pstats file (python -m pstats FILE, snakeviz),
+        sampling writes collapsed stacks (flamegraph.pl, speedscope). Only main process is profiled
+        :param path: pathlib.Path - output file
+        :param profiler: str - cprofile or sampling
+        :param interval: float - seconds between samples of sampling profiler
+    """
+    if profiler not in PROFILERS:
+        raise Exception(f'Profiler={profiler} is unknown. Supported ones are {PROFILERS}')
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
+        profilers = [cProfile.Profile()]
+        # since Python 3.12 cProfile uses sys.monitoring which sees all threads and only one profiler can be active.
+        # Before, cProfile sees only the thread which enabled it, so every new thread enables its own profiler
+        # and all of them are merged at the end
+        per_thread = sys.version_info < (3, 12)
+
+        def enable_in_thread(frame, event, arg):
+            sys.setprofile(None)
+            thread_profiler = cProfile.Profile()
+            try:
+                thread_profiler.enable()
+            except ValueError:
+                # another profiling tool is active, thread is profiled by it or not at all
+                return
+            profilers.append(thread_profiler)
+
+        if per_thread:
+            threading.setprofile(enable_in_thread)
+        profilers[0].enable()
+        try:
+            yield profilers[0]
+        finally:
+            profilers[0].disable()
+            if per_thread:
+                threading.setprofile(None)
+            stats = pstats.Stats(profilers[0])
+            for thread_profiler in profilers[1:]:
+                stats.add(thread_profiler)
+            stats.dump_stats(path)
+    else:
+        sampler = SamplingProfiler(interval)
+        sampler.start()
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            sampler.write(path)
@@ -0,0 +1,169 @@
+import csv
+import heapq
+import json
+import pathlib
+import sys
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Iterator, TextIO, Union
+from .defaults import RESULT_SINK_FORMATS
+import logging
+logger = logging.getLogger()
+
+
+RECORD_TYPES = ('found', 'copied', 'not_copied', 'duplicate', 'error', 'warning')
+
+
+@dataclass(frozen=True)
+class ResultRecord:
+    type: str
+    path: Union[str, None] = field(default=None)
+    target: Union[str, None] = field(default=None)
+    message: Union[str, None] = field(default=None)
+    time: float = field(default_factory=time.time)
+
+    def as_dict(self) -> dict:
+        return {'type': self.type, 'path': self.path, 'target': self.target, 'message': self.message,
+                'time': self.time}
+
+
+class ResultSink:
+    """
+        Receives result records as soon as they happen. Records may come from several threads
+    """
+    def __init__(self):
+        self._lock = Lock()
+
+    def write(self, record: ResultRecord) -> None:
+        with self._lock:
+            self._write(record)
+
+    def _write(self, record: ResultRecord) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CallbackResultSink(ResultSink):
+    def __init__(self, callback: Callable[[ResultRecord], None]):
+        """
+            :param callback: Callable - called with every ResultRecord
+        """
+        super().__init__()
+        self._callback = callback
+
+    def _write(self, record: ResultRecord) -> None:
+        self._callback(record)
+
+
+class _FileResultSink(ResultSink):
+    def __init__(self, file: Union[pathlib.Path, str, TextIO]):
+        """
+            :param file: pathlib.Path, str or TextIO - file to write records, '-' for stdout
+        """
+        super().__init__()
+        if isinstance(file, (str, pathlib.Path)):
+            if str(file) == '-':
+                self._file, self._own_file = sys.stdout, False
+            else:
+                # line buffering, so other tools can read records while scan is still running
+                self._file, self._own_file = open(file, 'w', encoding='utf-8', newline='', buffering=1), True
+        else:
+            self._file, self._own_file = file, False
+
+    def close(self) -> None:
+        with self._lock:
+            if self._own_file:
+                self._file.close()
+            else:
+                self._file.flush()
+
+
+class JsonLinesResultSink(_FileResultSink):
+    def _write(self, record: ResultRecord) -> None:
+        self._file.write(json.dumps(record.as_dict(), ensure_ascii=False) + '\n')
+
+
+class CsvResultSink(_FileResultSink):
+    FIELDS = ('type', 'path', 'target', 'message', 'time')
+
+    def __init__(self, file: Union[pathlib.Path, str, TextIO]):
+        super().__init__(file)
+        self._writer = csv.DictWriter(self._file, fieldnames=self.FIELDS, lineterminator='\n')
+        self._writer.writeheader()
+
+    def _write(self, record: ResultRecord) -> None:
+        self._writer.writerow(record.as_dict())
+
+
+def open_result_sink(output: Union[pathlib.Path, str], output_format: str = None) -> ResultSink:
+    """
+        :param output: pathlib.Path or str - file to write records, '-' for stdout
+        :param output_format: str - jsonl or csv, by default csv for .csv files and jsonl for others
+        :return: ResultSink - opened sink
+    """
+    if output_format is None:
+        output_format = 'csv' if str(output).lower().endswith('.csv') else 'jsonl'
+    if output_format not in RESULT_SINK_FORMATS:
+        raise Exception(f'Output format={output_format} is unknown. Supported ones are {RESULT_SINK_FORMATS}')
+    return CsvResultSink(output) if output_format == 'csv' else JsonLinesResultSink(output)
+
+
+def read_result_records(file: Union[pathlib.Path, str], input_format: str = None,
+                        on_warning: Callable[[str], None] = None) -> Iterator[ResultRecord]:
+    """
+        Read records written by result sink, broken lines (e.g. torn by interrupted run) are skipped with warning
+        :param file: pathlib.Path or str - file with records
+        :param input_format: str - jsonl or csv, by default csv for .csv files and jsonl for others
+        :param on_warning: Callable - called with warning message about broken line
+        :return: Iterator[ResultRecord] - records in file order
+    """
+    if input_format is None:
+        input_format = 'csv' if str(file).lower().endswith('.csv') else 'jsonl'
+    if input_format not in RESULT_SINK_FORMATS:
+        raise Exception(f'Input format={input_format} is unknown. Supported ones are {RESULT_SINK_FORMATS}')
+    with open(file, 'r', encoding='utf-8', newline='') as opened:
+        rows = csv.DictReader(opened) if input_format == 'csv' else opened
+        for line_number, row in enumerate(rows, start=2 if input_format == 'csv' else 1):
+            try:
+                if input_format == 'jsonl':
+                    row = json.loads(row)
+                if row['type'] not in RECORD_TYPES:
+                    raise ValueError(f'type={row["type"]}')
+                # csv has empty strings instead of nulls
+                yield ResultRecord(type=row['type'], path=row.get('path') or None, target=row.get('target') or None,
+                                   message=row.get('message') or None, time=float(row['time']))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                warning_message = f'Result file {file} line {line_number} is broken and skipped: {repr(e)}'
+                logger.warning(warning_message)
+                if on_warning is not None:
+                    on_warning(warning_message)
+
+
+def merge_result_records(files: list, input_format: str = None,
+                         on_warning: Callable[[str], None] = None) -> Iterator[ResultRecord]:
+    """
+        Merge records of several result files, e.g. of shards, by time. Files are read in parallel streams,
+        so memory does not grow with number of records. Every shard walks all directories, so warnings and errors
+        without file are kept only once
+        :param files: list - pathlib.Path or str of files with records
+        :param input_format: str - jsonl or csv, by default csv for .csv files and jsonl for others
+        :param on_warning: Callable - called with warning message about broken line
+        :return: Iterator[ResultRecord] - records of all files ordered by time
+    """
+    seen_messages = set()
+    for record in heapq.merge(*(read_result_records(file, input_format, on_warning) for file in files),
+                              key=lambda record: record.time):
+        if record.path is None and record.type in ('warning', 'error'):
+            if record.message in seen_messages:
+                continue
+            seen_messages.add(record.message)
+        yield record
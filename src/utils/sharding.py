@@ -0,0 +1,57 @@
+import pathlib
+import re
+import zlib
+from dataclasses import dataclass
+from typing import Union
+
+
+@dataclass(frozen=True)
+class Shard:
+    """
+        Slice number index of count slices of a tree. File belongs to the slice by CRC32 of its path relative
+        to find_dir, so workers with the same find_dirs and count scan disjoint slices which together cover the tree
+        and every file always goes to the same worker
+    """
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if self.count < 1 or not 0 <= self.index < self.count:
+            raise Exception(f'Shard {self.index}/{self.count} is incorrect, index must be from 0 to count - 1')
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        """
+            :param value: str - index/count, e.g. 0/4 for the first of 4 shards
+            :return: Shard - parsed shard
+        """
+        match = re.match(r'^\s*([0-9]{1,6})\s*/\s*([0-9]{1,6})\s*$', value)
+        if not match:
+            raise Exception(f'Shard "{value}" is incorrect, set it in format index/count, e.g. 0/4')
+        return cls(index=int(match.group(1)), count=int(match.group(2)))
+
+    @property
+    def name(self) -> str:
+        return f'{self.index}-of-{self.count}'
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+    def contains(self, rel_path: Union[str, pathlib.PurePath]) -> bool:
+        """
+            :param rel_path: str or pathlib.PurePath - file path relative to find_dir, str must use / separator
+            :return: bool - file belongs to this shard
+        """
+        if self.count == 1:
+            return True
+        if not isinstance(rel_path, str):
+            rel_path = rel_path.as_posix()
+        return zlib.crc32(rel_path.encode('utf-8', 'surrogateescape')) % self.count == self.index
+
+    def file_path(self, path: Union[pathlib.Path, str]) -> pathlib.Path:
+        """
+            :param path: pathlib.Path - output file shared by all shards
+            :return: pathlib.Path - output file of this shard, e.g. result.0-of-4.jsonl for result.jsonl
+        """
+        path = pathlib.Path(path)
+        return path.with_name(f'{path.stem}.{self.name}{path.suffix}')
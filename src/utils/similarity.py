@@ -0,0 +1,303 @@
+import itertools
+import math
+import operator
+import os
+import pathlib
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Union
+
+from .defaults import MAX_PERCEPTUAL_DISTANCE, PERCEPTUAL_HASHES
+from .governor import estimate_decode_memory, governor
+from .metrics import metrics
+from .photo_finder import PhotoRequirements, read_photo_info
+from .walker import DirectoryWalker
+import logging
+logger = logging.getLogger()
+
+if TYPE_CHECKING:
+    from PIL import Image
+    from .photo_index import PhotoIndex
+
+
+HASH_BITS = 64
+DEFAULT_DISTANCE = 10
+# JPEG is decoded with DCT scaling to the smallest size not less than this one
+DRAFT_SIZE = 64
+_PHASH_SIZE = 32
+_PHASH_COEFFICIENTS = 8
+_PHASH_COSINES = [[math.cos((2 * x + 1) * u * math.pi / (2 * _PHASH_SIZE)) for x in range(_PHASH_SIZE)]
+                  for u in range(_PHASH_COEFFICIENTS)]
+
+
+_CHUNK_BITS = 16
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+# int.bit_count exists since Python 3.10
+_popcount = getattr(int, 'bit_count', None) or (lambda value: bin(value).count('1'))
+
+
+def _chunk_probes(radius: int) -> list:
+    # all chunk XOR masks with at most radius bits set
+    probes = [0]
+    for bits in range(1, radius + 1):
+        probes.extend(sum(1 << bit for bit in combination)
+                      for combination in itertools.combinations(range(_CHUNK_BITS), bits))
+    return probes
+
+
+def _lane_masks(size: int) -> tuple:
+    return tuple(int.from_bytes(bytes((byte,)) * size, 'little') for byte in (0x55, 0x33, 0x0F))
+
+
+def _lane_popcounts(bits: int, masks: tuple, size: int) -> bytes:
+    # SWAR popcount of every 64-bit lane of size bytes, the lowest byte of lane gets its bit count
+    mask_1, mask_2, mask_4 = masks
+    bits -= (bits >> 1) & mask_1
+    bits = (bits & mask_2) + ((bits >> 2) & mask_2)
+    bits = (bits + (bits >> 4)) & mask_4
+    bits += bits >> 8
+    bits += bits >> 16
+    bits += bits >> 32
+    return bits.to_bytes(size, 'little')[::8]
+
+
+def _check_distance(distance: int) -> None:
+    if not 0 <= distance <= MAX_PERCEPTUAL_DISTANCE:
+        raise Exception(f'distance must be from 0 to {MAX_PERCEPTUAL_DISTANCE}')
+
+
+def _dhash(image: 'Image.Image') -> int:
+    # brightness gradient between horizontal neighbours of 9x8 image
+    from PIL import Image
+    pixels = list(image.resize((9, 8), Image.BILINEAR, reducing_gap=2.0).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+def _phash(image: 'Image.Image') -> int:
+    # low frequencies of DCT of 32x32 image compared with their median
+    from PIL import Image
+    pixels = list(image.resize((_PHASH_SIZE, _PHASH_SIZE), Image.BILINEAR, reducing_gap=2.0).getdata())
+    rows = [[sum(pixels[y * _PHASH_SIZE + x] * cosines[x] for x in range(_PHASH_SIZE)) for cosines in _PHASH_COSINES]
+            for y in range(_PHASH_SIZE)]
+    coefficients = [sum(rows[y][u] * cosines[y] for y in range(_PHASH_SIZE))
+                    for cosines in _PHASH_COSINES for u in range(_PHASH_COEFFICIENTS)]
+    # DC coefficient is average brightness, it does not take part in median
+    median = sorted(coefficients[1:])[len(coefficients) // 2 - 1]
+    value = 0
+    for coefficient in coefficients:
+        value = value << 1 | (coefficient > median)
+    return value
+
+
+def perceptual_hash(path: pathlib.Path, kind: str = 'dhash') -> int:
+    """
+        Hash of image look, resized and recompressed copies have hashes within small Hamming distance
+        :param path: pathlib.Path - image file
+        :param kind: str - dhash (gradients, faster) or phash (DCT, more robust)
+        :return: int - 64-bit hash
+    """
+    if kind not in PERCEPTUAL_HASHES:
+        raise Exception(f'Perceptual hash={kind} is unknown. Supported ones are {PERCEPTUAL_HASHES}')
+    from PIL import Image
+    with metrics.stage('perceptual_hash'):
+        with Image.open(path) as img:
+            # JPEG is decoded at 1/2, 1/4 or 1/8 scale, so full size pixels are never made
+            img.draft('L', (DRAFT_SIZE, DRAFT_SIZE))
+            gray = img.convert('L')
+        return _dhash(gray) if kind == 'dhash' else _phash(gray)
+
+
+class PerceptualHashIndex:
+    """
+        Perceptual hashes in one array of unsigned 64-bit values. Query compares hash with all hashes at once:
+        XOR and popcount run on one big integer made from the array, so cost does not grow with Python loop
+    """
+    __slots__ = ['kind', 'hashes', 'paths', '_packed', '_masks']
+
+    def __init__(self, kind: str = 'dhash'):
+        """
+            :param kind: str - dhash or phash, only hashes of one kind can be compared
+        """
+        self.kind = kind
+        self.hashes = array('Q')
+        self.paths = []
+        self._packed = None
+        self._masks = None
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, path: pathlib.Path, value: int) -> None:
+        self.hashes.append(value)
+        self.paths.append(path)
+        self._packed = None
+
+    def _pack(self) -> None:
+        if self._packed is None:
+            self._packed = int.from_bytes(self.hashes.tobytes(), 'little')
+            # masks fit all hashes, so they fit any part of them
+            self._masks = _lane_masks(len(self.hashes) * 8)
+
+    def _distances(self, value: int) -> bytes:
+        self._pack()
+        bits = self._packed ^ int.from_bytes(array('Q', (value,)).tobytes() * len(self.hashes), 'little')
+        return _lane_popcounts(bits, self._masks, len(self.hashes) * 8)
+
+    def query(self, value: int, distance: int = DEFAULT_DISTANCE) -> list:
+        """
+            :param value: int - perceptual hash of photo
+            :param distance: int - maximum Hamming distance, at most MAX_PERCEPTUAL_DISTANCE
+            :return: list - (path, distance) of photos within distance, the nearest first
+        """
+        _check_distance(distance)
+        if not self.hashes:
+            return []
+        distances = self._distances(value)
+        within = distances.translate(bytes(1 if count <= distance else 0 for count in range(256)))
+        matches = [(self.paths[match.start()], distances[match.start()]) for match in re.finditer(b'\x01', within)]
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    def clusters(self, distance: int = DEFAULT_DISTANCE) -> list:
+        """
+            Group photos linked by chains of hashes within distance. Pairs are found with multi-index hashing:
+            hash is split into 4 chunks of 16 bits and hashes within distance have at least one chunk
+            within distance // 4 bits, so only hashes from such chunk buckets are compared.
+            Hashes of a bucket are compared with all hashes of its probed buckets at once by SWAR popcount
+            :param distance: int - maximum Hamming distance between neighbours of group,
+                at most MAX_PERCEPTUAL_DISTANCE
+            :return: list - groups of at least two paths
+        """
+        _check_distance(distance)
+        by_hash = {}
+        for index, value in enumerate(self.hashes):
+            by_hash.setdefault(value, []).append(index)
+        unique = list(by_hash)
+        parents = list(range(len(unique)))
+
+        def find(node: int) -> int:
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+
+        self._pack()
+        within = bytes(1 if count <= distance else 0 for count in range(256))
+        quotient, remainder = divmod(distance, HASH_BITS // _CHUNK_BITS)
+        for number, shift in enumerate(range(0, HASH_BITS, _CHUNK_BITS)):
+            # distance of 4 * quotient + remainder bits has one of the first remainder + 1 chunks within quotient
+            # bits or one of the other chunks within quotient - 1 bits
+            radius = quotient if number <= remainder else quotient - 1
+            if radius < 0:
+                continue
+            buckets = {}
+            for node, value in enumerate(unique):
+                buckets.setdefault(value >> shift & _CHUNK_MASK, []).append(node)
+            # nodes and packed hashes of every chunk value, probed chunk values are mostly empty
+            members = [()] * (1 << _CHUNK_BITS)
+            packed = [b''] * (1 << _CHUNK_BITS)
+            for chunk, nodes in buckets.items():
+                members[chunk] = nodes
+                packed[chunk] = array('Q', map(unique.__getitem__, nodes)).tobytes()
+            probes = _chunk_probes(radius)
+            for chunk, nodes in buckets.items():
+                # pair of buckets is compared once, from the lower chunk
+                neighbours = [other for other in map(operator.xor, probes, itertools.repeat(chunk)) if other >= chunk]
+                block = b''.join(map(packed.__getitem__, neighbours))
+                block_bits = int.from_bytes(block, 'little')
+                others = None
+                for node in nodes:
+                    bits = block_bits ^ int.from_bytes(array('Q', (unique[node],)).tobytes() * (len(block) // 8),
+                                                       'little')
+                    matches = _lane_popcounts(bits, self._masks, len(block)).translate(within)
+                    # hash is always within distance of itself
+                    if matches.count(1) > 1:
+                        if others is None:
+                            others = list(itertools.chain.from_iterable(map(members.__getitem__, neighbours)))
+                        for match in re.finditer(b'\x01', matches):
+                            parents[find(others[match.start()])] = find(node)
+
+        groups = {}
+        for node, value in enumerate(unique):
+            groups.setdefault(find(node), []).extend(self.paths[index] for index in by_hash[value])
+        clusters = [sorted(paths, key=str) for paths in groups.values() if len(paths) > 1]
+        clusters.sort(key=lambda paths: str(paths[0]))
+        return clusters
+
+
+def _hash_file(path: pathlib.Path, photo_requirements: Union[PhotoRequirements, None], kind: str,
+               cached: Union[int, None]) -> tuple:
+    # (hash, error message, warning message)
+    try:
+        if photo_requirements and not photo_requirements.check_file(path):
+            return None, None, None
+        info = read_photo_info(path, read_exif=bool(photo_requirements and photo_requirements.needs_exif),
+                               photo_formats=photo_requirements.photo_formats if photo_requirements else None)
+        if info is None or (photo_requirements and not photo_requirements.check_image(info)):
+            return None, None, None
+        if cached is not None:
+            return cached, None, None
+        # hash needs pixels, so image over decode limits is not hashed, it is skipped like by sniff_image
+        reason = governor.refuse_reason(info, os.stat(path).st_size)
+        if reason is not None:
+            metrics.count('decode_refused')
+            return None, None, f'File "{str(path)}" is not hashed because {reason}'
+        with governor.reserve(estimate_decode_memory(info)):
+            return perceptual_hash(path, kind), None, None
+    except Exception as e:
+        return None, f'Exception error on file "{str(path)}": {repr(e)}', None
+
+
+def build_perceptual_index(find_dir: Union[pathlib.Path, list], recursive: bool = False,
+                           photo_requirements: PhotoRequirements = None, kind: str = 'dhash',
+                           photo_index: 'PhotoIndex' = None, workers: int = None,
+                           on_error: Callable[[str], None] = None,
+                           on_warning: Callable[[str], None] = None) -> PerceptualHashIndex:
+    """
+        Hash every photo in find_dir which matches requirements
+        :param find_dir: pathlib.Path or list - directory or directories to find photos, they are hashed into one index
+        :param recursive: bool - go to inner directories or not
+        :param photo_requirements: PhotoRequirements - requirement to photo to find
+        :param kind: str - dhash or phash
+        :param photo_index: PhotoIndex - index to keep hashes by device, inode, size and mtime between runs
+        :param workers: int - number of threads to read and hash files
+        :param on_error: Callable - called with error message
+        :param on_warning: Callable - called with warning message, e.g. for photo over decode limits which is not hashed
+        :return: PerceptualHashIndex - hashes of found photos
+    """
+    if kind not in PERCEPTUAL_HASHES:
+        raise Exception(f'Perceptual hash={kind} is unknown. Supported ones are {PERCEPTUAL_HASHES}')
+    hash_index = PerceptualHashIndex(kind)
+    find_dirs = find_dir if isinstance(find_dir, (list, tuple)) else [find_dir]
+    walkers = (DirectoryWalker(find_dir, recursive=recursive, with_stat=photo_index is not None,
+                               on_error=on_error, on_warning=on_warning) for find_dir in find_dirs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in itertools.chain.from_iterable(walker.iter_batches() for walker in walkers):
+            keys = [(item.stat.st_dev, item.stat.st_ino, item.stat.st_size, item.stat.st_mtime_ns)
+                    if item.stat else None for item in batch.files]
+            cached = photo_index.get_perceptual_hashes(keys, kind) if photo_index is not None else {}
+            computed = []
+            for item, key, (value, error_message, warning_message) in zip(batch.files, keys, executor.map(
+                    lambda args: _hash_file(args[0].path, photo_requirements, kind, cached.get(args[1])),
+                    zip(batch.files, keys))):
+                if error_message is not None:
+                    logger.error(error_message)
+                    if on_error is not None:
+                        on_error(error_message)
+                elif warning_message is not None:
+                    logger.warning(warning_message)
+                    if on_warning is not None:
+                        on_warning(warning_message)
+                elif value is not None:
+                    hash_index.add(item.path, value)
+                    if key is not None and key not in cached:
+                        computed.append((*key, value))
+            if computed:
+                photo_index.put_perceptual_hashes(computed, kind)
+    return hash_index
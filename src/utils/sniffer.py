@@ -0,0 +1,358 @@
+import dataclasses
+import functools
+import importlib
+import os
+import pathlib
+import struct
+from typing import BinaryIO, Callable, Union
+
+from .exif import read_exif_fields
+from .governor import DeadlineReader, estimate_decode_memory, governor
+from .metrics import metrics
+from .photo_info import ExifInfo, PhotoInfo
+import logging
+logger = logging.getLogger()
+
+
+HEADER_SIZE = 64 * 1024
+
+_JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+_JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+# (bit depth, color type) => mode, the same as PIL PngImagePlugin
+_PNG_MODES = {
+    (1, 0): '1', (2, 0): 'L', (4, 0): 'L', (8, 0): 'L', (16, 0): 'I',
+    (8, 2): 'RGB', (16, 2): 'RGB',
+    (1, 3): 'P', (2, 3): 'P', (4, 3): 'P', (8, 3): 'P',
+    (8, 4): 'LA', (16, 4): 'RGBA',
+    (8, 6): 'RGBA', (16, 6): 'RGBA',
+}
+# (photometric interpretation, bits per sample, extra samples) => mode, the same as PIL TiffImagePlugin
+_TIFF_MODES = {
+    (0, (1,), ()): '1', (1, (1,), ()): '1',
+    (0, (8,), ()): 'L', (1, (8,), ()): 'L',
+    (2, (8, 8, 8), ()): 'RGB',
+    (2, (8, 8, 8, 8), (0,)): 'RGBX', (2, (8, 8, 8, 8), (1,)): 'RGBA', (2, (8, 8, 8, 8), (2,)): 'RGBA',
+    (3, (4,), ()): 'P', (3, (8,), ()): 'P',
+    (5, (8, 8, 8, 8), ()): 'CMYK',
+}
+# TIFF value type => struct format and size, only BYTE, SHORT and LONG are needed
+_TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4)}
+# TIFF tag => maximum number of its values, file with more values is broken or crafted, it is not parsed
+_TIFF_MAX_COUNTS = {256: 1, 257: 1, 258: 4, 262: 1, 277: 1, 338: 4, 339: 1}
+# format => Pillow plugin module, only plugins of requested formats are imported
+_PIL_PLUGINS = {
+    'BMP': 'BmpImagePlugin', 'DDS': 'DdsImagePlugin', 'DIB': 'BmpImagePlugin', 'EPS': 'EpsImagePlugin',
+    'GIF': 'GifImagePlugin', 'ICNS': 'IcnsImagePlugin', 'ICO': 'IcoImagePlugin', 'IM': 'ImImagePlugin',
+    'JPEG': 'JpegImagePlugin', 'MSP': 'MspImagePlugin', 'PCX': 'PcxImagePlugin', 'PNG': 'PngImagePlugin',
+    'PPM': 'PpmImagePlugin', 'SGI': 'SgiImagePlugin', 'SPIDER': 'SpiderImagePlugin', 'TGA': 'TgaImagePlugin',
+    'TIFF': 'TiffImagePlugin', 'WEBP': 'WebPImagePlugin', 'XBM': 'XbmImagePlugin',
+}
+
+
+class _HeaderReader:
+    """
+        Reads from header buffer and from opened file only if requested bytes are beyond the buffer.
+        Read from file is bounded by file size, so size taken from broken header does not allocate memory for it
+    """
+    __slots__ = ['header', '_file', '_file_size']
+
+    def __init__(self, header: bytes, file: BinaryIO = None):
+        self.header = header
+        self._file = file
+        self._file_size = None
+
+    def read(self, offset: int, size: int) -> bytes:
+        if offset + size <= len(self.header) or self._file is None:
+            return self.header[offset:offset + size]
+        if self._file_size is None:
+            self._file_size = self._file.seek(0, os.SEEK_END)
+        size = min(size, self._file_size - offset)
+        if size <= 0:
+            return b''
+        self._file.seek(offset)
+        return self._file.read(size)
+
+
+def _parse_jpeg(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    offset = 2
+    while True:
+        marker = reader.read(offset, 2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            offset += 1
+            continue
+        marker = marker[1]
+        offset += 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            return None
+        length_data = reader.read(offset, 2)
+        if len(length_data) < 2:
+            return None
+        length = struct.unpack('>H', length_data)[0]
+        if marker == 0xE2 and reader.read(offset + 2, 4) == b'MPF\x00':
+            # PIL opens JPEG with multi-picture data as MPO format
+            return None
+        if marker in _JPEG_SOF_MARKERS:
+            data = reader.read(offset + 2, 6)
+            if len(data) < 6:
+                return None
+            height, width, layers = struct.unpack('>HHB', data[1:6])
+            mode = _JPEG_MODES.get(layers)
+            return PhotoInfo(format='JPEG', mode=mode, width=width, height=height) if mode else None
+        offset += length
+
+
+def _parse_png(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    data = reader.read(8, 19)
+    if len(data) < 19 or data[4:8] != b'IHDR':
+        return None
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', data[8:18])
+    mode = _PNG_MODES.get((bit_depth, color_type))
+    return PhotoInfo(format='PNG', mode=mode, width=width, height=height) if mode else None
+
+
+def _is_gif_palette_needed(palette: bytes) -> bool:
+    # the same as GifImageFile._is_palette_needed, grayscale identity palette gives L mode
+    for index in range(0, len(palette), 3):
+        if not (index // 3 == palette[index] == palette[index + 1] == palette[index + 2]):
+            return True
+    return False
+
+
+def _parse_gif(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    header = reader.header
+    if len(header) < 13:
+        return None
+    width, height, flags = struct.unpack('<HHB', header[6:11])
+    offset = 13
+    palette_needed = False
+    if flags & 0x80:
+        size = 3 << ((flags & 7) + 1)
+        palette_needed = _is_gif_palette_needed(header[offset:offset + size])
+        offset += size
+    # mode depends on palette of the first frame, which is the local one if it exists
+    while offset < len(header):
+        block = header[offset]
+        if block == 0x21:
+            offset += 2
+            while offset < len(header) and header[offset]:
+                offset += header[offset] + 1
+            offset += 1
+        elif block == 0x2C:
+            if offset + 10 > len(header):
+                return None
+            local_flags = header[offset + 9]
+            if local_flags & 0x80:
+                size = 3 << ((local_flags & 7) + 1)
+                if offset + 10 + size > len(header):
+                    return None
+                palette_needed = _is_gif_palette_needed(header[offset + 10:offset + 10 + size])
+            return PhotoInfo(format='GIF', mode='P' if palette_needed else 'L', width=width, height=height)
+        else:
+            return None
+    return None
+
+
+def _parse_bmp(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    data = reader.read(14, 26)
+    if len(data) < 26:
+        return None
+    header_size = struct.unpack('<I', data[:4])[0]
+    if header_size < 40:
+        return None
+    width, height, _, bits, compression = struct.unpack('<iiHHI', data[4:20])
+    # paletted and bitfields images need more data to get mode
+    if compression != 0 or bits not in (16, 24, 32):
+        return None
+    return PhotoInfo(format='BMP', mode='RGB', width=width, height=abs(height))
+
+
+def _parse_webp(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    data = reader.read(12, 18)
+    if len(data) < 18:
+        return None
+    chunk = data[:4]
+    if chunk == b'VP8 ':
+        if data[11:14] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', data[14:18])
+        return PhotoInfo(format='WEBP', mode='RGB', width=width & 0x3FFF, height=height & 0x3FFF)
+    if chunk == b'VP8L':
+        if data[8] != 0x2F:
+            return None
+        bits = struct.unpack('<I', data[9:13])[0]
+        return PhotoInfo(format='WEBP', mode='RGBA' if bits >> 28 & 1 else 'RGB',
+                         width=(bits & 0x3FFF) + 1, height=(bits >> 14 & 0x3FFF) + 1)
+    if chunk == b'VP8X':
+        data = reader.read(20, 10)
+        if len(data) < 10:
+            return None
+        width = int.from_bytes(data[4:7], 'little') + 1
+        height = int.from_bytes(data[7:10], 'little') + 1
+        return PhotoInfo(format='WEBP', mode='RGBA' if data[0] & 0x10 else 'RGB', width=width, height=height)
+    return None
+
+
+def _parse_tiff(reader: _HeaderReader) -> Union[PhotoInfo, None]:
+    order = '<' if reader.header[:2] == b'II' else '>'
+    data = reader.read(4, 4)
+    if len(data) < 4:
+        return None
+    ifd_offset = struct.unpack(f'{order}I', data)[0]
+    count_data = reader.read(ifd_offset, 2)
+    if len(count_data) < 2:
+        return None
+    count = struct.unpack(f'{order}H', count_data)[0]
+    entries = reader.read(ifd_offset + 2, count * 12)
+    if len(entries) < count * 12:
+        return None
+    tags = {}
+    for index in range(count):
+        tag, value_type, value_count = struct.unpack(f'{order}HHI', entries[index * 12:index * 12 + 8])
+        if tag not in _TIFF_MAX_COUNTS or value_type not in _TIFF_TYPES:
+            continue
+        if not 0 < value_count <= _TIFF_MAX_COUNTS[tag]:
+            return None
+        value_format, value_size = _TIFF_TYPES[value_type]
+        value_data = entries[index * 12 + 8:index * 12 + 12]
+        if value_size * value_count > 4:
+            value_data = reader.read(struct.unpack(f'{order}I', value_data)[0], value_size * value_count)
+        else:
+            value_data = value_data[:value_size * value_count]
+        if len(value_data) < value_size * value_count:
+            return None
+        tags[tag] = struct.unpack(f'{order}{value_count}{value_format}', value_data)
+    if 256 not in tags or 257 not in tags or tags.get(339, (1,))[0] != 1:
+        return None
+    samples = tags.get(277, (1,))[0]
+    bits = tags.get(258, (1,))
+    if len(bits) == 1 and samples > 1:
+        bits = bits * samples
+    mode = _TIFF_MODES.get((tags.get(262, (None,))[0], bits, tags.get(338, ())))
+    return PhotoInfo(format='TIFF', mode=mode, width=tags[256][0], height=tags[257][0]) if mode else None
+
+
+def parse_header(header: bytes, file: BinaryIO = None) -> Union[PhotoInfo, None]:
+    """
+        Get format, mode and size of JPEG, PNG, GIF, BMP, WEBP and TIFF images without PIL
+        :param header: bytes - first bytes of file
+        :param file: BinaryIO - opened file to read data beyond header if needed
+        :return: PhotoInfo - image header data or None if format is not supported or data is not enough to get it
+    """
+    reader = _HeaderReader(header, file)
+    try:
+        if header[:3] == b'\xff\xd8\xff':
+            return _parse_jpeg(reader)
+        if header[:8] == b'\x89PNG\r\n\x1a\n':
+            return _parse_png(reader)
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return _parse_gif(reader)
+        if header[:2] == b'BM':
+            return _parse_bmp(reader)
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return _parse_webp(reader)
+        if header[:4] in (b'II*\x00', b'MM\x00*'):
+            return _parse_tiff(reader)
+    except struct.error:
+        return None
+    return None
+
+
+def parse_exif(header: bytes, file: BinaryIO = None) -> Union[ExifInfo, None]:
+    """
+        Get date taken, camera and GPS position from EXIF of JPEG, PNG and TIFF images without PIL
+        :param header: bytes - first bytes of file
+        :param file: BinaryIO - opened file to read data beyond header if needed
+        :return: ExifInfo - EXIF fields or None if image has no EXIF
+    """
+    return read_exif_fields(_HeaderReader(header, file))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_plugins(photo_formats: frozenset) -> tuple:
+    # Image.open loads every plugin of Pillow for a format it does not know, so plugins are imported before
+    from PIL import Image
+    for photo_format in photo_formats:
+        importlib.import_module(f'PIL.{_PIL_PLUGINS[photo_format]}')
+    # formats are tried in Pillow registration order, formats with weak header checks like TGA are the last
+    return tuple(photo_format for photo_format in Image.ID if photo_format in photo_formats)
+
+
+def _has_signature(header: bytes, photo_formats: tuple) -> bool:
+    # the same header checks Pillow makes before it opens image, formats without them like TGA have no signature
+    from PIL import Image
+    return any(Image.OPEN[photo_format][1] is not None and Image.OPEN[photo_format][1](header)
+               for photo_format in photo_formats)
+
+
+def _is_decode_refused(path: pathlib.Path, info: PhotoInfo, file: BinaryIO,
+                       on_warning: Union[Callable[[str], None], None]) -> bool:
+    reason = governor.refuse_reason(info, os.fstat(file.fileno()).st_size)
+    if reason is None:
+        return False
+    warning_message = f'File "{path}" is not decoded because {reason}, only its header is checked'
+    logger.warning(warning_message)
+    metrics.count('decode_refused')
+    if on_warning is not None:
+        on_warning(warning_message)
+    return True
+
+
+def sniff_image(path: pathlib.Path, verify_decode: bool = False, read_exif: bool = False,
+                photo_formats: Union[set, frozenset, None] = None,
+                on_warning: Callable[[str], None] = None) -> Union[PhotoInfo, None]:
+    """
+        Open file once and read one header buffer to decide if file is image and to get its format, mode and size.
+        PIL reads the same opened file only if format is not supported by parse_header
+        :param path: pathlib.Path - file to read
+        :param verify_decode: bool - decode image fully with PIL to check its integrity. Image over limits of
+            governor is checked by header only, decode waits for memory budget and stops after timeout
+        :param read_exif: bool - read EXIF fields too, they are parsed from the same header buffer
+        :param photo_formats: set - formats PIL tries, only their plugins are loaded. Other images are not opened
+            and None is returned for them, file with signature of these formats which PIL can not open is an error.
+            Any format by default
+        :param on_warning: Callable - called with warning message if image is not decoded because of limits
+        :return: PhotoInfo - image header data or None if file is not image
+    """
+    with open(path, 'rb') as file:
+        with metrics.stage('read_header'):
+            header = file.read(HEADER_SIZE)
+        with metrics.stage('parse_header'):
+            info = parse_header(header, file)
+        # header is parsed before decode too, so image over limits is never opened by Pillow
+        if verify_decode and info is not None and _is_decode_refused(path, info, file, on_warning):
+            verify_decode = False
+        if info is None or verify_decode:
+            # Pillow and filetype are imported by the first image parse_header does not support
+            import filetype
+            from PIL import Image, UnidentifiedImageError
+            if not filetype.is_image(header):
+                return None
+            file.seek(0)
+            # decoders read file by chunks, so reader stops decode after timeout
+            source = DeadlineReader(file) if verify_decode else file
+            with metrics.stage('pil_open'):
+                if photo_formats:
+                    formats = _load_plugins(frozenset(photo_formats))
+                    try:
+                        img = Image.open(source, formats=formats)
+                    except UnidentifiedImageError:
+                        # image of other format is skipped, image with signature of requested format is corrupt
+                        if not _has_signature(header, formats):
+                            return None
+                        raise
+                else:
+                    img = Image.open(source)
+            with img:
+                info = PhotoInfo(format=img.format, mode=img.mode, width=img.width, height=img.height)
+                if verify_decode and not _is_decode_refused(path, info, file, on_warning):
+                    with governor.reserve(estimate_decode_memory(info)), metrics.stage('decode'):
+                        source.start(governor.limits.timeout)
+                        img.load()
+        if read_exif:
+            with metrics.stage('exif'):
+                info = dataclasses.replace(info, exif=parse_exif(header, file))
+        return info
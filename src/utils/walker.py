@@ -0,0 +1,208 @@
+import os
+import pathlib
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Union
+
+from .metrics import metrics
+from .sharding import Shard
+
+import logging
+logger = logging.getLogger()
+
+
+DEFAULT_WALK_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_BATCH_SIZE = 256
+
+
+@dataclass
+class WalkItem:
+    path: pathlib.Path
+    rel_dir: pathlib.PurePath
+    stat: Union[os.stat_result, None] = field(default=None)
+
+
+@dataclass
+class WalkBatch:
+    dir_path: pathlib.Path
+    rel_dir: pathlib.PurePath
+    files: list = field(default_factory=list)
+    is_last: bool = field(default=True)
+
+
+@dataclass(frozen=True)
+class _WalkMessage:
+    is_error: bool
+    message: str
+
+
+class DirectoryWalker:
+    """
+        Walks directory tree with os.scandir in several threads and streams files to one consumer.
+        File type is taken from DirEntry, so no extra stat call is needed per entry. Files are passed to consumer
+        through bounded queue, so walk threads wait while consumer is busy and memory does not grow with tree size
+    """
+    __slots__ = ['_root', '_recursive', '_skip_dirs', '_workers', '_max_queue', '_batch_size', '_with_stat',
+                 '_shard', '_on_error', '_on_warning']
+
+    def __init__(self, root: pathlib.Path, recursive: bool = False, skip_dirs: list = None, workers: int = None,
+                 max_queue: int = DEFAULT_MAX_QUEUE, batch_size: int = DEFAULT_BATCH_SIZE, with_stat: bool = False,
+                 shard: Shard = None, on_error: Callable[[str], None] = None, on_warning: Callable[[str], None] = None):
+        """
+            :param root: pathlib.Path - directory to walk
+            :param recursive: bool - go to inner directories or not
+            :param skip_dirs: list - directories to skip with warning, e.g. copy_dir
+            :param workers: int - number of threads scanning directories concurrently
+            :param max_queue: int - maximum number of file batches waiting for consumer
+            :param batch_size: int - maximum number of files in one batch
+            :param with_stat: bool - stat files in walk threads and pass stat_result in WalkItem
+            :param shard: Shard - yield only files of this shard, all directories are still walked
+            :param on_error: Callable - called in consumer thread with error message
+            :param on_warning: Callable - called in consumer thread with warning message
+        """
+        self._root = pathlib.Path(os.path.abspath(root))
+        self._recursive = recursive
+        self._skip_dirs = {os.path.abspath(skip_dir) for skip_dir in skip_dirs or () if skip_dir is not None}
+        self._workers = max(1, workers or DEFAULT_WALK_WORKERS)
+        self._max_queue = max(1, max_queue)
+        self._batch_size = max(1, batch_size)
+        self._with_stat = with_stat
+        self._shard = shard
+        self._on_error = on_error
+        self._on_warning = on_warning
+
+    def __iter__(self) -> Iterator[WalkItem]:
+        for batch in self.iter_batches():
+            yield from batch.files
+
+    def iter_batches(self) -> Iterator[WalkBatch]:
+        """
+            :return: Iterator[WalkBatch] - batches of files, all batches of one directory are yielded in order,
+                the last one has is_last=True
+        """
+        out_queue = queue.Queue(maxsize=self._max_queue)
+        dir_queue = queue.SimpleQueue()
+        stop = threading.Event()
+        pending_lock = threading.Lock()
+        pending = [1]
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def finish_dir():
+            with pending_lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                for _ in range(self._workers):
+                    dir_queue.put(None)
+                put(None)
+
+        def worker():
+            while True:
+                task = dir_queue.get()
+                if task is None or stop.is_set():
+                    return
+                try:
+                    self._scan_dir(*task, dir_queue=dir_queue, pending=pending, pending_lock=pending_lock, put=put)
+                except Exception as e:
+                    put(_WalkMessage(is_error=True, message=f'Exception error on directory "{task[0]}": {repr(e)}'))
+                finally:
+                    finish_dir()
+
+        if str(self._root) in self._skip_dirs:
+            self._warning(f'find_dir "{self._root}" and copy_dir are the same, find_dir will be skipped')
+            return
+
+        dir_queue.put((self._root, pathlib.PurePath()))
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self._workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, _WalkMessage):
+                    if item.is_error:
+                        self._error(item.message)
+                    else:
+                        self._warning(item.message)
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for _ in range(self._workers):
+                dir_queue.put(None)
+
+    def _scan_dir(self, dir_path: pathlib.Path, rel_dir: pathlib.PurePath, dir_queue: queue.SimpleQueue,
+                  pending: list, pending_lock: threading.Lock, put: Callable) -> None:
+        logger.info('In directory %s', dir_path)
+        # time blocked on full queue is waiting for consumer, it is not counted as walk time
+        start = time.perf_counter()
+        blocked = 0.0
+        count = 0
+        files = []
+        shard = self._shard
+        # relative path of file is built from string prefix, so shard check does not create PurePath per file
+        rel_prefix = rel_dir.as_posix() + '/' if shard is not None and rel_dir.parts else ''
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not self._recursive:
+                            continue
+                        if entry.path in self._skip_dirs:
+                            put(_WalkMessage(is_error=False, message=f'Directory "{entry.path}" and copy_dir are the '
+                                                                     f'same, this directory will be skipped'))
+                            continue
+                        if entry.is_symlink() and self._is_loop(entry.path, dir_path):
+                            put(_WalkMessage(is_error=False, message=f'Directory "{entry.path}" is symlink to its '
+                                                                     f'parent, this directory will be skipped'))
+                            continue
+                        with pending_lock:
+                            pending[0] += 1
+                        dir_queue.put((pathlib.Path(entry.path), rel_dir.joinpath(entry.name)))
+                    elif entry.is_file():
+                        if shard is not None and not shard.contains(rel_prefix + entry.name):
+                            continue
+                        files.append(WalkItem(path=pathlib.Path(entry.path), rel_dir=rel_dir,
+                                              stat=entry.stat() if self._with_stat else None))
+                        if len(files) >= self._batch_size:
+                            count += len(files)
+                            put_start = time.perf_counter()
+                            put(WalkBatch(dir_path=dir_path, rel_dir=rel_dir, files=files, is_last=False))
+                            blocked += time.perf_counter() - put_start
+                            files = []
+                except OSError as e:
+                    put(_WalkMessage(is_error=True, message=f'Exception error on file "{entry.path}": {repr(e)}'))
+        if metrics.enabled:
+            metrics.observe('walk', time.perf_counter() - start - blocked)
+            metrics.count('directories')
+            metrics.count('files', count + len(files))
+        put(WalkBatch(dir_path=dir_path, rel_dir=rel_dir, files=files, is_last=True))
+
+    @staticmethod
+    def _is_loop(link_path: str, parent_dir: pathlib.Path) -> bool:
+        target = os.path.realpath(link_path)
+        parent = os.path.realpath(parent_dir)
+        return parent == target or parent.startswith(os.path.join(target, ''))
+
+    def _error(self, message: str) -> None:
+        logger.error(message)
+        if self._on_error is not None:
+            self._on_error(message)
+
+    def _warning(self, message: str) -> None:
+        logger.warning(message)
+        if self._on_warning is not None:
+            self._on_warning(message)
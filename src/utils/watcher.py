@@ -0,0 +1,374 @@
+import errno
+import os
+import pathlib
+import select
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Callable, Union
+
+from .copy_engine import CopyEngine
+from .defaults import WATCH_BACKENDS
+from .metrics import Histogram
+from .photo_finder import FindCopyPhotoResult, PhotoRequirements, check_image_file_and_copy
+from .walker import DirectoryWalker
+import logging
+logger = logging.getLogger()
+
+
+# file is checked when it was not changed for this number of seconds, so partially written files are skipped
+DEFAULT_SETTLE = 2.0
+DEFAULT_POLL_INTERVAL = 5.0
+# inotify knows files which are still open for writing, they are checked after close or this long pause
+OPEN_FILE_SETTLE = 60.0
+# temporary names of sync clients and browsers, file is checked after it is renamed to the final name
+PARTIAL_SUFFIXES = ('.part', '.partial', '.tmp', '.crdownload', '.download', '.!sync', '.filepart')
+
+# inotify constants from sys/inotify.h
+_IN_MODIFY, _IN_CLOSE_WRITE, _IN_MOVED_TO, _IN_CREATE = 0x2, 0x8, 0x80, 0x100
+_IN_Q_OVERFLOW, _IN_IGNORED, _IN_ISDIR = 0x4000, 0x8000, 0x40000000
+_IN_NONBLOCK, _IN_CLOEXEC = 0o4000, 0o2000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def is_partial_file(path: pathlib.Path) -> bool:
+    """
+        :param path: pathlib.Path - file to check
+        :return: bool - file name is temporary name of file being written
+    """
+    return path.name.startswith('.syncthing.') or path.suffix.lower() in PARTIAL_SUFFIXES
+
+
+class WatchStats:
+    """
+        Latency from file arrival to the end of its check and copy. Arrival is inotify event time,
+        polling takes file ctime bounded by time of the previous scan. Latencies are kept in histogram,
+        so memory and report time do not grow while watch runs
+    """
+    __slots__ = ['histogram', '_lock']
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self._lock = Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self.histogram.add(latency)
+
+    def percentile(self, percent: float) -> float:
+        """
+            :param percent: float - from 0 to 100
+            :return: float - upper bound of histogram bucket with the percentile, max for the last bucket
+        """
+        with self._lock:
+            return self.histogram.percentile(percent)
+
+    def repr_short(self) -> str:
+        if not self.histogram.count:
+            return 'Watch latency: no files were checked'
+        return (f'Watch latency: p50={self.percentile(50):.2f} s, p95={self.percentile(95):.2f} s, '
+                f'max={self.histogram.max:.2f} s ({self.histogram.count} files)')
+
+
+class _InotifySource:
+    """
+        Linux inotify through libc, every directory of tree has its own watch. Process sleeps in select
+        until some event happens, so idle watch takes no CPU
+    """
+    def __init__(self, root: pathlib.Path, recursive: bool, skip_dirs: set, on_warning: Callable[[str], None]):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is supported only on Linux')
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._recursive = recursive
+        self._skip_dirs = skip_dirs
+        self._on_warning = on_warning
+        self._dirs = {}
+        self.add_tree(root)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def add_tree(self, directory: pathlib.Path) -> list:
+        """
+            Watch directory and its inner directories
+            :return: list - files which already exist there, they could be written before watch was added
+        """
+        files = []
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            if str(directory) in self._skip_dirs:
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+            if wd < 0:
+                import ctypes
+                self._on_warning(f'Directory "{directory}" is not watched: {os.strerror(ctypes.get_errno())}')
+                continue
+            self._dirs[wd] = directory
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self._recursive:
+                                directories.append(pathlib.Path(entry.path))
+                        elif entry.is_file():
+                            files.append(pathlib.Path(entry.path))
+            except OSError as e:
+                self._on_warning(f'Directory "{directory}" is not read: {repr(e)}')
+        return files
+
+    def read(self) -> tuple:
+        """
+            :return: tuple - (path, is open for writing) of changed files and whether events were lost by overflow
+        """
+        changed = []
+        overflow = False
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return changed, overflow
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\x00')
+            offset += _EVENT.size + length
+            if mask & _IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self._dirs.get(wd)
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if directory is None or not name:
+                continue
+            path = directory.joinpath(os.fsdecode(name))
+            if mask & _IN_ISDIR:
+                if self._recursive and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    changed.extend((file_path, False) for file_path in self.add_tree(path))
+            else:
+                changed.append((path, not mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO)))
+        return changed, overflow
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class _PollingSource:
+    """
+        Fallback for systems without inotify: directory tree is walked every poll interval and stat of files is
+        compared with the previous walk
+    """
+    def __init__(self, root: pathlib.Path, recursive: bool, skip_dirs: set, on_warning: Callable[[str], None]):
+        self._walker = DirectoryWalker(root, recursive=recursive, skip_dirs=list(skip_dirs), with_stat=True,
+                                       on_warning=on_warning, on_error=on_warning)
+        self._scanned = time.time()
+        self._stats = self._scan()
+
+    def _scan(self) -> dict:
+        return {item.path: (item.stat.st_size, item.stat.st_mtime_ns, item.stat.st_ctime) for item in self._walker}
+
+    def read(self) -> list:
+        """
+            :return: list - (path, arrival time) of new and changed files
+        """
+        previous_scan = self._scanned
+        self._scanned = time.time()
+        stats = self._scan()
+        changed = [(path, max(stat[2], previous_scan)) for path, stat in stats.items()
+                   if self._stats.get(path, (None, None))[:2] != stat[:2]]
+        self._stats = stats
+        return changed
+
+
+class PhotoWatcher:
+    """
+        Event-driven search and copy: only new and changed files of find_dir are checked, each of them once it was
+        not changed for settle seconds
+    """
+    def __init__(self, find_dir: pathlib.Path, copy_dir: pathlib.Path = None, recursive: bool = False,
+                 photo_requirements: PhotoRequirements = None, verify_decode: bool = False,
+                 copy_engine: CopyEngine = None, backend: str = 'auto', settle: float = DEFAULT_SETTLE,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, workers: int = None,
+                 result: FindCopyPhotoResult = None):
+        """
+            :param find_dir: pathlib.Path - directory to watch
+            :param copy_dir: pathlib.Path - directory to copy found photos, only search if None
+            :param recursive: bool - watch inner directories too
+            :param photo_requirements: PhotoRequirements - requirement to photo to find
+            :param verify_decode: bool - decode every image fully to check its integrity
+            :param copy_engine: CopyEngine - copy method and created directories cache
+            :param backend: str - inotify, polling or auto (inotify if it is available)
+            :param settle: float - seconds without changes before file is checked
+            :param poll_interval: float - seconds between walks of polling backend
+            :param workers: int - number of threads to check and copy files
+            :param result: FindCopyPhotoResult - result for all
+        """
+        if backend not in WATCH_BACKENDS:
+            raise Exception(f'Watch backend={backend} is unknown. Supported ones are {WATCH_BACKENDS}')
+        self.find_dir = pathlib.Path(os.path.abspath(find_dir))
+        self.copy_dir = pathlib.Path(os.path.abspath(copy_dir)) if copy_dir is not None else None
+        self.recursive = recursive
+        self.photo_requirements = photo_requirements
+        self.verify_decode = verify_decode
+        self.copy_engine = copy_engine if copy_engine is not None else CopyEngine()
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.result = result if result is not None else FindCopyPhotoResult()
+        self.stats = WatchStats()
+        self._backend = backend
+        self._lock = Lock()
+        self._stop = Event()
+        # inotify backend sleeps in select, stop wakes it through this pipe
+        self._wake = None
+        # path => (arrival time, time of the last change, stat at the last look, is open for writing)
+        self._pending = {}
+        self._overflow_since = time.time()
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    def stop(self) -> None:
+        """
+            Stop run from other thread or signal handler
+        """
+        self._stop.set()
+        if self._wake is not None:
+            os.write(self._wake[1], b'\x00')
+
+    def _add_warning(self, message: str) -> None:
+        with self._lock:
+            self.result.add_warning(message)
+        logger.warning(message)
+
+    def _open_source(self) -> Union[_InotifySource, _PollingSource]:
+        skip_dirs = {str(self.copy_dir)} if self.copy_dir is not None else set()
+        if self._backend in ('auto', 'inotify'):
+            try:
+                source = _InotifySource(self.find_dir, self.recursive, skip_dirs, self._add_warning)
+                self._backend = 'inotify'
+                return source
+            except (OSError, AttributeError) as e:
+                if self._backend == 'inotify':
+                    raise
+                logger.info(f'inotify is not available ({repr(e)}), polling is used')
+        self._backend = 'polling'
+        return _PollingSource(self.find_dir, self.recursive, skip_dirs, self._add_warning)
+
+    def _is_skipped(self, path: pathlib.Path) -> bool:
+        if is_partial_file(path):
+            return True
+        return self.copy_dir is not None and (path.parent == self.copy_dir or self.copy_dir in path.parents)
+
+    def _touch(self, path: pathlib.Path, arrival: float, is_open: bool = False) -> None:
+        if self._is_skipped(path):
+            return
+        known = self._pending.get(path)
+        self._pending[path] = (known[0] if known else arrival, time.monotonic(), known[2] if known else None,
+                               is_open)
+
+    def _ready(self) -> list:
+        # file is ready when settle time passed since its last event and its size and mtime did not change meanwhile,
+        # file seen for the first time is ready at once only if its mtime is settle seconds old
+        now = time.monotonic()
+        ready = []
+        for path, (arrival, changed, last_stat, is_open) in list(self._pending.items()):
+            if now - changed < self._settle(is_open):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            stat_key = (stat.st_size, stat.st_mtime_ns)
+            if stat_key == last_stat or (last_stat is None and time.time() - stat.st_mtime >= self.settle):
+                del self._pending[path]
+                ready.append((path, arrival))
+            else:
+                self._pending[path] = (arrival, now, stat_key, is_open)
+        return ready
+
+    def _settle(self, is_open: bool) -> float:
+        return max(self.settle, OPEN_FILE_SETTLE) if is_open else self.settle
+
+    def _timeout(self, next_poll: Union[float, None]) -> Union[float, None]:
+        # without pending files inotify backend sleeps until event, polling one until the next walk
+        deadlines = [changed + self._settle(is_open) for _, changed, _, is_open in self._pending.values()]
+        if next_poll is not None:
+            deadlines.append(next_poll)
+        return max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+
+    def _check(self, path: pathlib.Path, arrival: float) -> None:
+        copy_dir = None
+        if self.copy_dir is not None:
+            copy_dir = self.copy_dir.joinpath(path.parent.relative_to(self.find_dir))
+        try:
+            if not self.photo_requirements or self.photo_requirements.check_file(path):
+                check_image_file_and_copy(path=path, executor_lock=self._lock, result=self.result,
+                                          photo_requirements=self.photo_requirements, copy_dir=copy_dir,
+                                          verify_decode=self.verify_decode, copy_engine=self.copy_engine)
+        finally:
+            latency = time.time() - arrival
+            self.stats.add(latency)
+            logger.info('File %s was checked %.2f s after arrival', path, latency)
+
+    def _read_events(self, source: _InotifySource) -> None:
+        changed, overflow = source.read()
+        now = time.time()
+        for path, is_open in changed:
+            self._touch(path, now, is_open)
+        if overflow:
+            # lost events are replaced by walk, files changed since the last settled one are checked again
+            self._add_warning(f'inotify queue overflow in "{self.find_dir}", changed files are found by walk')
+            for item in DirectoryWalker(self.find_dir, recursive=self.recursive, skip_dirs=[self.copy_dir],
+                                        with_stat=True, on_warning=self._add_warning, on_error=self._add_warning):
+                if item.stat.st_ctime >= self._overflow_since:
+                    self._touch(item.path, item.stat.st_ctime)
+        self._overflow_since = now - self.settle
+
+    def run(self, on_ready: Callable[[], None] = None) -> FindCopyPhotoResult:
+        """
+            Watch until stop is called or KeyboardInterrupt
+            :param on_ready: Callable - called when watches are set, files written after that are not missed
+            :return: FindCopyPhotoResult - found and copied photos, warnings and errors
+        """
+        source = self._open_source()
+        next_poll = time.monotonic() + self.poll_interval if self._backend == 'polling' else None
+        if next_poll is None:
+            self._wake = os.pipe()
+        try:
+            if on_ready is not None:
+                on_ready()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while not self._stop.is_set():
+                    if next_poll is None:
+                        readable, _, _ = select.select([source.fileno(), self._wake[0]], [], [],
+                                                       self._timeout(next_poll))
+                        if source.fileno() in readable:
+                            self._read_events(source)
+                    elif not self._stop.wait(self._timeout(next_poll)) and time.monotonic() >= next_poll:
+                        for path, arrival in source.read():
+                            self._touch(path, arrival)
+                        next_poll = time.monotonic() + self.poll_interval
+                    for path, arrival in self._ready():
+                        executor.submit(self._check, path, arrival)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if isinstance(source, _InotifySource):
+                source.close()
+            if self._wake is not None:
+                wake, self._wake = self._wake, None
+                os.close(wake[0])
+                os.close(wake[1])
+        return self.result
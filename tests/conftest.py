@@ -0,0 +1,62 @@
+import pathlib
+
+import pytest
+
+from utils import ResourceLimits, governor, metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_process_state():
+    # governor and metrics are one per process, every test starts with defaults
+    governor.configure(ResourceLimits())
+    metrics.disable()
+    yield
+    governor.configure(ResourceLimits())
+    metrics.disable()
+
+
+@pytest.fixture
+def make_image():
+    """
+        :return: Callable - make_image(path, size=(64, 48), mode='RGB', image_format=None, **params) saves image
+            with noise pixels and returns its path, format is taken from extension by default
+    """
+    from PIL import Image
+
+    def make(path: pathlib.Path, size: tuple = (64, 48), mode: str = 'RGB', image_format: str = None,
+             **params) -> pathlib.Path:
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        image = Image.effect_noise(size, 64).convert(mode)
+        image.save(path, format=image_format, **params)
+        return path
+
+    return make
+
+
+@pytest.fixture
+def truncate():
+    """
+        :return: Callable - truncate(path, keep=0.5) cuts the end of file, header stays readable
+    """
+    def cut(path: pathlib.Path, keep: float = 0.5) -> pathlib.Path:
+        data = pathlib.Path(path).read_bytes()
+        pathlib.Path(path).write_bytes(data[:int(len(data) * keep)])
+        return path
+
+    return cut
+
+
+@pytest.fixture
+def run_cli():
+    """
+        :return: Callable - run_cli(*args) runs photo-finder command in this process and returns click Result,
+            its output has stdout and stderr
+    """
+    from click.testing import CliRunner
+    from main import photo_finder
+
+    def run(*args):
+        return CliRunner().invoke(photo_finder, [str(arg) for arg in args], catch_exceptions=False)
+
+    return run
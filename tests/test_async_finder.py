@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from utils import PhotoRequirements, afind_photos
+
+
+@pytest.fixture
+def find_dir(tmp_path, make_image):
+    for number in range(6):
+        make_image(tmp_path.joinpath('inner' if number % 2 else '', f'p{number}.png'), size=(50, 40),
+                   mode='RGB' if number < 4 else 'L')
+    tmp_path.joinpath('notes.txt').write_text('text')
+    return tmp_path
+
+
+async def _collect(*args, **kwargs) -> list:
+    return [match async for match in afind_photos(*args, **kwargs)]
+
+
+def test_matches_have_header_data(find_dir):
+    matches = asyncio.run(_collect(find_dir, PhotoRequirements(photo_modes=['RGB']), recursive=True,
+                                   max_open_files=2))
+    assert sorted(match.path.name for match in matches) == ['p0.png', 'p1.png', 'p2.png', 'p3.png']
+    assert all((match.info.format, match.info.width, match.info.height) == ('PNG', 50, 40) for match in matches)
+    assert {str(match.rel_dir) for match in matches} == {'.', 'inner'}
+
+
+def test_errors_are_passed_to_callback(find_dir, truncate):
+    truncate(find_dir.joinpath('p0.png'))
+    errors = []
+    matches = asyncio.run(_collect(find_dir, verify_decode=True, on_error=errors.append))
+    assert sorted(match.path.name for match in matches) == ['p2.png', 'p4.png']
+    assert len(errors) == 1 and 'p0.png' in errors[0]
+
+
+def test_break_stops_search(find_dir):
+    async def first():
+        async for match in afind_photos(find_dir, recursive=True):
+            return match
+
+    assert asyncio.run(first()).path.suffix == '.png'
+
+
+def test_incorrect_max_open_files():
+    with pytest.raises(Exception, match='max_open_files'):
+        asyncio.run(_collect('.', max_open_files=0))
@@ -0,0 +1,77 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+from utils import find_and_copy_photo
+
+BENCHMARKS_DIR = pathlib.Path(__file__).parent.parent.joinpath('benchmarks')
+
+
+@pytest.fixture
+def corpus(monkeypatch):
+    # benchmark scripts import each other as top level modules
+    monkeypatch.syspath_prepend(str(BENCHMARKS_DIR))
+    import corpus
+    return corpus
+
+
+SETTINGS = dict(files=30, sizes=((40, 30), (20, 60)), formats=('JPEG', 'PNG', 'GIF'), depth=2, fan_out=2,
+                corrupt_ratio=0.2, non_image_ratio=0.2, seed=3)
+
+
+def test_tree_has_every_kind_of_file(tmp_path, corpus):
+    generated = corpus.generate_tree(tmp_path, corpus.CorpusSettings(**SETTINGS))
+    assert generated.directories == 7 and generated.files == 30
+    assert generated.photos and generated.corrupt and generated.non_images
+    files = sorted(path for path in tmp_path.rglob('*') if path.is_file())
+    assert files == sorted(generated.photos + generated.corrupt + generated.non_images)
+    assert generated.bytes == sum(path.stat().st_size for path in files)
+    assert {len(path.relative_to(tmp_path).parts) for path in files} == {1, 2, 3}
+
+
+def test_tree_is_the_same_for_the_same_seed(tmp_path, corpus):
+    first = corpus.generate_tree(tmp_path.joinpath('first'), corpus.CorpusSettings(**SETTINGS))
+    second = corpus.generate_tree(tmp_path.joinpath('second'), corpus.CorpusSettings(**SETTINGS))
+    for kind in ('photos', 'corrupt', 'non_images'):
+        assert [path.relative_to(tmp_path.joinpath('first')) for path in getattr(first, kind)] == \
+               [path.relative_to(tmp_path.joinpath('second')) for path in getattr(second, kind)]
+    # photos without other kinds of files keep their names and sizes of older corpus
+    photos = corpus.generate_corpus(tmp_path.joinpath('photos'), corpus.CorpusSettings(files=5, sizes=((40, 30),)))
+    assert [path.name for path in photos] == [f'photo_{index:06d}.{path.suffix[1:]}'
+                                              for index, path in enumerate(photos)]
+
+
+def test_search_finds_generated_photos(tmp_path, corpus):
+    generated = corpus.generate_tree(tmp_path, corpus.CorpusSettings(**SETTINGS))
+    result = find_and_copy_photo(tmp_path, recursive=True, verify_decode=True)
+    assert sorted(result.found) == sorted(generated.photos)
+    assert result.counts['errors'] == len(generated.corrupt)
+
+
+def test_suite_writes_and_compares_report(tmp_path):
+    env = {**os.environ, 'PYTHONPATH': str(BENCHMARKS_DIR.parent.joinpath('src'))}
+    command = [sys.executable, str(BENCHMARKS_DIR.joinpath('suite.py')), '--files', '12', '--depth', '1',
+               '--fan_out', '2', '--sizes', '640:480', '--formats', 'JPEG,PNG', '--scenarios', 'search,copy',
+               '--repeat', '1']
+    report_path = tmp_path.joinpath('before.json')
+    output = subprocess.run(command + ['--json', str(report_path)], env=env, capture_output=True, text=True,
+                            check=True, timeout=120).stdout
+    assert output.startswith('Corpus: 12 files')
+    report = json.loads(report_path.read_text())
+    assert [scenario['name'] for scenario in report['scenarios']] == ['search', 'copy']
+    for scenario in report['scenarios']:
+        assert scenario['files_per_second'] > 0 and scenario['peak_rss_mb'] > 0
+        assert set(scenario['stages']) == ({'check', 'copy'} if scenario['name'] == 'copy' else {'check'})
+        assert scenario['counts']['found'] == 10 and scenario['first_match_ms'] is not None
+    assert report['scenarios'][1]['copied_bytes_per_second'] > 0
+
+    output = subprocess.run(command + ['--compare', str(report_path)], env=env, capture_output=True, text=True,
+                            check=True, timeout=120).stdout
+    assert 'files/sec (' in output and 'not comparable' not in output
+    output = subprocess.run(command + ['--seed', '1', '--compare', str(report_path)], env=env, capture_output=True,
+                            text=True, check=True, timeout=120).stdout
+    assert 'Warning: corpus differs' in output
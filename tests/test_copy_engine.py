@@ -0,0 +1,113 @@
+import errno
+import os
+import pathlib
+
+import pytest
+
+from utils import COPY_METHODS, CopyEngine, find_and_copy_photo
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path.joinpath('src.bin')
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    os.utime(path, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+    return path
+
+
+def _unsupported(*args):
+    raise OSError(errno.ENOTSUP, 'not supported')
+
+
+@pytest.mark.parametrize('method', COPY_METHODS)
+def test_every_method_copies_data(tmp_path, src, monkeypatch, method):
+    # methods before the tested one are unsupported, so engine falls back to it
+    for other in COPY_METHODS[:COPY_METHODS.index(method)]:
+        monkeypatch.setattr(CopyEngine, f'_copy_{other}', staticmethod(_unsupported))
+    engine = CopyEngine(buffer_size=1024 * 1024)
+    dst = tmp_path.joinpath('dst.bin')
+    used = engine.copy(src, dst)
+    # filesystem of tmp_path may not support the tested method, then one of the next methods is used
+    assert used in COPY_METHODS[COPY_METHODS.index(method):]
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+    assert engine.is_copy_of(src, dst)
+    assert engine.stats.files == 1 and engine.stats.bytes == os.stat(src).st_size
+
+
+def test_unsupported_method_is_not_tried_again(tmp_path, src, monkeypatch):
+    calls = []
+
+    def reflink(*args):
+        calls.append(args)
+        _unsupported()
+
+    monkeypatch.setattr(CopyEngine, '_copy_reflink', staticmethod(reflink))
+    engine = CopyEngine()
+    engine.copy(src, tmp_path.joinpath('a.bin'))
+    engine.copy(src, tmp_path.joinpath('b.bin'))
+    assert len(calls) == 1
+
+
+def test_existing_destination_is_not_overwritten(tmp_path, src):
+    dst = tmp_path.joinpath('dst.bin')
+    dst.write_bytes(b'other')
+    with pytest.raises(FileExistsError):
+        CopyEngine().copy(src, dst)
+    assert dst.read_bytes() == b'other'
+    assert not CopyEngine().is_copy_of(src, dst)
+
+
+@pytest.mark.parametrize('changed', [0, -1])
+def test_other_file_with_the_same_size_and_mtime_is_not_copy(tmp_path, src, changed):
+    dst = tmp_path.joinpath('dst.bin')
+    CopyEngine().copy(src, dst)
+    data = bytearray(dst.read_bytes())
+    data[changed] ^= 0xFF
+    dst.write_bytes(data)
+    os.utime(dst, ns=(os.stat(src).st_mtime_ns, os.stat(src).st_mtime_ns))
+    assert not CopyEngine().is_copy_of(src, dst)
+    assert not CopyEngine(preserve_metadata=False).is_copy_of(src, dst)
+
+
+def test_photo_of_the_same_size_gets_numbered_name(tmp_path, make_image):
+    # BMP of the same size has the same file size, photos have the same mtime and relative path
+    find_dirs = [tmp_path.joinpath('first'), tmp_path.joinpath('second')]
+    for find_dir in find_dirs:
+        path = make_image(find_dir.joinpath('photo.bmp'))
+        os.utime(path, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    result = find_and_copy_photo(find_dirs, copy_dir=copy_dir)
+    assert result.counts['copied'] == 2 and result.counts['warnings'] == 0
+    assert sorted(path.name for path in copy_dir.iterdir()) == ['photo.bmp', 'photo_1.bmp']
+    # rerun finds both copies
+    result = find_and_copy_photo(find_dirs, copy_dir=copy_dir)
+    assert result.counts['copied'] == 0 and result.counts['warnings'] == 2
+
+
+def test_failed_copy_leaves_no_destination(tmp_path, src, monkeypatch):
+    def broken(*args):
+        raise OSError(errno.EIO, 'disk error')
+
+    for method in COPY_METHODS:
+        monkeypatch.setattr(CopyEngine, f'_copy_{method}', staticmethod(broken))
+    with pytest.raises(OSError):
+        CopyEngine().copy(src, tmp_path.joinpath('dst.bin'))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['src.bin']
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'symlink'])
+def test_link_modes(tmp_path, src, mode):
+    engine = CopyEngine(mode=mode)
+    dst = tmp_path.joinpath('dst.bin')
+    assert engine.copy(src, dst) == mode
+    assert dst.is_symlink() == (mode == 'symlink')
+    assert engine.is_copy_of(src, dst)
+    assert not engine.is_copy_of(tmp_path.joinpath('missing'), dst)
+
+
+def test_target_name():
+    engine = CopyEngine()
+    assert engine.target_name(pathlib.Path('a/photo.jpg')) == 'photo.jpg'
+    assert engine.target_name(pathlib.Path('a/photo.jpg'), 2) == 'photo_2.jpg'
@@ -0,0 +1,130 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import utils
+from utils import CopyJournal, FindCopyPhotoResult, PhotoRequirements, default_journal_path, find_and_copy_photo
+from utils.copy_engine import TMP_FILE_PREFIX
+
+
+@pytest.fixture
+def find_dir(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('rgb.png'), size=(60, 40))
+    make_image(find_dir.joinpath('gray.png'), size=(60, 40), mode='L')
+    make_image(find_dir.joinpath('inner', 'rgb2.png'), size=(60, 40))
+    return find_dir
+
+
+@pytest.fixture
+def copy_dir(tmp_path):
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    return copy_dir
+
+
+def _copy(find_dir, copy_dir, resume=False, retry_failed=False, requirements=None, options=None):
+    journal = CopyJournal(default_journal_path(copy_dir), find_dir=find_dir, copy_dir=copy_dir, recursive=True,
+                          resume=resume, retry_failed=retry_failed, options=options)
+    with journal:
+        result = find_and_copy_photo(find_dir, copy_dir=copy_dir, recursive=True, photo_requirements=requirements,
+                                     result=FindCopyPhotoResult(journal=journal))
+    return result, journal
+
+
+def _copied_files(copy_dir) -> list:
+    return sorted(path.relative_to(copy_dir).as_posix() for path in copy_dir.rglob('*')
+                  if path.is_file() and path.name != default_journal_path(copy_dir).name
+                  and not path.name.startswith(TMP_FILE_PREFIX))
+
+
+def test_resume_skips_finished_files(find_dir, copy_dir):
+    result, _ = _copy(find_dir, copy_dir)
+    assert result.counts['copied'] == 3
+    copy_dir.joinpath('inner', 'rgb2.png').unlink()
+
+    result, journal = _copy(find_dir, copy_dir, resume=True)
+    assert journal.resumed == 3 and result.counts['found'] == 0
+    # finished file is not copied again even if its copy was removed
+    assert _copied_files(copy_dir) == ['gray.png', 'rgb.png']
+
+
+def test_retry_failed_checks_failed_files_again(find_dir, copy_dir, truncate):
+    broken = truncate(find_dir.joinpath('gray.png'))
+    journal = CopyJournal(default_journal_path(copy_dir), find_dir=find_dir, copy_dir=copy_dir, recursive=True)
+    with journal:
+        journal.record('failed', broken, message='decode error')
+    _, journal = _copy(find_dir, copy_dir, resume=True)
+    assert journal.resumed == 1 and journal.failed == 1
+    assert _copied_files(copy_dir) == ['inner/rgb2.png', 'rgb.png']
+    _, journal = _copy(find_dir, copy_dir, retry_failed=True)
+    assert journal.resumed == 2
+    assert _copied_files(copy_dir) == ['gray.png', 'inner/rgb2.png', 'rgb.png']
+
+
+def test_torn_last_line_is_skipped(find_dir, copy_dir):
+    _copy(find_dir, copy_dir)
+    with open(default_journal_path(copy_dir), 'a') as file:
+        file.write('{"status": "copied", "pa')
+    _, journal = _copy(find_dir, copy_dir, resume=True)
+    assert journal.resumed == 3
+
+
+def test_resume_with_other_options_is_refused(find_dir, copy_dir):
+    l_requirements = PhotoRequirements(photo_modes=['L'])
+    _copy(find_dir, copy_dir, requirements=l_requirements, options={'requirements': l_requirements.as_dict()})
+    rgb_requirements = PhotoRequirements(photo_modes=['RGB'])
+    with pytest.raises(Exception, match='different options'):
+        _copy(find_dir, copy_dir, resume=True, requirements=rgb_requirements,
+              options={'requirements': rgb_requirements.as_dict()})
+    # journal of refused job is kept as it is
+    assert json.loads(default_journal_path(copy_dir).read_text().splitlines()[0])['options'] == \
+           {'requirements': l_requirements.as_dict()}
+
+
+def test_cli_resume_with_other_requirements_is_refused(find_dir, copy_dir, run_cli):
+    result = run_cli('-d', find_dir, '-r', '-m', 'L', 'copy', copy_dir)
+    assert 'copied=1' in result.output
+    result = run_cli('-d', find_dir, '-r', '-m', 'RGB', 'copy', copy_dir, '--resume')
+    assert 'can not be resumed' in result.output and 'copied=0' in result.output
+    assert _copied_files(copy_dir) == ['gray.png']
+
+    # the same requirements in other order and case are the same job
+    run_cli('-d', find_dir, '-r', '-m', 'rgb,L', 'copy', copy_dir)
+    result = run_cli('-d', find_dir, '-r', '-m', 'L,RGB', 'copy', copy_dir, '--resume')
+    assert 'Resumed: 3 finished files were skipped' in result.output
+
+
+def test_killed_copy_leaves_no_partial_file(find_dir, copy_dir):
+    # copy is killed in the middle of data of the first file, nothing can clean up after it
+    script = textwrap.dedent(f'''
+        import os, pathlib
+        from utils import CopyEngine, CopyJournal, FindCopyPhotoResult, find_and_copy_photo, default_journal_path
+
+        def killed(src_fd, dst_fd, size):
+            os.write(dst_fd, os.read(src_fd, size // 2))
+            os._exit(9)
+
+        for method in ('reflink', 'copy_file_range', 'sendfile', 'buffer'):
+            setattr(CopyEngine, '_copy_' + method, staticmethod(killed))
+        find_dir, copy_dir = pathlib.Path({str(find_dir)!r}), pathlib.Path({str(copy_dir)!r})
+        journal = CopyJournal(default_journal_path(copy_dir), find_dir=find_dir, copy_dir=copy_dir, recursive=True)
+        find_and_copy_photo(find_dir, copy_dir=copy_dir, recursive=True, result=FindCopyPhotoResult(journal=journal))
+    ''')
+    env = {**os.environ, 'PYTHONPATH': str(pathlib.Path(utils.__file__).parent.parent)}
+    assert subprocess.run([sys.executable, '-c', script], env=env).returncode == 9
+    assert _copied_files(copy_dir) == []
+    # copies run in parallel, every started copy leaves its temporary file
+    assert len(list(copy_dir.rglob(f'{TMP_FILE_PREFIX}*'))) >= 1
+
+    # killed file has no record in journal, it is copied again with its own name
+    result, _ = _copy(find_dir, copy_dir, resume=True)
+    assert result.counts['copied'] == 3
+    assert _copied_files(copy_dir) == ['gray.png', 'inner/rgb2.png', 'rgb.png']
+    for name in ('gray.png', 'rgb.png'):
+        assert copy_dir.joinpath(name).read_bytes() == find_dir.joinpath(name).read_bytes()
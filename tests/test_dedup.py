@@ -0,0 +1,78 @@
+import os
+import shutil
+
+import pytest
+
+from utils import DuplicateFinder, PhotoIndex, find_and_copy_photo
+from utils.dedup import PARTIAL_HASH_SIZE
+
+
+@pytest.fixture
+def photos(tmp_path):
+    find_dir = tmp_path.joinpath('find')
+    find_dir.mkdir()
+    head, tail = os.urandom(PARTIAL_HASH_SIZE), os.urandom(PARTIAL_HASH_SIZE)
+    # big files with the same size, head and tail differ only in the middle
+    find_dir.joinpath('big_a.bin').write_bytes(head + b'a' * 1000 + tail)
+    find_dir.joinpath('big_b.bin').write_bytes(head + b'a' * 1000 + tail)
+    find_dir.joinpath('big_c.bin').write_bytes(head + b'b' * 1000 + tail)
+    find_dir.joinpath('small_a.bin').write_bytes(b'small')
+    find_dir.joinpath('small_b.bin').write_bytes(b'small')
+    find_dir.joinpath('small_c.bin').write_bytes(b'other')
+    find_dir.joinpath('unique.bin').write_bytes(b'unique size')
+    return find_dir
+
+
+def _finder(find_dir, **kwargs) -> DuplicateFinder:
+    finder = DuplicateFinder(**kwargs)
+    for path in sorted(find_dir.iterdir()):
+        finder.add(path)
+    return finder
+
+
+def test_groups_have_the_same_content(photos):
+    finder = _finder(photos)
+    groups = finder.find_duplicates()
+    assert [[path.name for path in group] for group in groups] == [['big_a.bin', 'big_b.bin'],
+                                                                 ['small_a.bin', 'small_b.bin']]
+    assert finder.duplicate_of(photos.joinpath('big_b.bin')) == photos.joinpath('big_a.bin')
+    assert finder.duplicate_of(photos.joinpath('big_a.bin')) is None
+    assert finder.duplicate_of(photos.joinpath('big_c.bin')) is None
+
+
+def test_hashes_are_cached_in_index(photos, tmp_path, monkeypatch):
+    with PhotoIndex(tmp_path.joinpath('index.sqlite')) as index:
+        assert len(_finder(photos, cache=index).find_duplicates()) == 2
+
+        def not_read(*args):
+            raise AssertionError('file is read again')
+
+        monkeypatch.setattr('utils.dedup.partial_hash', not_read)
+        monkeypatch.setattr('utils.dedup.full_hash', not_read)
+        assert len(_finder(photos, cache=index).find_duplicates()) == 2
+
+
+def test_unreadable_file_is_error(photos):
+    finder = _finder(photos)
+    photos.joinpath('small_b.bin').unlink()
+    errors = []
+    assert len(finder.find_duplicates(on_error=lambda message, path: errors.append(path))) == 1
+    assert errors == [photos.joinpath('small_b.bin')]
+
+
+def test_unknown_mode():
+    with pytest.raises(Exception, match='Dedup mode=all is unknown'):
+        DuplicateFinder(mode='all')
+
+
+@pytest.mark.parametrize('mode, copied', [('report', 3), ('unique', 2)])
+def test_copy_with_dedup(tmp_path, make_image, mode, copied):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('a.png'))
+    shutil.copyfile(find_dir.joinpath('a.png'), find_dir.joinpath('b.png'))
+    make_image(find_dir.joinpath('c.png'))
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    result = find_and_copy_photo(find_dir, copy_dir=copy_dir, duplicate_finder=DuplicateFinder(mode=mode))
+    assert result.counts['duplicates'] == 1 and result.counts['copied'] == copied
+    assert ('b.png' in os.listdir(copy_dir)) == (mode == 'report')
@@ -0,0 +1,81 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import Lock
+
+import pytest
+
+from utils import ExecutionSettings, PhotoRequirements, find_and_copy_photo
+from utils import photo_finder
+from utils.executors import iter_batches, max_cpu_batches
+
+
+@pytest.fixture
+def find_dir(tmp_path, make_image, truncate):
+    find_dir = tmp_path.joinpath('find')
+    for number in range(12):
+        make_image(find_dir.joinpath(f'p{number}.png'), size=(40 + number, 30), mode='L' if number % 3 else 'RGB')
+    truncate(make_image(find_dir.joinpath('broken.png'), size=(256, 256)))
+    find_dir.joinpath('notes.txt').write_text('text')
+    return find_dir
+
+
+class _CountingExecutor(ThreadPoolExecutor):
+    # stands for process pool, counts batches which are submitted and not finished
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.pending = 0
+        self.max_pending = 0
+        self._count_lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._count_lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._count_lock:
+            self.pending -= 1
+
+
+def test_iter_batches():
+    assert list(iter_batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_batches([], 2)) == []
+
+
+def test_settings_are_checked():
+    with pytest.raises(Exception, match='unknown'):
+        ExecutionSettings(backend='gpu')
+    with pytest.raises(Exception, match='io_workers can not be less than 1'):
+        ExecutionSettings(io_workers=0)
+
+
+@pytest.mark.parametrize('backend', ['threads', 'processes', 'hybrid'])
+@pytest.mark.parametrize('verify_decode', [False, True])
+def test_backends_give_the_same_result(find_dir, backend, verify_decode):
+    requirements = PhotoRequirements(photo_modes=['L'])
+    result = find_and_copy_photo(find_dir, photo_requirements=requirements, verify_decode=verify_decode,
+                                 execution=ExecutionSettings(backend=backend, cpu_workers=2, batch_size=3))
+    assert sorted(path.name for path in result.found) == sorted(f'p{number}.png' for number in range(12)
+                                                                if number % 3)
+    assert result.counts['errors'] == int(verify_decode)
+
+
+def test_hybrid_bounds_batches_submitted_to_cpu_processes(find_dir, monkeypatch):
+    cpu_executor = _CountingExecutor()
+    check_photo_batch = photo_finder.check_photo_batch
+
+    def slow_check_photo_batch(*args, **kwargs):
+        time.sleep(0.02)
+        return check_photo_batch(*args, **kwargs)
+
+    monkeypatch.setattr(photo_finder, 'create_cpu_executor', lambda settings: nullcontext(cpu_executor))
+    monkeypatch.setattr(photo_finder, 'check_photo_batch', slow_check_photo_batch)
+    execution = ExecutionSettings(backend='hybrid', io_workers=8, cpu_workers=1, batch_size=1)
+    result = find_and_copy_photo(find_dir, verify_decode=True, execution=execution)
+    cpu_executor.shutdown()
+    assert result.counts['found'] == 12 and result.counts['errors'] == 1
+    assert cpu_executor.max_pending <= max_cpu_batches(execution)
@@ -0,0 +1,112 @@
+import datetime
+import struct
+
+import pytest
+from PIL import Image
+
+from utils import ExifInfo, ExifRequirements, PhotoRequirements, find_and_copy_photo, read_photo_info
+
+
+def _exif(make: str = 'Apple', model: str = 'iPhone 12 Pro', taken: str = '2021:06:15 12:30:00',
+          gps: tuple = ((46.0, 30.0, 0.0), 'N', (7.0, 15.0, 36.0), 'W')) -> Image.Exif:
+    exif = Image.Exif()
+    exif[0x010F], exif[0x0110], exif[0x0132] = make, model, '2019:01:01 00:00:00'
+    if taken is not None:
+        exif[0x8769] = {0x9003: taken}
+    if gps is not None:
+        exif[0x8825] = {2: gps[0], 1: gps[1], 4: gps[2], 3: gps[3]}
+    return exif
+
+
+def _timestamp(*args) -> float:
+    return datetime.datetime(*args).timestamp()
+
+
+@pytest.mark.parametrize('name', ['photo.jpg', 'photo.png'])
+def test_exif_fields_are_read(tmp_path, make_image, name):
+    path = make_image(tmp_path.joinpath(name), exif=_exif())
+    info = read_photo_info(path, read_exif=True)
+    assert info.exif == ExifInfo(taken=_timestamp(2021, 6, 15, 12, 30), make='Apple', model='iPhone 12 Pro',
+                                 latitude=46.5, longitude=pytest.approx(-7.26))
+    assert read_photo_info(path).exif is None
+
+
+@pytest.mark.parametrize('name', ['photo.jpg', 'photo.tiff'])
+def test_date_time_is_taken_without_original(tmp_path, make_image, name):
+    # TIFF tags are read from image file directory itself
+    path = make_image(tmp_path.joinpath(name), exif=_exif(taken=None, gps=None))
+    exif = read_photo_info(path, read_exif=True).exif
+    assert exif.make == 'Apple' and exif.model == 'iPhone 12 Pro'
+    assert exif.taken == _timestamp(2019, 1, 1) and exif.latitude is None and exif.longitude is None
+
+
+@pytest.mark.parametrize('make_count', [1000, 0x7FFFFFFF])
+def test_value_with_oversized_count_is_skipped(tmp_path, make_image, make_count):
+    # Make declares too long string, e.g. 2 GB beyond the file, it is skipped and other tags are read
+    entries = [(0x010F, 2, make_count, 50), (0x0110, 2, 4, int.from_bytes(b'X10\x00', 'little')),
+               (0x0132, 2, 20, 50)]
+    tiff = b'II*\x00' + struct.pack('<IH', 8, len(entries)) + \
+        b''.join(struct.pack('<HHII', *entry) for entry in entries) + b'\x00' * 4 + b'2019:01:01 00:00:00\x00'
+    path = make_image(tmp_path.joinpath('photo.jpg'), exif=b'Exif\x00\x00' + tiff)
+    exif = read_photo_info(path, read_exif=True).exif
+    assert exif == ExifInfo(taken=_timestamp(2019, 1, 1), make=None, model='X10')
+
+
+def test_photo_without_exif(tmp_path, make_image):
+    assert read_photo_info(make_image(tmp_path.joinpath('photo.jpg')), read_exif=True).exif is None
+
+
+EXIF = ExifInfo(taken=_timestamp(2021, 6, 15), make='Apple', model='iPhone 12 Pro', latitude=46.5, longitude=-7.26)
+
+
+@pytest.mark.parametrize('requirements, matches', [
+    (ExifRequirements(), True),
+    (ExifRequirements(taken_from=_timestamp(2021, 1, 1)), True),
+    (ExifRequirements(taken_from=_timestamp(2021, 1, 1), taken_to=_timestamp(2021, 6, 1)), False),
+    (ExifRequirements(cameras=('IPHONE 12', 'canon')), True),
+    (ExifRequirements(cameras=('canon',)), False),
+    (ExifRequirements(gps_bbox=(45.0, -8.0, 47.0, -7.0)), True),
+    (ExifRequirements(gps_bbox=(45.0, -7.0, 47.0, 0.0)), False),
+    # box crossing 180th meridian
+    (ExifRequirements(gps_bbox=(45.0, 170.0, 47.0, -5.0)), True),
+    (ExifRequirements(gps_bbox=(45.0, 170.0, 47.0, -10.0)), False),
+])
+def test_requirements_check(requirements, matches):
+    assert requirements.check(EXIF) is matches
+
+
+def test_photo_without_needed_field_does_not_match():
+    assert not ExifRequirements(cameras=('apple',)).check(None)
+    assert not ExifRequirements(taken_to=_timestamp(2030, 1, 1)).check(ExifInfo(make='Apple'))
+    assert not ExifRequirements(gps_bbox=(-90, -180, 90, 180)).check(ExifInfo(latitude=1.0))
+    assert not ExifRequirements()
+    assert ExifRequirements(cameras=('apple',))
+
+
+@pytest.mark.parametrize('gps_bbox', [(1.0, 2.0, 3.0), (47.0, 0.0, 45.0, 1.0), (0.0, -181.0, 1.0, 1.0)])
+def test_incorrect_gps_bbox(gps_bbox):
+    with pytest.raises(Exception, match='gps_bbox'):
+        ExifRequirements(gps_bbox=gps_bbox)
+
+
+def test_find_by_exif(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('iphone.jpg'), exif=_exif())
+    make_image(find_dir.joinpath('canon.jpg'), exif=_exif(make='Canon', model='EOS R5', gps=None))
+    make_image(find_dir.joinpath('no_exif.jpg'))
+    requirements = PhotoRequirements(exif_requirements=ExifRequirements(cameras=('canon', 'iphone')))
+    result = find_and_copy_photo(find_dir, photo_requirements=requirements)
+    assert sorted(path.name for path in result.found) == ['canon.jpg', 'iphone.jpg']
+    requirements = PhotoRequirements(exif_requirements=ExifRequirements(gps_bbox=(46.0, -8.0, 47.0, -7.0)))
+    result = find_and_copy_photo(find_dir, photo_requirements=requirements)
+    assert [path.name for path in result.found] == ['iphone.jpg']
+
+
+def test_cli_exif_options(tmp_path, make_image, run_cli):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('iphone.jpg'), exif=_exif())
+    make_image(find_dir.joinpath('old.jpg'), exif=_exif(taken='2010:01:01 10:00:00'))
+    result = run_cli('-d', find_dir, '-e', '--taken_from', '2021-01-01', '--cameras', 'iphone', 'search')
+    assert 'iphone.jpg' in result.output and 'old.jpg' not in result.output
+    result = run_cli('-d', find_dir, '--gps_bbox', '47,0,45,1', 'search')
+    assert result.exit_code != 0 and 'south,west,north,east' in result.output
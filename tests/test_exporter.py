@@ -0,0 +1,140 @@
+import os
+
+import pytest
+from PIL import Image
+
+from utils import ExportCache, ExportEngine, ExportSettings, PhotoInfo, ResourceLimits, default_export_cache_path, \
+    estimate_export_memory, export_image, governor
+from utils.copy_engine import TMP_FILE_PREFIX
+
+
+def test_settings_fit_photo_in_box():
+    assert ExportSettings(max_width=100, max_height=100).target_size(400, 200) == (100, 50)
+    assert ExportSettings(max_width=0, max_height=50).target_size(400, 200) == (100, 50)
+    # photo is never enlarged
+    assert ExportSettings(max_width=1000).target_size(400, 200) == (400, 200)
+    assert ExportSettings(format='webp').format == 'WEBP' and ExportSettings(format='webp').extension == '.webp'
+    with pytest.raises(Exception, match='Export format=GIF is unknown'):
+        ExportSettings(format='GIF')
+    with pytest.raises(Exception, match='quality must be from 1 to 100'):
+        ExportSettings(quality=0)
+
+
+def test_jpeg_memory_is_estimated_at_reduced_scale():
+    settings = ExportSettings(max_width=100, max_height=100)
+    jpeg = PhotoInfo(format='JPEG', mode='RGB', width=4000, height=3000)
+    png = PhotoInfo(format='PNG', mode='RGB', width=4000, height=3000)
+    # JPEG is decoded at 1/8 scale, other formats at full size
+    assert estimate_export_memory(jpeg, settings) == 500 * 375 * 3 + 100 * 75 * 4
+    assert estimate_export_memory(png, settings) == 4000 * 3000 * 3 + 100 * 75 * 4
+
+
+@pytest.mark.parametrize('export_format', ['JPEG', 'WEBP', 'PNG'])
+def test_export_resizes_and_encodes(tmp_path, make_image, export_format):
+    src = make_image(tmp_path.joinpath('photo.png'), size=(320, 240), mode='RGBA')
+    dst = tmp_path.joinpath('photo.out')
+    size = export_image(src, dst, ExportSettings(format=export_format, max_width=80, max_height=80))
+    assert size == os.stat(dst).st_size
+    with Image.open(dst) as img:
+        assert img.format == export_format and img.size == (80, 60)
+        # JPEG has no alpha
+        assert img.mode in (('RGB',) if export_format == 'JPEG' else ('RGB', 'RGBA'))
+    assert [path.name for path in tmp_path.iterdir() if path.name.endswith('.tmp')] == []
+
+
+def test_export_applies_orientation(tmp_path, make_image):
+    exif = Image.Exif()
+    # stored photo is rotated by 90 degrees, it is shown as portrait
+    exif[0x0112] = 6
+    src = make_image(tmp_path.joinpath('photo.jpg'), size=(320, 240), exif=exif.tobytes())
+    dst = tmp_path.joinpath('photo_out.jpg')
+    export_image(src, dst, ExportSettings(max_width=60))
+    with Image.open(dst) as img:
+        assert img.size == (60, 80)
+
+
+def test_export_refuses_image_over_limits(tmp_path, make_image):
+    src = make_image(tmp_path.joinpath('photo.png'), size=(320, 240))
+    governor.configure(ResourceLimits(max_pixels=320 * 240 - 1))
+    dst = tmp_path.joinpath('photo_out.jpg')
+    with pytest.raises(Exception, match='File is not exported because 320x240 has more than 76799 pixels'):
+        export_image(src, dst, ExportSettings())
+    assert not dst.exists()
+
+
+def test_export_stops_decode_after_timeout(tmp_path, make_image):
+    # noise does not compress, so decoder reads file by many chunks
+    src = make_image(tmp_path.joinpath('photo.png'), size=(1000, 1000))
+    governor.configure(ResourceLimits(timeout=0.000001))
+    dst = tmp_path.joinpath('photo_out.jpg')
+    with pytest.raises(TimeoutError, match='Decode took longer than'):
+        export_image(src, dst, ExportSettings(max_width=100))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['photo.png']
+
+
+def test_failed_export_leaves_no_file_and_keeps_existing(tmp_path, make_image, monkeypatch):
+    src = make_image(tmp_path.joinpath('photo.png'), size=(320, 240))
+    dst = tmp_path.joinpath('photo_out.jpg')
+
+    def fail(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    # encode fails after decode, neither empty nor partial file has name of photo
+    monkeypatch.setattr(Image.Image, 'save', fail)
+    with pytest.raises(OSError, match='No space left'):
+        export_image(src, dst, ExportSettings())
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['photo.png']
+    monkeypatch.undo()
+    # file which takes the name during export is not replaced
+    dst.write_bytes(b'other photo')
+    with pytest.raises(FileExistsError):
+        export_image(src, dst, ExportSettings())
+    assert dst.read_bytes() == b'other photo'
+    assert not [path.name for path in tmp_path.iterdir() if path.name.startswith(TMP_FILE_PREFIX)]
+
+
+def test_engine_exports_and_records_cache(tmp_path, make_image):
+    src = make_image(tmp_path.joinpath('photo.png'), size=(320, 240))
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    settings = ExportSettings(format='WEBP', max_width=40)
+    with ExportEngine(settings, default_export_cache_path(copy_dir), workers=1) as engine:
+        assert engine.target_name(src, 2) == 'photo_2.webp'
+        dst = copy_dir.joinpath(engine.target_name(src))
+        assert engine.copy(src, dst) == 'export'
+        assert engine.is_copy_of(src, dst)
+        # destination is reserved exclusively
+        with pytest.raises(FileExistsError):
+            engine.copy(src, dst)
+    assert engine.stats.files == 1
+    # cache of other run knows exported file, other settings are exported again
+    cache = ExportCache(default_export_cache_path(copy_dir))
+    assert cache.is_exported(ExportCache.key(src, settings), dst)
+    assert not cache.is_exported(ExportCache.key(src, ExportSettings(format='WEBP', max_width=80)), dst)
+    cache.close()
+
+
+def test_engine_must_be_entered(tmp_path, make_image):
+    src = make_image(tmp_path.joinpath('photo.png'))
+    engine = ExportEngine(ExportSettings(), tmp_path.joinpath('cache.jsonl'))
+    with pytest.raises(Exception, match='must be entered'):
+        engine.copy(src, tmp_path.joinpath('photo.jpg'))
+
+
+def test_cli_export(tmp_path, make_image, run_cli):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('first.png'), size=(320, 240))
+    make_image(find_dir.joinpath('second.jpg'), size=(240, 320))
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    args = ('-d', find_dir, 'copy', copy_dir, '--export_format', 'webp', '--export_size', '64:64')
+    assert 'copied=2' in run_cli(*args).output
+    for name, size in (('first.webp', (64, 48)), ('second.webp', (48, 64))):
+        with Image.open(copy_dir.joinpath(name)) as img:
+            assert img.format == 'WEBP' and img.size == size
+    # rerun finds exports in cache and does not export them again
+    assert 'copied=0' in run_cli(*args).output
+    assert sorted(path.name for path in copy_dir.iterdir() if not path.name.startswith('.')) == \
+           ['first.webp', 'second.webp']
+    result = run_cli('-d', find_dir, 'copy', copy_dir, '--export_format', 'webp', '--copy_mode', 'hardlink')
+    assert 'Export can not be used with copy_mode=hardlink' in result.output
@@ -0,0 +1,99 @@
+import os
+import pathlib
+import pickle
+
+import pytest
+
+from utils import FileFilter, PhotoInfo, PhotoRequirements, find_and_copy_photo
+
+
+def _stat(size: int, mtime: float = 0.0) -> os.stat_result:
+    return os.stat_result((0o100644, 0, 0, 1, 0, 0, size, mtime, mtime, mtime))
+
+
+@pytest.mark.parametrize('text, path, size, matches', [
+    ('ext = JPG', 'a.jpg', 0, True),
+    ('ext in (png, gif)', 'a.jpg', 0, False),
+    ('name glob "IMG_*"', 'IMG_1.jpg', 0, True),
+    ('path regex "/holiday/"', '/photos/holiday/1.jpg', 0, True),
+    ('size > 1MB', 'a.jpg', 1000 ** 2 + 1, True),
+    ('size <= 1KiB', 'a.jpg', 1025, False),
+    ('size between 1kb and 2kb', 'a.jpg', 1500, True),
+    ('not (ext = jpg or size < 10)', 'a.png', 20, True),
+    ('ext = jpg and not size > 10', 'a.jpg', 20, False),
+])
+def test_path_and_stat_conditions(text, path, size, matches):
+    assert FileFilter(text).check_file(pathlib.Path(path), _stat(size)) is matches
+
+
+def test_mtime_is_local_time():
+    where = FileFilter('mtime >= 2020-01-01 and mtime < "2021-01-01 00:00"')
+    assert where.check_file(pathlib.Path('a.jpg'), _stat(0, 1593561600.0))
+    assert not where.check_file(pathlib.Path('a.jpg'), _stat(0, 1625097600.0))
+
+
+@pytest.mark.parametrize('text, matches', [
+    ('width >= 4000 and height >= 3000', True),
+    ('megapixels > 12.5', False),
+    ('aspect = 4:3', True),
+    ('format in (jpeg, png)', True),
+    ('mode != RGB', False),
+])
+def test_header_conditions(text, matches):
+    where = FileFilter(text)
+    assert where.has_header_predicates and not where.needs_stat
+    assert where.check_info(PhotoInfo(format='JPEG', mode='RGB', width=4000, height=3000)) is matches
+
+
+def test_conditions_are_split_by_stage(tmp_path):
+    where = FileFilter('ext = jpg and size > 10 and width > 100')
+    assert where.needs_stat and where.has_header_predicates
+    # path condition rejects file before stat, missing file is not stat
+    assert not where.check_file(tmp_path.joinpath('missing.png'))
+    with pytest.raises(FileNotFoundError):
+        where.check_file(tmp_path.joinpath('missing.jpg'))
+    assert where.check_info(PhotoInfo(width=101))
+
+
+@pytest.mark.parametrize('text, message', [
+    ('colour = red', 'field is expected at position 0, got "colour"'),
+    ('size > big', 'wrong value of size at position 7'),
+    ('name > a', 'name can be compared only with =, !='),
+    ('ext glob', 'unexpected end of "ext glob"'),
+    ('width between 1 or 2', '"and" is expected at position 16, got "or"'),
+    ('(ext = jpg', 'unexpected end'),
+    ('ext = jpg)', 'unexpected ")" at position 9'),
+    ('name regex "("', 'wrong pattern at position 11'),
+    ('ext = jpg or width > 10', 'can be combined with path and stat fields only by top level "and"'),
+    ('ext = "jpg', 'unexpected symbol at position 5'),
+])
+def test_incorrect_expression(text, message):
+    with pytest.raises(Exception, match='Incorrect where expression') as error:
+        FileFilter(text)
+    assert message in str(error.value)
+
+
+def test_filter_is_pickled_as_text():
+    where = pickle.loads(pickle.dumps(FileFilter('ext = jpg and width > 10')))
+    assert where.text == 'ext = jpg and width > 10'
+    assert where.check_file(pathlib.Path('a.jpg')) and not where.check_info(PhotoInfo(width=10))
+
+
+def test_find_with_where(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('small.png'), size=(40, 30))
+    make_image(find_dir.joinpath('wide.png'), size=(120, 30))
+    make_image(find_dir.joinpath('wide.gif'), size=(120, 30))
+    requirements = PhotoRequirements(where=FileFilter('ext = png and width > 100'))
+    result = find_and_copy_photo(find_dir, photo_requirements=requirements)
+    assert [path.name for path in result.found] == ['wide.png']
+
+
+def test_cli_where(tmp_path, make_image, run_cli):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('small.png'), size=(40, 30))
+    make_image(find_dir.joinpath('wide.png'), size=(120, 30))
+    result = run_cli('-d', find_dir, '-e', '-w', 'aspect > 2', 'search')
+    assert 'wide.png' in result.output and 'small.png' not in result.output
+    result = run_cli('-d', find_dir, '-w', 'aspect >', 'search')
+    assert result.exit_code != 0 and 'Incorrect where expression' in result.output
@@ -0,0 +1,109 @@
+import io
+import threading
+import time
+
+import pytest
+
+from utils import DeadlineReader, ExecutionSettings, MemoryBudget, PhotoInfo, ResourceGovernor, ResourceLimits, \
+    estimate_decode_memory, find_and_copy_photo, governor, metrics, sniff_image
+
+
+def test_limits_must_be_positive():
+    assert ResourceLimits().max_pixels == 89478485 and ResourceLimits().timeout is None
+    for name in ('max_pixels', 'max_file_size', 'decode_memory', 'timeout'):
+        with pytest.raises(Exception, match=f'{name} must be greater than 0'):
+            ResourceLimits(**{name: 0})
+
+
+def test_refuse_reason():
+    info = PhotoInfo(format='PNG', mode='RGB', width=100, height=50)
+    assert estimate_decode_memory(info) == 100 * 50 * 3
+    assert estimate_decode_memory(PhotoInfo(format='PNG', mode='RGBA', width=100, height=50)) == 100 * 50 * 4
+    assert ResourceGovernor().refuse_reason(info, 10 ** 9) is None
+    assert ResourceGovernor(ResourceLimits(max_pixels=4999)).refuse_reason(info) == \
+           '100x50 has more than 4999 pixels'
+    assert ResourceGovernor(ResourceLimits(max_file_size=1000)).refuse_reason(info, 1001) == \
+           'file size 1001 is more than 1000 bytes'
+    assert ResourceGovernor(ResourceLimits(decode_memory=14999)).refuse_reason(info) == \
+           'decoded RGB image needs 15000 bytes, more than 14999 bytes'
+    # memory of reduced decode is given by caller
+    assert ResourceGovernor(ResourceLimits(decode_memory=14999)).refuse_reason(info, memory=1000) is None
+
+
+def test_budget_waits_for_release():
+    budget = MemoryBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.2)
+    budget.release(60)
+    assert acquired.wait(5)
+    thread.join()
+    assert budget.used == 60
+    budget.release(60)
+    # image larger than whole budget is decoded alone
+    budget.acquire(1000)
+    assert budget.used == 1000
+
+
+def test_deadline_reader_stops_read_after_timeout():
+    reader = DeadlineReader(io.BytesIO(b'0123456789'))
+    # header is read without deadline
+    assert reader.read(2) == b'01' and reader.tell() == 2
+    reader.start(None)
+    assert reader.read(2) == b'23'
+    reader.start(0.01)
+    time.sleep(0.02)
+    with pytest.raises(TimeoutError, match='Decode took longer than 0.01 s'):
+        reader.read(2)
+
+
+def test_image_over_limits_is_checked_by_header(tmp_path, make_image, truncate):
+    path = truncate(make_image(tmp_path.joinpath('photo.png'), size=(200, 100)))
+    with pytest.raises(Exception):
+        sniff_image(path, verify_decode=True)
+    governor.configure(ResourceLimits(max_pixels=200 * 100 - 1))
+    metrics.enable()
+    warnings = []
+    info = sniff_image(path, verify_decode=True, on_warning=warnings.append)
+    assert (info.width, info.height) == (200, 100)
+    assert warnings == [f'File "{path}" is not decoded because 200x100 has more than 19999 pixels, '
+                        f'only its header is checked']
+    assert metrics.snapshot()['counters']['decode_refused'] == 1
+
+
+def test_decode_fails_after_timeout(tmp_path, make_image):
+    # noise does not compress, so decoder reads file by many chunks
+    make_image(tmp_path.joinpath('photo.png'), size=(1000, 1000))
+    governor.configure(ResourceLimits(timeout=0.000001))
+    result = find_and_copy_photo(tmp_path, verify_decode=True)
+    assert result.counts['found'] == 0 and result.counts['errors'] == 1
+    assert 'Decode took longer than' in result.errors[0]
+    # header-only check does not decode
+    assert find_and_copy_photo(tmp_path).counts['found'] == 1
+
+
+@pytest.mark.parametrize('backend', ['threads', 'processes', 'hybrid'])
+def test_small_budget_decodes_every_image(tmp_path, make_image, backend):
+    for number in range(8):
+        make_image(tmp_path.joinpath(f'photo_{number}.png'), size=(200, 100))
+    # budget fits one image, so decodes of all threads and CPU processes wait for each other
+    governor.configure(ResourceLimits(decode_memory=200 * 100 * 3))
+    result = find_and_copy_photo(tmp_path, verify_decode=True,
+                                 execution=ExecutionSettings(backend=backend, io_workers=4, cpu_workers=2))
+    assert result.counts['found'] == 8 and result.counts['errors'] == 0
+    assert governor.budget.used == 0
+
+
+def test_cli_limits(tmp_path, make_image, truncate, run_cli):
+    truncate(make_image(tmp_path.joinpath('photo.png'), size=(200, 100)))
+    assert 'errors=1' in run_cli('-d', tmp_path, '--verify_decode', 'search').output
+    result = run_cli('-d', tmp_path, '--verify_decode', '--max_pixels', 1000, 'search')
+    assert 'found=1' in result.output and 'has more than 1000 pixels' in result.output
+    assert 'Invalid value' in run_cli('-d', tmp_path, '--decode_timeout', 0, 'search').output
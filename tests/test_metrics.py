@@ -0,0 +1,113 @@
+import io
+import json
+import logging
+
+import pytest
+
+from utils import ExecutionSettings, Histogram, Metrics, find_and_copy_photo, metrics
+from utils.metrics import BUCKETS
+
+
+def test_histogram_percentiles_are_bucket_bounds():
+    histogram = Histogram()
+    assert histogram.percentile(50) == 0.0
+    for seconds in (0.0002, 0.0003, 0.0004, 0.003, 20.0):
+        histogram.add(seconds)
+    assert histogram.count == 5 and histogram.sum == pytest.approx(20.0039)
+    assert histogram.percentile(50) == 0.0005 and histogram.percentile(80) == 0.005
+    # the last bucket is unbounded, its percentile is max
+    assert histogram.percentile(99) == 20.0 and histogram.counts[len(BUCKETS)] == 1
+
+
+def test_disabled_metrics_record_nothing():
+    registry = Metrics()
+    with registry.stage('check'):
+        pass
+    registry.observe('copy', 1.0)
+    registry.count('files')
+    assert registry.snapshot() == {'histograms': {}, 'counters': {}}
+
+
+def test_snapshots_of_processes_are_merged():
+    main, worker = Metrics(), Metrics()
+    for registry in (main, worker):
+        registry.enable()
+        registry.observe('decode', 0.002)
+        registry.count('images', 2)
+    worker.observe('decode', 1.5)
+    main.merge(worker.snapshot())
+    snapshot = main.snapshot()
+    assert snapshot['counters'] == {'images': 4}
+    assert snapshot['histograms']['decode']['count'] == 3 and snapshot['histograms']['decode']['max'] == 1.5
+    # enable starts a new run
+    main.enable()
+    assert main.snapshot() == {'histograms': {}, 'counters': {}}
+
+
+def test_dumps():
+    registry = Metrics()
+    registry.enable()
+    registry.observe('copy', 0.003)
+    registry.observe('walk', 0.0001)
+    registry.count('files', 3)
+    data = json.loads(_write(registry, 'json'))
+    assert data['histograms']['copy']['p50'] == 0.003 and data['histograms']['copy']['buckets'] == list(BUCKETS)
+    assert data['counters'] == {'files': 3}
+    lines = _write(registry, 'prometheus').splitlines()
+    assert 'photo_finder_stage_seconds_bucket{stage="copy",le="0.0025"} 0' in lines
+    assert 'photo_finder_stage_seconds_bucket{stage="copy",le="+Inf"} 1' in lines
+    assert 'photo_finder_files_total 3' in lines
+    # stages are in order of pipeline
+    assert lines.index('photo_finder_stage_seconds_count{stage="walk"} 1') < \
+           lines.index('photo_finder_stage_seconds_count{stage="copy"} 1')
+    summary = registry.repr_summary().splitlines()
+    assert summary[2].startswith('walk') and summary[3].startswith('copy') and summary[4] == 'files: 3'
+    with pytest.raises(Exception, match='Metrics format=xml is unknown'):
+        registry.write(io.StringIO(), 'xml')
+
+
+def _write(registry: Metrics, metrics_format: str) -> str:
+    file = io.StringIO()
+    registry.write(file, metrics_format)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize('backend', ['threads', 'processes'])
+def test_find_records_stages(tmp_path, make_image, backend):
+    find_dir = tmp_path.joinpath('find')
+    for index in range(4):
+        make_image(find_dir.joinpath(f'photo_{index}.png'))
+    find_dir.joinpath('notes.txt').write_text('not a photo')
+    metrics.enable()
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    find_and_copy_photo(find_dir, copy_dir=copy_dir, verify_decode=True,
+                        execution=ExecutionSettings(backend=backend, cpu_workers=2))
+    snapshot = metrics.snapshot()
+    # stages of CPU processes are merged into metrics of main process
+    assert {name: state['count'] for name, state in snapshot['histograms'].items()
+            if name in ('walk', 'decode', 'check', 'copy')} == {'walk': 1, 'decode': 4, 'check': 4, 'copy': 4}
+    assert snapshot['counters']['files'] == 5 and snapshot['counters']['images'] == 4
+
+
+def test_disabled_logging_does_not_format_messages(tmp_path, make_image, monkeypatch):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('photo.png'))
+    monkeypatch.setattr(logging.getLogger(), 'level', logging.CRITICAL)
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    formatted = []
+    monkeypatch.setattr('pathlib.Path.absolute', lambda path: formatted.append(path) or path)
+    assert find_and_copy_photo(find_dir, copy_dir=copy_dir).counts['copied'] == 1
+    assert formatted == []
+
+
+def test_cli_stats_and_metrics(tmp_path, make_image, run_cli):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('photo.png'))
+    metrics_path = tmp_path.joinpath('metrics.prom')
+    result = run_cli('-d', find_dir, '--stats', '--metrics', metrics_path, '--metrics_format', 'prometheus',
+                     'search')
+    assert 'Stats:' in result.output and 'read_header' in result.output
+    assert 'photo_finder_images_total 1' in metrics_path.read_text()
+    assert not metrics.enabled
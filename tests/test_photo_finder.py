@@ -0,0 +1,81 @@
+import pathlib
+
+import pytest
+
+from utils import FindCopyPhotoResult, PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo
+from utils.photo_finder import check_photo
+
+
+@pytest.fixture
+def photo_tree(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('rgb.jpg'), size=(800, 600))
+    make_image(find_dir.joinpath('gray.png'), size=(300, 200), mode='L')
+    make_image(find_dir.joinpath('inner', 'small.png'), size=(40, 30))
+    find_dir.joinpath('notes.txt').write_text('not an image')
+    return find_dir
+
+
+def _names(paths: list) -> set:
+    return {pathlib.Path(path).name for path in paths}
+
+
+def test_check_photo_matches_header_requirements(photo_tree):
+    rgb = photo_tree.joinpath('rgb.jpg')
+    assert check_photo(rgb)
+    assert check_photo(rgb, PhotoRequirements(photo_modes=['rgb'], photo_formats=['jpeg']))
+    assert not check_photo(rgb, PhotoRequirements(photo_modes=['L']))
+    assert not check_photo(rgb, PhotoRequirements(photo_formats=['PNG']))
+    assert check_photo(rgb, PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(800, 600)]))
+    assert not check_photo(rgb, PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(801, 600)]))
+    assert not check_photo(photo_tree.joinpath('notes.txt'))
+
+
+def test_unknown_requirement_is_rejected():
+    with pytest.raises(Exception, match='Photo mode=XYZ is unknown'):
+        PhotoRequirements(photo_modes=['XYZ'])
+
+
+def test_header_only_match_does_not_decode_pixels(tmp_path, make_image, truncate):
+    path = truncate(make_image(tmp_path.joinpath('cut.png'), size=(256, 256)))
+    assert check_photo(path)
+    with pytest.raises(OSError):
+        check_photo(path, verify_decode=True)
+
+
+def test_search_reports_found_and_errors(photo_tree, tmp_path, make_image, truncate):
+    truncate(make_image(photo_tree.joinpath('broken.png'), size=(256, 256)))
+    result = find_and_copy_photo(photo_tree, recursive=True)
+    assert _names(result.found) == {'rgb.jpg', 'gray.png', 'small.png', 'broken.png'}
+    assert not result.errors
+
+    result = find_and_copy_photo(photo_tree, recursive=True, verify_decode=True)
+    assert _names(result.found) == {'rgb.jpg', 'gray.png', 'small.png'}
+    assert len(result.errors) == 1 and 'broken.png' in result.errors[0]
+
+
+def test_search_with_requirements(photo_tree):
+    requirements = PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(200, 100)], photo_modes=['RGB', 'L'])
+    result = find_and_copy_photo(photo_tree, recursive=True, photo_requirements=requirements)
+    assert _names(result.found) == {'rgb.jpg', 'gray.png'}
+    result = find_and_copy_photo(photo_tree, recursive=False)
+    assert _names(result.found) == {'rgb.jpg', 'gray.png'}
+
+
+def test_copy_keeps_inner_directories(photo_tree, tmp_path):
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    result = find_and_copy_photo(photo_tree, copy_dir=copy_dir, recursive=True)
+    assert result.counts['copied'] == 3 and not result.errors
+    assert copy_dir.joinpath('inner', 'small.png').read_bytes() == photo_tree.joinpath('inner', 'small.png').read_bytes()
+
+    # photos which are already copied are not copied again
+    result = find_and_copy_photo(photo_tree, copy_dir=copy_dir, recursive=True)
+    assert result.counts['copied'] == 0 and result.counts['not_copied'] == 3
+    assert sorted(path.name for path in copy_dir.rglob('*') if path.is_file()) == ['gray.png', 'rgb.jpg', 'small.png']
+
+
+def test_missing_find_dir_is_error(tmp_path):
+    result = find_and_copy_photo(tmp_path.joinpath('missing'))
+    assert result.has_errors and 'does not exist' in result.errors[0]
+    assert isinstance(result, FindCopyPhotoResult)
@@ -0,0 +1,113 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from utils import PhotoIndex, PhotoPixelSizeObject, PhotoRequirements, find_and_copy_photo
+
+
+@pytest.fixture
+def index(tmp_path):
+    with PhotoIndex(tmp_path.joinpath('index.sqlite')) as photo_index:
+        yield photo_index
+
+
+@pytest.fixture
+def find_dir(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    make_image(find_dir.joinpath('a.jpg'), size=(640, 480))
+    make_image(find_dir.joinpath('b.png'), size=(100, 100), mode='L')
+    make_image(find_dir.joinpath('inner', 'c.png'), size=(1024, 768))
+    find_dir.joinpath('readme.txt').write_text('text')
+    return find_dir
+
+
+def test_refresh_reads_only_new_and_changed_files(index, find_dir, make_image):
+    result = index.refresh(find_dir, recursive=True)
+    assert (result.added, result.updated, result.unchanged, result.removed) == (4, 0, 0, 0)
+
+    result = index.refresh(find_dir, recursive=True)
+    assert (result.added, result.updated, result.unchanged, result.removed) == (0, 0, 4, 0)
+
+    make_image(find_dir.joinpath('b.png'), size=(200, 200), mode='L')
+    os.utime(find_dir.joinpath('b.png'), ns=(1, 1))
+    find_dir.joinpath('readme.txt').unlink()
+    result = index.refresh(find_dir, recursive=True)
+    assert (result.added, result.updated, result.unchanged, result.removed) == (0, 1, 2, 1)
+    assert index.get(find_dir.joinpath('b.png')).width == 200
+
+
+def test_query_matches_walk(index, find_dir):
+    index.refresh(find_dir, recursive=True)
+    requirements = PhotoRequirements(min_photo_sizes=[PhotoPixelSizeObject(600, 400)], photo_formats=['PNG', 'JPEG'])
+    assert {path.name for path in index.query(find_dir, recursive=True, photo_requirements=requirements)} == \
+           {'a.jpg', 'c.png'}
+    assert {path.name for path in index.query(find_dir)} == {'a.jpg', 'b.png'}
+
+    indexed = find_and_copy_photo(find_dir, recursive=True, photo_requirements=requirements, photo_index=index)
+    walked = find_and_copy_photo(find_dir, recursive=True, photo_requirements=requirements)
+    assert sorted(indexed.found) == sorted(path.absolute() for path in walked.found)
+
+
+def test_changed_file_is_not_answered_from_index(index, find_dir):
+    path = find_dir.joinpath('a.jpg')
+    index.refresh(find_dir)
+    assert index.get(path).format == 'JPEG'
+    path.write_bytes(b'not an image any more')
+    assert index.get(path) is None
+
+
+def test_prune_removes_deleted_files(index, find_dir):
+    index.refresh(find_dir, recursive=True)
+    find_dir.joinpath('inner', 'c.png').unlink()
+    result = index.prune(find_dir)
+    assert (result.removed, result.unchanged) == (1, 3)
+    assert index.query(find_dir.joinpath('inner')) == []
+
+
+def test_refresh_removes_deleted_directories(tmp_path, index, find_dir, make_image, run_cli):
+    make_image(find_dir.joinpath('inner', 'deeper', 'd.png'))
+    # directory with a name sorted after inner/ keeps its rows
+    make_image(find_dir.joinpath('inner2', 'e.png'))
+    index.refresh(find_dir, recursive=True)
+    shutil.rmtree(find_dir.joinpath('inner'))
+    result = index.refresh(find_dir, recursive=True)
+    assert (result.removed, result.unchanged) == (2, 4)
+    assert {path.name for path in index.query(find_dir, recursive=True)} == {'a.jpg', 'b.png', 'e.png'}
+
+    index_path = tmp_path.joinpath('cli_index.sqlite')
+    make_image(find_dir.joinpath('inner', 'c.png'))
+    run_cli('-d', find_dir, '-r', '-i', '--index_path', index_path, 'search')
+    shutil.rmtree(find_dir.joinpath('inner'))
+    copy_dir = tmp_path.joinpath('copy')
+    copy_dir.mkdir()
+    result = run_cli('-d', find_dir, '-r', '-i', '--index_path', index_path, 'copy', copy_dir)
+    assert 'found=3, copied=3' in result.output and 'errors=0' in result.output
+
+
+def test_hashes_are_cached_per_device(index):
+    index.put_hashes([(1, 10, 100, 1000, b'partial', b'full')])
+    index.put_perceptual_hashes([(1, 10, 100, 1000, 1 << 63)], 'dhash')
+    assert index.get_hashes([(1, 10, 100, 1000)]) == {(1, 10, 100, 1000): (b'partial', b'full')}
+    # the same inode of other filesystem is other file
+    assert index.get_hashes([(2, 10, 100, 1000)]) == {}
+    assert index.get_perceptual_hashes([(1, 10, 100, 1000), (2, 10, 100, 1000)], 'dhash') == \
+           {(1, 10, 100, 1000): 1 << 63}
+
+
+def test_hashes_of_old_index_are_dropped(tmp_path):
+    path = tmp_path.joinpath('index.sqlite')
+    with PhotoIndex(path):
+        pass
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript('DROP TABLE hashes; DROP TABLE perceptual_hashes; '
+                                 'CREATE TABLE hashes (inode, size, mtime_ns, partial_hash, full_hash); '
+                                 'CREATE TABLE perceptual_hashes (inode, size, mtime_ns, kind, hash); '
+                                 "INSERT INTO hashes VALUES (10, 100, 1000, x'00', x'00')")
+    connection.close()
+    with PhotoIndex(path) as photo_index:
+        assert photo_index.get_hashes([(1, 10, 100, 1000)]) == {}
+        photo_index.put_hashes([(1, 10, 100, 1000, b'partial', None)])
+        assert photo_index.get_hashes([(1, 10, 100, 1000)]) == {(1, 10, 100, 1000): (b'partial', None)}
@@ -0,0 +1,94 @@
+import os
+import pathlib
+import pstats
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+import utils
+from utils import SamplingProfiler, profile
+
+# profiled find runs in its own process, so a hang of worker threads fails the test instead of blocking the suite
+FIND_SCRIPT = textwrap.dedent('''
+    import cProfile, pathlib, sys, threading
+    from utils import ExecutionSettings, find_and_copy_photo, profile
+
+    find_dir, output, profiler, busy = sys.argv[1:]
+    if busy == 'busy':
+        # since Python 3.12 only one profiler can be active, enable in other threads fails
+        class BusyProfile(cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                if threading.current_thread() is not threading.main_thread():
+                    raise ValueError('Another profiling tool is already active')
+                return super().enable(*args, **kwargs)
+
+        cProfile.Profile = BusyProfile
+    with profile(pathlib.Path(output), profiler, interval=0.001):
+        result = find_and_copy_photo(pathlib.Path(find_dir), recursive=True, verify_decode=True,
+                                     execution=ExecutionSettings(io_workers=4))
+    print(result.counts['found'])
+''')
+
+
+@pytest.fixture
+def find_dir(tmp_path, make_image):
+    find_dir = tmp_path.joinpath('find')
+    for index in range(24):
+        make_image(find_dir.joinpath(f'dir_{index % 3}', f'photo_{index}.png'), size=(320, 240))
+    return find_dir
+
+
+def _run_find(find_dir: pathlib.Path, output: pathlib.Path, profiler: str, busy: bool = False) -> str:
+    env = {**os.environ, 'PYTHONPATH': str(pathlib.Path(utils.__file__).parent.parent)}
+    completed = subprocess.run([sys.executable, '-c', FIND_SCRIPT, str(find_dir), str(output), profiler,
+                                'busy' if busy else ''], env=env, capture_output=True, text=True, timeout=30)
+    assert completed.returncode == 0, completed.stderr
+    return completed.stdout.strip()
+
+
+@pytest.mark.parametrize('busy', [False, True])
+def test_cprofile_sees_threaded_find(find_dir, tmp_path, busy):
+    output = tmp_path.joinpath('find.pstats')
+    assert _run_find(find_dir, output, 'cprofile', busy) == '24'
+    functions = {function for _, _, function in pstats.Stats(str(output)).stats}
+    assert 'find_and_copy_photo' in functions
+    # worker threads are profiled unless another profiler is active in them
+    assert ('check_photo' in functions) is (not busy or sys.version_info >= (3, 12))
+
+
+def test_sampling_profiler_sees_threaded_find(find_dir, tmp_path):
+    output = tmp_path.joinpath('find.folded')
+    assert _run_find(find_dir, output, 'sampling') == '24'
+    lines = output.read_text().splitlines()
+    assert lines and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    assert any('check_photo' in line for line in lines)
+
+
+def test_sampling_profiler_counts_stacks(tmp_path):
+    sampler = SamplingProfiler(interval=0.001)
+    sampler.start()
+    deadline = time.monotonic() + 0.2
+    while time.monotonic() < deadline:
+        pass
+    sampler.stop()
+    assert sum(sampler.samples.values()) > 10
+    assert any('test_sampling_profiler_counts_stacks' in stack for stack in sampler.samples)
+    sampler.write(tmp_path.joinpath('stacks.folded'))
+    counts = [int(line.rsplit(' ', 1)[1]) for line in tmp_path.joinpath('stacks.folded').read_text().splitlines()]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_unknown_profiler(tmp_path):
+    with pytest.raises(Exception, match='Profiler=yappi is unknown'):
+        with profile(tmp_path.joinpath('profile'), 'yappi'):
+            pass
+
+
+def test_cli_profile(find_dir, tmp_path, run_cli):
+    output = tmp_path.joinpath('search.pstats')
+    result = run_cli('-d', find_dir, '-r', '--profile', output, 'search')
+    assert 'found=24' in result.output
+    assert 'find_and_copy_photo' in {function for _, _, function in pstats.Stats(str(output)).stats}
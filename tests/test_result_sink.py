@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+
+from utils import CallbackResultSink, FindCopyPhotoResult, ResultRecord, find_and_copy_photo, open_result_sink, \
+    read_result_records
+
+
+@pytest.mark.parametrize('name', ['result.jsonl', 'result.csv'])
+def test_records_are_read_back(tmp_path, name):
+    path = tmp_path.joinpath(name)
+    records = [ResultRecord(type='found', path='/a/b.jpg', time=1.0),
+               ResultRecord(type='copied', path='/a/b.jpg', target='/c/b.jpg', time=2.0),
+               ResultRecord(type='error', message='broken, "quoted"\nline', time=3.0)]
+    with open_result_sink(path) as sink:
+        for record in records:
+            sink.write(record)
+    assert list(read_result_records(path)) == records
+
+
+def test_broken_line_is_skipped_with_warning(tmp_path):
+    path = tmp_path.joinpath('result.jsonl')
+    path.write_text(json.dumps(ResultRecord(type='found', path='/a.jpg', time=1.0).as_dict()) + '\n'
+                    + '{"type": "found", "pa\n')
+    warnings = []
+    assert [record.path for record in read_result_records(path, on_warning=warnings.append)] == ['/a.jpg']
+    assert len(warnings) == 1 and 'line 2' in warnings[0]
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    with pytest.raises(Exception, match='Output format=xml is unknown'):
+        open_result_sink(tmp_path.joinpath('result.xml'), 'xml')
+
+
+def test_result_streams_records_without_keeping_items(tmp_path, make_image):
+    for number in range(3):
+        make_image(tmp_path.joinpath(f'p{number}.png'))
+    records = []
+    result = FindCopyPhotoResult(sink=CallbackResultSink(records.append), keep_items=False)
+    find_and_copy_photo(tmp_path, result=result)
+    assert result.found == [] and result.counts['found'] == 3
+    assert sorted(record.path for record in records if record.type == 'found') == \
+           sorted(str(tmp_path.joinpath(f'p{number}.png')) for number in range(3))
+
+
+def test_opened_file_is_not_closed_by_sink():
+    file = io.StringIO()
+    sink = open_result_sink(file, 'jsonl')
+    sink.write(ResultRecord(type='warning', message='w', time=1.0))
+    sink.close()
+    assert json.loads(file.getvalue())['message'] == 'w'
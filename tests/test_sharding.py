@@ -0,0 +1,129 @@
+import json
+import pathlib
+
+import pytest
+
+from utils import CopyJournal, FindCopyPhotoResult, PhotoIndex, ResultRecord, Shard, find_and_copy_photo, \
+    merge_result_records, open_result_sink
+
+
+def test_parse():
+    assert Shard.parse(' 1 / 4 ') == Shard(index=1, count=4)
+    assert str(Shard(1, 4)) == '1/4' and Shard(1, 4).name == '1-of-4'
+    for value in ('1', '1/4/2', '-1/4', 'a/b'):
+        with pytest.raises(Exception, match='set it in format index/count'):
+            Shard.parse(value)
+    for value in ('4/4', '0/0'):
+        with pytest.raises(Exception, match='index must be from 0 to count - 1'):
+            Shard.parse(value)
+
+
+def test_file_path_has_shard_name():
+    assert Shard(2, 4).file_path('out/result.jsonl') == pathlib.Path('out/result.2-of-4.jsonl')
+    assert Shard(0, 2).file_path('metrics') == pathlib.Path('metrics.0-of-2')
+
+
+def test_shards_split_paths():
+    paths = [f'dir_{number % 7}/photo_{number}.jpg' for number in range(500)]
+    shards = [Shard(index, 3) for index in range(3)]
+    owners = [[shard for shard in shards if shard.contains(path)] for path in paths]
+    # every path belongs to exactly one shard and shards are not empty
+    assert all(len(owner) == 1 for owner in owners)
+    assert all(sum(1 for owner in owners if owner[0] == shard) > 100 for shard in shards)
+    assert all(shards[1].contains(pathlib.PurePath(path)) is shards[1].contains(path) for path in paths)
+    assert all(Shard(0, 1).contains(path) for path in paths)
+
+
+@pytest.fixture
+def find_dirs(tmp_path, make_image):
+    find_dirs = [tmp_path.joinpath('first'), tmp_path.joinpath('second')]
+    for number in range(24):
+        make_image(find_dirs[number % 2].joinpath(f'dir_{number % 3}', f'photo_{number}.png'), size=(16, 16))
+    return find_dirs
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_shards_find_all_photos_once(tmp_path, find_dirs, use_index):
+    everything = find_and_copy_photo(find_dirs, recursive=True)
+    assert everything.counts['found'] == 24
+    found = []
+    for index in range(3):
+        if use_index:
+            with PhotoIndex(tmp_path.joinpath('index.sqlite')) as photo_index:
+                for find_dir in find_dirs:
+                    photo_index.refresh(find_dir=find_dir, recursive=True, shard=Shard(index, 3))
+                result = find_and_copy_photo(find_dirs, recursive=True, photo_index=photo_index,
+                                             shard=Shard(index, 3))
+        else:
+            result = find_and_copy_photo(find_dirs, recursive=True, shard=Shard(index, 3))
+        assert 0 < result.counts['found'] < 24
+        found.extend(result.found)
+    assert sorted(found) == sorted(everything.found)
+
+
+def test_repeated_and_nested_find_dirs_are_searched_once(find_dirs):
+    result = find_and_copy_photo([find_dirs[0], find_dirs[0], find_dirs[0].joinpath('dir_0'), find_dirs[1]],
+                                 recursive=True)
+    assert result.counts['found'] == 24 and result.counts['warnings'] == 2
+
+
+def test_journal_is_resumed_only_by_the_same_shard(tmp_path):
+    journal_path = tmp_path.joinpath('journal.jsonl')
+    CopyJournal(journal_path, find_dir=tmp_path, copy_dir=tmp_path, shard=Shard(0, 2)).close()
+    CopyJournal(journal_path, find_dir=tmp_path, copy_dir=tmp_path, shard=Shard(0, 2), resume=True).close()
+    with pytest.raises(Exception, match='different shard'):
+        CopyJournal(journal_path, find_dir=tmp_path, copy_dir=tmp_path, shard=Shard(1, 2), resume=True)
+
+
+def _write(path: pathlib.Path, records: list) -> pathlib.Path:
+    with open_result_sink(path) as sink:
+        for record in records:
+            sink.write(record)
+    return path
+
+
+def test_merge_orders_records_and_keeps_shared_messages_once(tmp_path):
+    first = _write(tmp_path.joinpath('result.0-of-2.jsonl'), [
+        ResultRecord(type='warning', message='find_dir "a" is set several times', time=1.0),
+        ResultRecord(type='found', path='/a/1.jpg', time=2.0),
+        ResultRecord(type='error', path='/a/3.jpg', message='broken', time=5.0)])
+    second = _write(tmp_path.joinpath('result.1-of-2.csv'), [
+        ResultRecord(type='warning', message='find_dir "a" is set several times', time=1.5),
+        ResultRecord(type='found', path='/a/2.jpg', time=3.0),
+        ResultRecord(type='error', path='/a/4.jpg', message='broken', time=4.0)])
+    merged = list(merge_result_records([first, second]))
+    assert [record.time for record in merged] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    # the same message of file is kept for every file
+    assert [record.path for record in merged if record.type == 'error'] == ['/a/4.jpg', '/a/3.jpg']
+
+
+def test_cli_shards_and_merge(tmp_path, find_dirs, run_cli):
+    output = tmp_path.joinpath('result.jsonl')
+    for index in range(2):
+        result = run_cli('-d', find_dirs[0], '-d', find_dirs[1], '-r', '--shard', f'{index}/2', '-o', output,
+                         'search')
+        assert 'found=' in result.output and 'found=24' not in result.output
+    shard_outputs = [tmp_path.joinpath(f'result.{index}-of-2.jsonl') for index in range(2)]
+    assert not output.exists() and all(path.exists() for path in shard_outputs)
+    # output of merge is a report of all shards
+    merged_output = tmp_path.joinpath('merged.jsonl')
+    result = run_cli('-e', '-o', merged_output, 'merge', *shard_outputs)
+    assert 'Merged files: 2' in result.output and 'found=24' in result.output
+    merged = [json.loads(line) for line in merged_output.read_text().splitlines()]
+    assert len(merged) == 24 and len({record['path'] for record in merged}) == 24
+
+    result = run_cli('--shard', '2/2', 'search')
+    assert 'index must be from 0 to count - 1' in result.output
+    result = run_cli('-d', find_dirs[0], '--shard', '0/2', 'similar')
+    assert 'it can not be used with shard' in result.output
+
+
+def test_merged_records_are_counted(tmp_path):
+    path = _write(tmp_path.joinpath('result.jsonl'), [
+        ResultRecord(type='found', path='/a/1.jpg', time=1.0),
+        ResultRecord(type='copied', path='/a/1.jpg', target='/b/1.jpg', time=2.0)])
+    result = FindCopyPhotoResult()
+    for record in merge_result_records([path]):
+        result.add_record(record)
+    assert result.counts['found'] == 1 and result.counts['copied'] == 1
+    assert result.copied == [pathlib.Path('/a/1.jpg')]
@@ -0,0 +1,155 @@
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from utils import MAX_PERCEPTUAL_DISTANCE, PERCEPTUAL_HASHES, PhotoIndex, PerceptualHashIndex, ResourceLimits, \
+    build_perceptual_index, governor, perceptual_hash
+from utils.similarity import _popcount
+
+
+def _scene(seed: int, size: tuple = (320, 240)) -> Image.Image:
+    # smooth picture with large shapes, perceptual hash of noise changes after resize
+    rng = random.Random(seed)
+    image = Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        radius = rng.randrange(20, 80)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image
+
+
+@pytest.fixture
+def photos(tmp_path):
+    find_dir = tmp_path.joinpath('find')
+    find_dir.mkdir()
+    original = _scene(1)
+    original.save(find_dir.joinpath('original.png'))
+    original.resize((160, 120), Image.LANCZOS).save(find_dir.joinpath('small.jpg'), quality=60)
+    original.save(find_dir.joinpath('recompressed.jpg'), quality=30)
+    _scene(2).save(find_dir.joinpath('other.png'))
+    find_dir.joinpath('notes.txt').write_text('not a photo')
+    return find_dir
+
+
+@pytest.mark.parametrize('kind', PERCEPTUAL_HASHES)
+def test_copies_are_near_and_other_photo_is_far(photos, kind):
+    original = perceptual_hash(photos.joinpath('original.png'), kind)
+    for name in ('small.jpg', 'recompressed.jpg'):
+        assert _popcount(original ^ perceptual_hash(photos.joinpath(name), kind)) <= 6
+    assert _popcount(original ^ perceptual_hash(photos.joinpath('other.png'), kind)) > 20
+
+
+def test_unknown_hash_kind(photos):
+    with pytest.raises(Exception, match='Perceptual hash=ahash is unknown'):
+        perceptual_hash(photos.joinpath('original.png'), 'ahash')
+
+
+def test_query_returns_nearest_first():
+    index = PerceptualHashIndex()
+    assert index.query(0) == []
+    for name, value in (('far', 0xFFFF), ('exact', 0), ('near', 0b101), ('highest', 1 << 63)):
+        index.add(name, value)
+    assert index.query(0, distance=1) == [('exact', 0), ('highest', 1)]
+    assert index.query(0, distance=16) == [('exact', 0), ('highest', 1), ('near', 2), ('far', 16)]
+
+
+def test_clusters_join_chains_of_neighbours():
+    index = PerceptualHashIndex()
+    # a and c differ by 12 bits, but b is within 6 bits of both
+    for name, value in (('a', 0), ('b', 0x3F), ('c', 0xFFF), ('same_as_a', 0), ('alone', 0xFFFF << 32)):
+        index.add(name, value)
+    assert index.clusters(6) == [['a', 'b', 'c', 'same_as_a']]
+    assert index.clusters(0) == [['a', 'same_as_a']]
+
+
+def test_clusters_find_pairs_in_any_chunk():
+    rng = random.Random(0)
+    index = PerceptualHashIndex()
+    values = [rng.getrandbits(64) for _ in range(200)]
+    for number, value in enumerate(values):
+        index.add(number, value)
+    index.add('copy', values[7] ^ (1 << 63 | 1 << 40 | 1 << 20 | 1 << 3))
+    assert index.clusters(4) == [[7, 'copy']]
+
+
+@pytest.mark.parametrize('distance', [1, 6, 9, 16])
+def test_clusters_are_the_same_as_comparison_of_all_pairs(distance):
+    rng = random.Random(distance)
+    index = PerceptualHashIndex()
+    values = [rng.getrandbits(64) for _ in range(300)]
+    # near copies differ by up to distance + 1 random bits, their chunks are changed unevenly
+    values.extend(value ^ sum(1 << bit for bit in rng.sample(range(64), rng.randint(1, distance + 1)))
+                  for value in values[:100])
+    for number, value in enumerate(values):
+        index.add(number, value)
+    parents = list(range(len(values)))
+
+    def find(node):
+        while parents[node] != node:
+            node = parents[node]
+        return node
+
+    for first in range(len(values)):
+        for second in range(first):
+            if _popcount(values[first] ^ values[second]) <= distance:
+                parents[find(first)] = find(second)
+    groups = {}
+    for node in range(len(values)):
+        groups.setdefault(find(node), []).append(node)
+    expected = sorted((sorted(group, key=str) for group in groups.values() if len(group) > 1),
+                      key=lambda group: str(group[0]))
+    assert index.clusters(distance) == expected and len(expected) > 10
+
+
+def test_distance_is_bounded(photos, run_cli):
+    index = PerceptualHashIndex()
+    index.add('a', 0)
+    for distance in (-1, MAX_PERCEPTUAL_DISTANCE + 1):
+        with pytest.raises(Exception, match='distance must be from 0 to 16'):
+            index.clusters(distance)
+        with pytest.raises(Exception, match='distance must be from 0 to 16'):
+            index.query(0, distance)
+    assert 'Invalid value' in run_cli('-d', photos, 'similar', '--distance', 17).output
+
+
+def test_build_index_groups_copies(photos):
+    index = build_perceptual_index(photos)
+    assert len(index) == 4
+    assert [[path.name for path in group] for group in index.clusters()] == \
+           [['original.png', 'recompressed.jpg', 'small.jpg']]
+    assert [path.name for path, _ in index.query(perceptual_hash(photos.joinpath('original.png')))][0] == \
+           'original.png'
+
+
+def test_photo_over_decode_limits_is_skipped_with_warning(photos, run_cli):
+    governor.configure(ResourceLimits(max_pixels=320 * 240 - 1))
+    errors, warnings = [], []
+    index = build_perceptual_index(photos, on_error=errors.append, on_warning=warnings.append)
+    assert [path.name for path in index.paths] == ['small.jpg'] and errors == []
+    assert sorted(warnings) == [f'File "{photos.joinpath(name)}" is not hashed because 320x240 has more than '
+                                f'76799 pixels' for name in ('original.png', 'other.png', 'recompressed.jpg')]
+    result = run_cli('-d', photos, '--max_pixels', 320 * 240 - 1, 'similar')
+    assert 'hashed=1, warnings=3, errors=0' in result.output
+
+
+def test_hashes_are_cached_in_index(photos, tmp_path, monkeypatch):
+    with PhotoIndex(tmp_path.joinpath('index.sqlite')) as photo_index:
+        first = build_perceptual_index(photos, photo_index=photo_index)
+
+        def not_hashed(*args):
+            raise AssertionError('photo is hashed again')
+
+        monkeypatch.setattr('utils.similarity.perceptual_hash', not_hashed)
+        second = build_perceptual_index(photos, photo_index=photo_index)
+    assert sorted(zip(first.paths, first.hashes)) == sorted(zip(second.paths, second.hashes))
+
+
+def test_cli_similar(photos, run_cli):
+    result = run_cli('-d', photos, 'similar')
+    assert 'hashed=4' in result.output and 'SIMILAR GROUPS: 1' in result.output
+    result = run_cli('-d', photos, 'similar', '--to', photos.joinpath('small.jpg'), '--distance', '6')
+    assert 'SIMILAR TO' in result.output and ': 3' in result.output
+    assert 'other.png' not in result.output
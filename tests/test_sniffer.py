@@ -0,0 +1,116 @@
+import struct
+
+import pytest
+from PIL import Image
+
+from utils import PhotoRequirements, find_and_copy_photo, parse_header, sniff_image
+from utils.sniffer import HEADER_SIZE, _HeaderReader
+
+
+@pytest.mark.parametrize('name, mode, params', [
+    ('rgb.jpg', 'RGB', {}),
+    ('gray.jpg', 'L', {}),
+    ('cmyk.jpg', 'CMYK', {}),
+    ('progressive.jpg', 'RGB', {'progressive': True}),
+    ('rgb.png', 'RGB', {}),
+    ('rgba.png', 'RGBA', {}),
+    ('gray.png', 'L', {}),
+    ('palette.png', 'P', {}),
+    ('bilevel.png', '1', {}),
+    ('palette.gif', 'P', {}),
+    ('rgb.bmp', 'RGB', {}),
+    ('rgb.webp', 'RGB', {}),
+    ('lossless.webp', 'RGBA', {'lossless': True}),
+    ('rgb.tif', 'RGB', {}),
+    ('gray.tif', 'L', {}),
+])
+def test_parse_header_is_the_same_as_pil(tmp_path, make_image, name, mode, params):
+    path = make_image(tmp_path.joinpath(name), size=(123, 45), mode=mode, **params)
+    with Image.open(path) as img:
+        expected = (img.format, img.mode, img.width, img.height)
+    with open(path, 'rb') as file:
+        info = parse_header(file.read(HEADER_SIZE), file)
+    assert info is not None
+    assert (info.format, info.mode, info.width, info.height) == expected
+    assert sniff_image(path) == info
+
+
+def test_header_beyond_buffer_is_read_from_file(tmp_path, make_image):
+    # large application segments move SOF marker after the first header buffer
+    path = make_image(tmp_path.joinpath('app.jpg'), size=(30, 20))
+    segment = b'\xff\xe5' + struct.pack('>H', 40002) + b'\x00' * 40000
+    data = path.read_bytes()
+    path.write_bytes(data[:2] + segment * 2 + data[2:])
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+        assert parse_header(header) is None
+        info = parse_header(header, file)
+    assert (info.format, info.width, info.height) == ('JPEG', 30, 20)
+
+
+@pytest.mark.parametrize('value_count', [0, 5, 0x7FFFFFFF])
+def test_tiff_with_wrong_value_count_is_not_parsed(tmp_path, value_count):
+    # BitsPerSample has at most 4 values, its count is not trusted to read values
+    entries = [(256, 3, 1, 64), (257, 3, 1, 48), (258, 3, value_count, 8), (262, 3, 1, 2)]
+    path = tmp_path.joinpath('crafted.tif')
+    path.write_bytes(b'II*\x00' + struct.pack('<IH', 8, len(entries)) +
+                     b''.join(struct.pack('<HHII', *entry) for entry in entries) + b'\x00' * HEADER_SIZE)
+    with open(path, 'rb') as file:
+        assert parse_header(file.read(16), file) is None
+
+
+def test_read_beyond_header_is_bounded_by_file_size(tmp_path):
+    path = tmp_path.joinpath('data.bin')
+    path.write_bytes(b'0123456789')
+    with open(path, 'rb') as file:
+        reader = _HeaderReader(b'01', file)
+        assert reader.read(4, 2 ** 40) == b'456789'
+        assert reader.read(20, 2 ** 40) == b''
+
+
+def test_format_without_header_parser_is_opened_by_pil(tmp_path, make_image):
+    path = make_image(tmp_path.joinpath('icon.ico'), size=(32, 32), mode='RGBA')
+    with open(path, 'rb') as file:
+        assert parse_header(file.read(HEADER_SIZE)) is None
+    info = sniff_image(path)
+    assert (info.format, info.width, info.height) == ('ICO', 32, 32)
+
+
+def test_not_image_is_none(tmp_path):
+    path = tmp_path.joinpath('notes.txt')
+    path.write_text('plain text')
+    assert sniff_image(path) is None
+    empty = tmp_path.joinpath('empty.jpg')
+    empty.write_bytes(b'')
+    assert sniff_image(empty) is None
+
+
+def test_only_plugins_of_requested_formats_are_tried(tmp_path, make_image):
+    path = make_image(tmp_path.joinpath('icon.ico'), size=(32, 32), mode='RGBA')
+    assert sniff_image(path, photo_formats={'JPEG', 'PNG'}) is None
+    assert sniff_image(path, photo_formats={'ICO'}).format == 'ICO'
+
+
+@pytest.fixture
+def corrupt_jpeg(tmp_path, make_image):
+    # unknown marker in place of SOF, neither parse_header nor Pillow can get the size
+    path = make_image(tmp_path.joinpath('corrupt.jpg'))
+    path.write_bytes(path.read_bytes().replace(b'\xff\xc0', b'\xff\x55', 1))
+    return path
+
+
+@pytest.mark.parametrize('photo_formats', [None, {'JPEG'}, {'JPEG', 'PNG', 'TIFF'}])
+def test_corrupt_image_of_requested_format_is_error(corrupt_jpeg, photo_formats):
+    with pytest.raises(Exception, match='cannot identify image file'):
+        sniff_image(corrupt_jpeg, photo_formats=photo_formats)
+
+
+def test_corrupt_image_of_other_format_is_not_image(corrupt_jpeg):
+    assert sniff_image(corrupt_jpeg, photo_formats={'PNG', 'GIF'}) is None
+
+
+def test_search_reports_corrupt_image_of_requested_format(corrupt_jpeg, make_image):
+    make_image(corrupt_jpeg.with_name('photo.jpg'))
+    result = find_and_copy_photo(corrupt_jpeg.parent, photo_requirements=PhotoRequirements(photo_formats=['JPEG']))
+    assert result.counts['found'] == 1 and result.counts['errors'] == 1
+    assert str(corrupt_jpeg) in result.errors[0]
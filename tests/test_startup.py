@@ -0,0 +1,77 @@
+import compileall
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+from PIL import Image
+
+import utils
+
+SRC_DIR = pathlib.Path(utils.__file__).parent.parent
+# median time of --help above bare interpreter start
+TARGET_MS = 125
+# modules which are imported only by commands and backends that use them
+LAZY_MODULES = ('PIL', 'filetype', 'asyncio', 'multiprocessing', 'sqlite3', 'ctypes', 'cProfile', 'hashlib',
+                'concurrent')
+# plugins which Pillow loads on its first open whatever formats are requested
+PRELOADED_PLUGINS = ('BmpImagePlugin', 'GifImagePlugin', 'JpegImagePlugin', 'PpmImagePlugin', 'PngImagePlugin')
+
+
+def _run(*args) -> str:
+    env = {**os.environ, 'PYTHONPATH': str(SRC_DIR)}
+    return subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True, check=True,
+                          timeout=60).stdout
+
+
+def _median_ms(*args, runs: int = 9) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def test_cli_import_does_not_import_commands():
+    imported = json.loads(_run('-c', 'import json, sys, main; print(json.dumps(sorted(sys.modules)))'))
+    assert [name for name in imported if name.startswith('utils')] == ['utils', 'utils.defaults', 'utils.governor',
+                                                                       'utils.metrics', 'utils.photo_info']
+    assert not {name.split('.')[0] for name in imported} & set(LAZY_MODULES)
+
+
+def test_help_starts_within_target():
+    # installed package has bytecode, so compile time of changed sources is not measured
+    compileall.compile_dir(SRC_DIR, quiet=1)
+    _run(str(SRC_DIR.joinpath('main.py')), '--help')
+    overhead_ms = _median_ms(str(SRC_DIR.joinpath('main.py')), '--help') - _median_ms('-c', 'pass')
+    assert overhead_ms < TARGET_MS
+
+
+def test_search_loads_only_plugins_of_requested_format(tmp_path):
+    # ICO and TIFF images in JPEG are not parsed from header, so Pillow opens them
+    with Image.new('RGB', (64, 48)) as img:
+        img.save(tmp_path.joinpath('photo.ico'), format='ICO')
+        img.save(tmp_path.joinpath('photo.psd.tif'), format='TIFF', compression='jpeg')
+    code = ('import json, pathlib, sys; '
+            'from utils import PhotoRequirements, find_and_copy_photo; '
+            f'result = find_and_copy_photo(pathlib.Path({str(tmp_path)!r}), '
+            "photo_requirements=PhotoRequirements(photo_formats=['ICO'])); "
+            'print(json.dumps([len(result.found), sorted(name[4:] for name in sys.modules '
+            'if name.startswith("PIL.") and name.endswith("ImagePlugin"))]))')
+    found, plugins = json.loads(_run('-c', code))
+    assert found == 1
+    assert set(plugins) - set(PRELOADED_PLUGINS) == {'IcoImagePlugin'}
+
+
+def test_names_are_imported_on_first_use():
+    from utils import defaults, photo_finder
+    assert utils.PHOTO_FORMATS is photo_finder.PHOTO_FORMATS is defaults.PHOTO_FORMATS
+    assert utils.find_and_copy_photo is photo_finder.find_and_copy_photo
+    assert 'find_and_copy_photo' in dir(utils)
+    with pytest.raises(AttributeError, match="has no attribute 'photo_finder_main'"):
+        utils.photo_finder_main
@@ -0,0 +1,58 @@
+import os
+import pathlib
+
+import pytest
+
+from utils import DirectoryWalker
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path.joinpath('root')
+    for rel_path in ('a.txt', 'b.txt', 'x/c.txt', 'x/y/d.txt', 'x/y/z/e.txt', 'skip/f.txt'):
+        path = root.joinpath(rel_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+    return root
+
+
+def _rel_paths(walker: DirectoryWalker) -> list:
+    return sorted(item.rel_dir.joinpath(item.path.name).as_posix() for item in walker)
+
+
+def test_walk_is_flat_without_recursive(tree):
+    assert _rel_paths(DirectoryWalker(tree)) == ['a.txt', 'b.txt']
+
+
+def test_recursive_walk_yields_every_file_once(tree):
+    assert _rel_paths(DirectoryWalker(tree, recursive=True, workers=4, batch_size=1, max_queue=1)) == \
+           ['a.txt', 'b.txt', 'skip/f.txt', 'x/c.txt', 'x/y/d.txt', 'x/y/z/e.txt']
+
+
+def test_skip_dir_is_reported(tree):
+    warnings = []
+    walker = DirectoryWalker(tree, recursive=True, skip_dirs=[tree.joinpath('skip')], on_warning=warnings.append)
+    assert 'skip/f.txt' not in _rel_paths(walker)
+    assert len(warnings) == 1 and 'skip' in warnings[0]
+
+
+def test_symlink_loop_is_skipped(tree):
+    os.symlink(tree.joinpath('x'), tree.joinpath('x', 'y', 'loop'))
+    warnings = []
+    paths = _rel_paths(DirectoryWalker(tree.joinpath('x'), recursive=True, on_warning=warnings.append))
+    assert paths == ['c.txt', 'y/d.txt', 'y/z/e.txt']
+    assert len(warnings) == 1 and 'symlink to its parent' in warnings[0]
+
+
+def test_batches_mark_last_batch_of_directory(tree):
+    for number in range(5):
+        tree.joinpath(f'n{number}.txt').write_text('n')
+    batches = [batch for batch in DirectoryWalker(tree, batch_size=3).iter_batches()]
+    assert [len(batch.files) for batch in batches] == [3, 3, 1]
+    assert [batch.is_last for batch in batches] == [False, False, True]
+
+
+def test_with_stat_passes_stat_of_entry(tree):
+    items = list(DirectoryWalker(tree, with_stat=True))
+    assert all(item.stat.st_size == os.stat(item.path).st_size for item in items)
+    assert all(isinstance(item.path, pathlib.Path) for item in items)
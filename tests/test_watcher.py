@@ -0,0 +1,153 @@
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from utils import PhotoRequirements, PhotoWatcher, WatchStats, is_partial_file
+
+BACKENDS = ['polling', pytest.param('inotify', marks=pytest.mark.skipif(not sys.platform.startswith('linux'),
+                                                                        reason='inotify is supported only on Linux'))]
+
+
+@pytest.mark.parametrize('name, partial', [
+    ('photo.jpg', False), ('photo.jpg.part', True), ('photo.JPG.CRDOWNLOAD', True),
+    ('.syncthing.photo.jpg.tmp', True), ('.syncthing.photo.jpg', True), ('partial.jpg', False),
+])
+def test_is_partial_file(name, partial):
+    assert is_partial_file(pathlib.Path('photos', name)) is partial
+
+
+def test_watch_stats():
+    stats = WatchStats()
+    assert stats.percentile(50) == 0.0 and 'no files' in stats.repr_short()
+    for latency in (0.4, 0.1, 0.3, 0.2):
+        stats.add(latency)
+    # percentile is upper bound of histogram bucket, max for the last one
+    assert stats.percentile(50) == 0.25 and stats.percentile(95) == 0.4
+    assert 'p50=0.25 s' in stats.repr_short() and 'max=0.40 s (4 files)' in stats.repr_short()
+    # memory does not grow with number of files
+    buckets = len(stats.histogram.counts)
+    for _ in range(10000):
+        stats.add(3.0)
+    assert stats.percentile(50) == 3.0 and stats.histogram.count == 10004 and len(stats.histogram.counts) == buckets
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(Exception, match='Watch backend=fanotify is unknown'):
+        PhotoWatcher(tmp_path, backend='fanotify')
+
+
+class _Running:
+    """
+        Watcher in background thread, it is stopped on exit
+    """
+    def __init__(self, watcher: PhotoWatcher):
+        self.watcher = watcher
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=watcher.run, kwargs={'on_ready': self._ready.set}, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        assert self._ready.wait(5)
+        return self
+
+    def __exit__(self, *args):
+        self.watcher.stop()
+        self._thread.join(5)
+        assert not self._thread.is_alive()
+
+    def wait_for(self, name: str, count: int, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while self.watcher.result.counts[name] < count:
+            assert time.monotonic() < deadline, f'{name}={self.watcher.result.counts[name]} after {timeout} s'
+            time.sleep(0.02)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    find_dir, copy_dir = tmp_path.joinpath('find'), tmp_path.joinpath('copy')
+    find_dir.mkdir()
+    return find_dir, copy_dir
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_new_photos_are_copied(dirs, make_image, backend):
+    find_dir, copy_dir = dirs
+    make_image(find_dir.joinpath('old.png'))
+    watcher = PhotoWatcher(find_dir, copy_dir, recursive=True, backend=backend, settle=0.1, poll_interval=0.05,
+                           photo_requirements=PhotoRequirements(photo_modes=['RGB']))
+    with _Running(watcher) as running:
+        make_image(find_dir.joinpath('new.png'))
+        make_image(find_dir.joinpath('gray.png'), mode='L')
+        find_dir.joinpath('notes.txt').write_text('not a photo')
+        # browser writes download under temporary name and renames it when it is complete
+        make_image(find_dir.joinpath('download.png.crdownload'), image_format='PNG')
+        os.rename(find_dir.joinpath('download.png.crdownload'), find_dir.joinpath('download.png'))
+        make_image(find_dir.joinpath('inner', 'nested.png'))
+        running.wait_for('copied', 3)
+        time.sleep(0.3)
+    assert watcher.backend == backend
+    assert sorted(path.relative_to(copy_dir).as_posix() for path in copy_dir.rglob('*.png')) == \
+           ['download.png', 'inner/nested.png', 'new.png']
+    # files which existed before watch are not checked
+    assert watcher.result.counts['copied'] == 3 and watcher.stats.histogram.count == 5
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_file_is_checked_after_it_settles(dirs, make_image, backend):
+    find_dir, copy_dir = dirs
+    watcher = PhotoWatcher(find_dir, copy_dir, backend=backend, settle=0.5, poll_interval=0.05,
+                           verify_decode=True)
+    path = find_dir.joinpath('slow.png')
+    make_image(path, size=(200, 200))
+    data = path.read_bytes()
+    with _Running(watcher) as running:
+        # photo is written in parts with pauses shorter than settle, it is not checked until writes stop
+        with open(path.with_name('copy.png'), 'wb') as file:
+            for part in range(4):
+                file.write(data[part * len(data) // 4:(part + 1) * len(data) // 4])
+                file.flush()
+                time.sleep(0.2)
+        running.wait_for('copied', 1)
+    assert watcher.result.counts['errors'] == 0
+    assert copy_dir.joinpath('copy.png').read_bytes() == data
+
+
+def test_copy_dir_inside_find_dir_is_not_watched(tmp_path, make_image):
+    find_dir = tmp_path
+    copy_dir = tmp_path.joinpath('copy')
+    watcher = PhotoWatcher(find_dir, copy_dir, recursive=True, backend='polling', settle=0.1, poll_interval=0.05)
+    with _Running(watcher) as running:
+        make_image(find_dir.joinpath('photo.png'))
+        running.wait_for('copied', 1)
+        time.sleep(0.5)
+    assert watcher.result.counts['copied'] == 1 and watcher.result.counts['found'] == 1
+
+
+def test_cli_watch_stops_on_sigterm(dirs, make_image):
+    find_dir, copy_dir = dirs
+    copy_dir.mkdir()
+    make_image(find_dir.joinpath('old.png'))
+    main_path = pathlib.Path(__file__).parent.parent.joinpath('src', 'main.py')
+    process = subprocess.Popen([sys.executable, str(main_path), '-d', str(find_dir), 'watch', str(copy_dir),
+                                '--initial_scan', '--watch_backend', 'polling', '--settle', '0.1',
+                                '--poll_interval', '0.1'], stdout=subprocess.PIPE, text=True)
+    try:
+        assert process.stdout.readline().strip() == ''
+        assert process.stdout.readline().startswith('Start watch')
+        assert process.stdout.readline().startswith(f'Watching {find_dir} with polling')
+        make_image(find_dir.joinpath('new.png'))
+        deadline = time.monotonic() + 5
+        while not copy_dir.joinpath('new.png').exists():
+            assert time.monotonic() < deadline
+            time.sleep(0.02)
+        process.send_signal(signal.SIGTERM)
+        output, _ = process.communicate(timeout=5)
+    finally:
+        process.kill()
+    assert 'Watch latency:' in output and '(1 files)' in output and 'copied=2' in output